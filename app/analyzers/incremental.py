@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import math
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+
+from app.core.period_utils import Dhis2PeriodUtils
+
+
+@dataclass
+class AnalysisScope:
+    """Date windows to analyse, for the given target org units or (None) all of them."""
+    windows: list
+    org_units: list = None
+
+
+@dataclass
+class IncrementalPlan:
+    stage_name: str
+    fingerprint: str
+    started_at: float
+    full: bool = True
+    scopes: list = field(default_factory=list)
+
+    def checkpoint(self):
+        return {'stage': self.stage_name, 'fingerprint': self.fingerprint, 'started_at': self.started_at,
+                'full': self.full}
+
+
+class IncrementalPlanner:
+    """
+    Decide what an outlier or validation rule stage has to re-analyse since its last checkpoint.
+
+    Two kinds of periods are re-analysed: periods which have ended since the checkpoint (they
+    were only analysed up to the end of the last run's range) for every org unit, and periods
+    with data values created, updated or deleted since the checkpoint (``lastUpdatedDuration``),
+    the current period included, for the target org units above the changed values. Everything
+    else keeps the counts posted by earlier runs, because stages only reconcile the org units
+    and windows they analysed.
+
+    Outlier statistics are computed over the whole duration, so a change in one period can in
+    principle move another period across the threshold; the periodic full run picks that up.
+    """
+    CHANGE_QUERY_CHUNK_SIZE = 50
+
+    def __init__(self, api_utils):
+        self.api_utils = api_utils
+        self.period_utils = Dhis2PeriodUtils()
+
+    async def plan(self, stage, start_date, end_date, describe_source, session, semaphore):
+        """
+        Return None when the stage does not run incrementally, otherwise an ``IncrementalPlan``.
+        ``describe_source()`` returns the dataValueSets parameters selecting the stage's input
+        data (one list per request) and the period types of that data.
+        """
+        store = self.api_utils.client.checkpoints
+        if store is None or not stage['params'].get('incremental', True):
+            return None
+
+        started_at = time.time()
+        plan = IncrementalPlan(stage['name'], store.fingerprint(stage), started_at)
+        checkpoint = await asyncio.to_thread(store.get, stage['name'])
+        if store.needs_full_run(stage, checkpoint, started_at):
+            logging.info(f"Stage '{stage['name']}': running a full analysis")
+            return plan
+
+        since = checkpoint['started_at'] - store.overlap
+        try:
+            source_params, period_types = await describe_source()
+            plan.scopes = await self._scopes(stage, start_date, end_date, source_params, period_types,
+                                             since, started_at, session, semaphore)
+        except Exception as e:
+            logging.warning(f"Stage '{stage['name']}': could not determine what changed, "
+                            f"running a full analysis: {e}")
+            return plan
+
+        plan.full = False
+        return plan
+
+    async def _scopes(self, stage, start_date, end_date, source_params, period_types, since, started_at,
+                      session, semaphore):
+        completed = set()
+        for period_type in period_types:
+            completed.update(self.period_utils.periods_ended_between(
+                period_type, datetime.fromtimestamp(since), end_date))
+
+        organisation_unit = stage.get('organisation_unit')
+        explicit = organisation_unit if isinstance(organisation_unit, list) else None
+        roots = explicit or await self.api_utils.get_organisation_units_at_level(1, session, semaphore)
+        changed = await self._changed_data(source_params, roots, start_date, end_date,
+                                           started_at - since, session, semaphore)
+        changed_periods = {pe for _, pe in changed} - completed
+        targets = await self._targets({ou for ou, pe in changed if pe in changed_periods},
+                                      stage['params'].get('level'), explicit, session, semaphore)
+
+        scopes = []
+        completed_windows = self._windows(completed, start_date, end_date)
+        if completed_windows:
+            scopes.append(AnalysisScope(completed_windows))
+        changed_windows = self._windows(changed_periods, start_date, end_date)
+        if changed_windows and targets:
+            scopes.append(AnalysisScope(changed_windows, sorted(targets)))
+
+        logging.info(f"Stage '{stage['name']}': incremental run over {len(completed)} newly completed periods "
+                     f"and {len(changed_periods)} changed periods in {len(targets)} org units")
+        return scopes
+
+    async def _changed_data(self, source_params, roots, start_date, end_date, seconds, session, semaphore):
+        """(org unit, period) pairs with data values changed in the last ``seconds``."""
+        changed = set()
+
+        def record(dv):
+            # Only the keys are needed, so nothing is kept in the response
+            changed.add((dv['orgUnit'], dv['period']))
+            return False
+
+        common = [('orgUnit', ou) for ou in roots] + [
+            ('startDate', start_date.strftime('%Y-%m-%d')),
+            ('endDate', end_date.strftime('%Y-%m-%d')),
+            ('children', 'true'),
+            ('includeDeleted', 'true'),
+            ('lastUpdatedDuration', f'{max(1, math.ceil(seconds / 60))}m'),
+        ]
+        await asyncio.gather(*[
+            self.api_utils.fetch_datavalue_sets(params + common, session, record, semaphore)
+            for params in source_params
+        ])
+        return changed
+
+    async def _targets(self, changed_org_units, level, explicit, session, semaphore):
+        """
+        The stage's target org units above ``changed_org_units``. Changes above the targets are
+        not part of any target's analysis and are ignored.
+        """
+        if not changed_org_units:
+            return set()
+        paths = await self.api_utils.get_organisation_unit_paths(changed_org_units, session, semaphore)
+        ancestors = [path.split('/') for path in paths.values()]
+        if explicit is not None:
+            wanted = set(explicit)
+            return {ou for parts in ancestors for ou in parts if ou in wanted}
+        return {parts[level] for parts in ancestors if len(parts) > level}
+
+    def _windows(self, periods, start_date, end_date):
+        """
+        Merge the date ranges of ``periods`` starting within the stage's range into windows. A
+        period which has not ended yet is analysed up to ``end_date``, as in a full run.
+        """
+        first_day = datetime(start_date.year, start_date.month, start_date.day)
+        bounds = []
+        for pe in periods:
+            pe_start = self.period_utils.get_start_date_from_period(pe)
+            pe_end = self.period_utils.get_end_date_from_period(pe)
+            if first_day <= pe_start <= end_date:
+                bounds.append((pe_start, min(pe_end, end_date)))
+
+        windows = []
+        for pe_start, pe_end in sorted(bounds):
+            if windows and pe_start <= windows[-1][1] + relativedelta(days=1):
+                windows[-1] = (windows[-1][0], max(windows[-1][1], pe_end))
+            else:
+                windows.append((pe_start, pe_end))
+        return windows
+
+    @classmethod
+    def chunked(cls, name, values):
+        """dataValueSets parameters selecting ``values`` of ``name``, a limited number per request."""
+        values = list(values)
+        return [[(name, value) for value in values[i:i + cls.CHANGE_QUERY_CHUNK_SIZE]]
+                for i in range(0, len(values), cls.CHANGE_QUERY_CHUNK_SIZE)]
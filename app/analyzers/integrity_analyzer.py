@@ -1,20 +1,25 @@
 import asyncio
 
 import logging
-from app.core.api_utils import Dhis2ApiUtils
+from datetime import datetime
 from urllib.parse import urlencode
 from app.core.period_utils import Dhis2PeriodUtils
 
 import requests.exceptions
+from aiohttp import ClientResponseError
 
 from app.analyzers.stage_analyzer import StageAnalyzer
 
 class IntegrityCheckAnalyzer(StageAnalyzer):
-    def __init__(self, config, base_url, headers):
-        super().__init__(config, base_url, headers)
+    # Summaries are polled after 0.25s, 0.5s, 1s, ... at most every 10s, for up to 10 minutes
+    INITIAL_POLL_INTERVAL = 0.25
+    MAX_POLL_INTERVAL = 10
+    POLL_TIMEOUT = 600
+
+    def __init__(self, config, base_url, headers, api_utils=None):
+        super().__init__(config, base_url, headers, api_utils)
 
         #Define a period utils instance for this class
-        self.api_utils = Dhis2ApiUtils(base_url, d2_token=self.d2_token)
         self.period_utils = Dhis2PeriodUtils()
 
     async def _prepare_params(self, stage, session, semaphore):
@@ -52,9 +57,16 @@ class IntegrityCheckAnalyzer(StageAnalyzer):
             stage['params']['orgunit'] = orgunits[0]
 
     async def trigger_only_async(self, stage, session, semaphore):
-        """Prepare params and trigger the DHIS2 integrity job. Returns immediately without waiting."""
+        """
+        Prepare params and trigger the DHIS2 integrity job for the checks whose summaries are
+        older than ``max_age``. Returns immediately without waiting.
+        """
         await self._prepare_params(stage, session, semaphore)
-        await self._trigger_metadata_integrity_summaries_async(session, stage, semaphore)
+        tracked = await self._tracked_check_codes(stage, session, semaphore)
+        summaries = await self._fetch_completed_summaries_async(session, stage, semaphore)
+        stale = await self._stale_check_codes(stage, tracked, summaries, session, semaphore)
+        if stale:
+            await self._trigger_metadata_integrity_summaries_async(session, stage, semaphore, stale)
 
     async def collect_results_async(self, stage, session, semaphore):
         """Fetch completed results and build the dataValueSet (call after job finishes)."""
@@ -63,78 +75,112 @@ class IntegrityCheckAnalyzer(StageAnalyzer):
         return self.process_results(results, stage)
 
     async def run_stage(self, stage, session, semaphore):
-        try:
-            logging.info(f"Running metadata integrity stage '{stage['name']}'")
-            await self._prepare_params(stage, session, semaphore)
-            results = await self._fetch_summary_results_async(session, stage, semaphore)
-            data_value_set = self.process_results(results, stage)
-            return {
-                'dataValueSet': data_value_set,
-                'errors': []
-            }
+        return (await self.run_stages([stage], session, semaphore))[0]
 
+    async def run_stages(self, stages, session, semaphore):
+        """
+        Run several integrity stages with a single summary job: the union of their checks is
+        triggered and polled once, and the summaries are handed to each stage's
+        ``process_results``. Returns one result per stage, ``[]`` for a stage which failed.
+        """
+        for stage in stages:
+            logging.info(f"Running metadata integrity stage '{stage['name']}'")
+        outcomes = await asyncio.gather(*[self._prepare_params(stage, session, semaphore) for stage in stages],
+                                        return_exceptions=True)
+        results = [[] for _ in stages]
+        prepared = []
+        for i, (stage, outcome) in enumerate(zip(stages, outcomes)):
+            if isinstance(outcome, Exception):
+                logging.error(f"Error running integrity stage '{stage['name']}': {outcome}")
+            else:
+                prepared.append(i)
+        if not prepared:
+            return results
+
+        # Checks monitored by several stages are only run once, and are reused only when
+        # they are recent enough for every one of those stages
+        max_age_by_code = {}
+        for i in prepared:
+            for code, max_age in self._max_ages(stages[i]).items():
+                max_age_by_code[code] = min(max_age, max_age_by_code.get(code, max_age))
+        combined = {
+            'name': ', '.join(stages[i]['name'] for i in prepared),
+            'params': {
+                'data_element_map': {code: de for i in prepared
+                                     for code, de in stages[i]['params']['data_element_map'].items()},
+                'max_age_by_code': max_age_by_code,
+            },
+        }
+        try:
+            summaries = await self._fetch_summary_results_async(session, combined, semaphore)
         except Exception as e:
-            logging.error(f"Error running integrity stage '{stage['name']}': {e}")
-            return []
+            logging.error(f"Error running integrity stage '{combined['name']}': {e}")
+            return results
+
+        for i in prepared:
+            try:
+                results[i] = {
+                    'dataValueSet': self.process_results(summaries, stages[i]),
+                    'errors': []
+                }
+            except Exception as e:
+                logging.error(f"Error running integrity stage '{stages[i]['name']}': {e}")
+        return results
 
     async def fetch_data_elements_to_monitor(self, session, params, semaphore):
         """
         Fetches data elements from the specified group and maps them by normalized code (without 'MI_' prefix).
         """
-        url = f'{self.base_url}/api/dataElementGroups'
-
-        if 'monitoring_group' in params:
-            fields_to_get = "dataElements[id,code]"
-            url = f'{url}/{params["monitoring_group"]}?fields={fields_to_get}'
-
-        async with semaphore:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    payload = await response.json()
-                    raw_elements = payload.get("dataElements", [])
-
-                    # Normalize and include both codes
-                    normalized_map = {}
-                    for de in raw_elements:
-                        original_code = de.get("code", "")
-                        if original_code.startswith("MI_"):
-                            check_code = original_code[3:]  # Strip 'MI_'
-                            normalized_map[check_code] = {
-                                "id": de["id"],
-                                "de_code": original_code,
-                                "check_code": check_code,
-                                "name": de.get("name", "")
-                            }
-                    return normalized_map
-                else:
-                    raise requests.exceptions.RequestException(
-                        f"Failed to fetch data elements to monitor: {response.status}")
-
-    async def _trigger_metadata_integrity_summaries_async(self, session, stage, semaphore):
+        group = params.get('monitoring_group')
+        try:
+            # Goes through the metadata cache when one is configured
+            groups = await self.api_utils.fetch_data_element_groups_async(
+                session, filters=[f'id:eq:{group}'], fields=['id', 'dataElements[id,code,name]'], semaphore=semaphore
+            )
+        except ClientResponseError as e:
+            raise requests.exceptions.RequestException(f"Failed to fetch data elements to monitor: {e.status}")
+        raw_elements = groups[0].get("dataElements", []) if groups else []
+
+        # Normalize and include both codes
+        normalized_map = {}
+        for de in raw_elements:
+            original_code = de.get("code", "")
+            if original_code.startswith("MI_"):
+                check_code = original_code[3:]  # Strip 'MI_'
+                normalized_map[check_code] = {
+                    "id": de["id"],
+                    "de_code": original_code,
+                    "check_code": check_code,
+                    "name": de.get("name", "")
+                }
+        return normalized_map
+
+    async def _trigger_metadata_integrity_summaries_async(self, session, stage, semaphore, check_codes=None):
         # POST /api/dataIntegrity/summary?checks=<name1>,<name2>
-        check_codes = list(stage.get('params', {}).get("data_element_map", {}).keys())
+        if check_codes is None:
+            check_codes = list(stage.get('params', {}).get("data_element_map", {}).keys())
+        check_codes = sorted(check_codes)
         url = f'{self.base_url}/api/dataIntegrity/summary'
         if check_codes:
             query = urlencode({'checks': ','.join(check_codes)})
             url = f'{url}?{query}'
 
-        async with semaphore:
-            async with session.post(url) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    raise requests.exceptions.RequestException(f"Failed to trigger metadata integrity summaries: {response.status}")
+        # Re-triggering a summary run is harmless, so the POST may be retried
+        async with self.api_utils.request(session, 'POST', url, semaphore, idempotent=True) as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                raise requests.exceptions.RequestException(f"Failed to trigger metadata integrity summaries: {response.status}")
 
     async def _poll_running_summaries_async(self, session,semaphore):
         # GET /api/dataIntegrity/summary/running
         url = f'{self.base_url}/api/dataIntegrity/summary/running'
-        async with semaphore:
-            async with session.get(url) as response:
-                if response.status == 200:
-                   response = await response.json()
-                   return response
-                else:
-                    raise requests.exceptions.RequestException(f"Failed to poll running summaries: {response.status}")
+        async with self.api_utils.request(session, 'GET', url, semaphore) as response:
+            if response.status == 200:
+               response = await response.json()
+               return response
+            else:
+                raise requests.exceptions.RequestException(f"Failed to poll running summaries: {response.status}")
 
     async def _fetch_completed_summaries_async(self, session, stage, semaphore):
         # GET /api/dataIntegrity/summary/completed
@@ -143,24 +189,114 @@ class IntegrityCheckAnalyzer(StageAnalyzer):
         if params is not None:
             query = urlencode({'checks': ','.join(params)})
             url = f'{url}?{query}'
-        async with semaphore:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    raise requests.exceptions.RequestException(f"Failed to fetch completed summaries: {response.status}")
+        async with self.api_utils.request(session, 'GET', url, semaphore) as response:
+            if response.status == 200:
+                return await response.json()
+            else:
+                raise requests.exceptions.RequestException(f"Failed to fetch completed summaries: {response.status}")
 
     async def _fetch_summary_results_async(self, session, stage, semaphore):
-        await self._trigger_metadata_integrity_summaries_async(session, stage, semaphore)
-        await asyncio.sleep(5)
-        running = await self._poll_running_summaries_async(session, semaphore)
-        timeout = 600
-        while running and timeout > 0:
-            await asyncio.sleep(5)
-            running = await self._poll_running_summaries_async(session, semaphore)
-            timeout -= 5
-        results =  await self._fetch_completed_summaries_async(session, stage, semaphore)
-        return results
+        """
+        Trigger the stage's checks and wait for their summaries.
+
+        Checks whose summaries are younger than the stage's ``max_age`` are reused rather than
+        triggered again. Only the checks this stage triggered are tracked, so jobs started by
+        others do not hold it up. A check is done once its summary reports a ``finishedTime``
+        newer than the one reported just before the trigger (comparing server times with server
+        times). Polling starts fast and backs off, so quick checks are collected within about a
+        second.
+        """
+        tracked = await self._tracked_check_codes(stage, session, semaphore)
+        previous = await self._fetch_completed_summaries_async(session, stage, semaphore)
+        before = self._finished_times(previous)
+        stale = await self._stale_check_codes(stage, tracked, previous, session, semaphore)
+        if not stale:
+            return previous
+        await self._trigger_metadata_integrity_summaries_async(session, stage, semaphore, stale)
+        tracked = stale
+
+        interval, waited = self.INITIAL_POLL_INTERVAL, 0
+        while True:
+            await asyncio.sleep(interval)
+            waited += interval
+            results = await self._fetch_completed_summaries_async(session, stage, semaphore)
+            finished = self._finished_times(results)
+            pending = [code for code in tracked if not self._is_newer(finished.get(code), before.get(code))]
+            if not pending:
+                logging.debug(f"Integrity checks of stage '{stage['name']}' finished after {waited:.2f}s")
+                return {**previous, **results}
+            if waited >= self.POLL_TIMEOUT:
+                logging.warning(f"Integrity checks {', '.join(sorted(pending))} of stage '{stage['name']}' did not "
+                                f"finish within {self.POLL_TIMEOUT}s, using their previous results")
+                return {**previous, **results}
+            interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+
+    @staticmethod
+    def _max_ages(stage):
+        """The ``max_age`` in seconds (None: always run) of each of the stage's checks."""
+        params = stage.get('params', {})
+        if 'max_age_by_code' in params:
+            return params['max_age_by_code']
+        max_age = params.get('max_age')
+        return {code: float(max_age) if max_age is not None else 0.0 for code in params.get('data_element_map', {})}
+
+    async def _stale_check_codes(self, stage, tracked, summaries, session, semaphore):
+        """The ``tracked`` checks without a summary finished within their ``max_age``."""
+        max_ages = self._max_ages(stage)
+        if not any(max_ages.get(code) for code in tracked):
+            return set(tracked)
+        server_time = await self._server_time(session, semaphore)
+        finished = self._finished_times(summaries)
+        stale = set()
+        for code in tracked:
+            finished_time = self._parse_time(finished.get(code))
+            if finished_time is None or (server_time - finished_time).total_seconds() > max_ages.get(code, 0):
+                stale.add(code)
+        reused = len(tracked) - len(stale)
+        if reused:
+            logging.info(f"Stage '{stage['name']}': reusing {reused} recent integrity summaries, "
+                         f"triggering {len(stale)}")
+        return stale
+
+    async def _server_time(self, session, semaphore):
+        """The server's current time, which ``finishedTime`` is comparable with."""
+        info = await self.api_utils.get_system_info(session)
+        server_time = self._parse_time(info.get('serverDate'))
+        if server_time is None:
+            logging.warning("The server did not report its time, comparing integrity summaries with local time")
+            return datetime.now()
+        return server_time
+
+    @staticmethod
+    def _parse_time(value):
+        if not value:
+            return None
+        try:
+            return datetime.fromisoformat(value).replace(tzinfo=None)
+        except ValueError:
+            return None
+
+    async def _tracked_check_codes(self, stage, session, semaphore):
+        """The stage's check codes which the server knows, and so will report a summary for."""
+        codes = set(stage.get('params', {}).get('data_element_map', {}))
+        checks = await self.api_utils.client.memo(session).do(
+            'integrity_checks', lambda: self.api_utils.get_metadata_integrity_checks_async(session, semaphore)
+        )
+        known = {check.get('code') for check in checks}
+        unknown = codes - known
+        if unknown:
+            logging.warning(f"Stage '{stage['name']}' monitors unknown integrity checks: {', '.join(sorted(unknown))}")
+        return codes & known
+
+    @staticmethod
+    def _finished_times(results):
+        return {v['code']: v.get('finishedTime') for v in (results or {}).values()
+                if isinstance(v, dict) and v.get('code')}
+
+    @staticmethod
+    def _is_newer(finished_time, previous_time):
+        # DHIS2 timestamps share one format, so they compare as strings
+        return finished_time is not None and (previous_time is None or finished_time > previous_time)
 
     @staticmethod
     def transform_integrity_check_to_data_value(result, dataelement_uid):
@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+from app.core.period_utils import Dhis2PeriodUtils
+
+
+class LocalOutlierEngine:
+    """
+    Outlier detection computed from raw data values, as an alternative to ``/api/outlierDetection``.
+
+    Every series (org unit, data element, category option combo, attribute option combo) is
+    scored at once with grouped array operations, following the DHIS2 definitions:
+
+    - ``Z_SCORE``: ``|value - mean| / standard deviation`` of the series;
+    - ``MOD_Z_SCORE``: ``0.6745 * |value - median| / median absolute deviation``;
+    - ``MIN_MAX``: the value lies outside the stored min/max bounds of its series.
+
+    The statistics are computed from the values in ``statistics_range``; values in ``check_range``
+    are tested. A period belongs to a range when it lies completely within it. Series without any
+    spread, and values which are not numbers, are skipped as DHIS2 does. There is no limit on the
+    number of outliers returned.
+    """
+    MOD_Z_SCORE_FACTOR = 0.6745
+    SERIES = ['orgUnit', 'dataElement', 'categoryOptionCombo', 'attributeOptionCombo']
+    COLUMNS = SERIES + ['period', 'value', 'deleted']
+
+    def __init__(self, algorithm, threshold, check_range, statistics_range=None, numeric_data_elements=None,
+                 min_max_bounds=None):
+        self.algorithm = algorithm
+        self.threshold = float(threshold)
+        self.check_range = check_range
+        self.statistics_range = statistics_range or check_range
+        self.numeric_data_elements = numeric_data_elements
+        # (orgUnit, dataElement, categoryOptionCombo) -> (min, max), for MIN_MAX
+        self.min_max_bounds = min_max_bounds or {}
+        self.period_utils = Dhis2PeriodUtils()
+        self._period_bounds = {}
+
+    def _in_range(self, periods, date_range):
+        start = pd.Timestamp(date_range[0].year, date_range[0].month, date_range[0].day)
+        end = pd.Timestamp(date_range[1].year, date_range[1].month, date_range[1].day, 23, 59, 59)
+        inside = {}
+        for pe in periods:
+            bounds = self._period_bounds.get(pe)
+            if bounds is None:
+                try:
+                    bounds = (self.period_utils.get_start_date_from_period(pe),
+                              self.period_utils.get_end_date_from_period(pe))
+                except ValueError:
+                    bounds = (None, None)
+                self._period_bounds[pe] = bounds
+            inside[pe] = bounds[0] is not None and bounds[0] >= start and bounds[1] <= end
+        return inside
+
+    def detect(self, data_values):
+        """Return the outliers among ``data_values`` in the shape of DHIS2 ``outlierValues``."""
+        frame = pd.DataFrame.from_records(list(data_values), columns=self.COLUMNS)
+        if frame.empty:
+            return []
+        frame = frame[frame['deleted'] != True]  # noqa: E712 (missing is NaN, not False)
+        if self.numeric_data_elements is not None:
+            frame = frame[frame['dataElement'].isin(self.numeric_data_elements)]
+        frame = frame.assign(
+            attributeOptionCombo=frame['attributeOptionCombo'].fillna(''),
+            x=pd.to_numeric(frame['value'], errors='coerce'),
+        )
+        frame = frame[frame['x'].notna()]
+        periods = frame['period'].unique()
+        check = frame['period'].map(self._in_range(periods, self.check_range)).astype(bool)
+        if self.algorithm == 'MIN_MAX':
+            return self._records(self._min_max(frame[check]))
+
+        candidates = frame[check]
+        in_statistics = frame[frame['period'].map(self._in_range(periods, self.statistics_range)).astype(bool)]
+        if candidates.empty or in_statistics.empty:
+            return []
+        statistics = in_statistics.groupby(self.SERIES)['x']
+        if self.algorithm == 'Z_SCORE':
+            centre, spread = statistics.mean(), statistics.std(ddof=0)
+            factor = 1.0
+        elif self.algorithm == 'MOD_Z_SCORE':
+            centre = statistics.median()
+            deviation = (in_statistics['x'] - in_statistics.join(centre.rename('centre'), on=self.SERIES)['centre'])
+            spread = deviation.abs().groupby([in_statistics[c] for c in self.SERIES]).median()
+            factor = self.MOD_Z_SCORE_FACTOR
+        else:
+            raise ValueError(f"Unsupported outlier algorithm for the local engine: {self.algorithm}")
+
+        scored = candidates.join(centre.rename('centre'), on=self.SERIES).join(spread.rename('spread'),
+                                                                              on=self.SERIES)
+        scored = scored[scored['spread'] > 0]
+        score = factor * (scored['x'] - scored['centre']).abs() / scored['spread']
+        return self._records(scored[np.asarray(score >= self.threshold)])
+
+    def _min_max(self, frame):
+        if not self.min_max_bounds:
+            return frame.iloc[0:0]
+        bounds = pd.DataFrame(
+            [(ou, de, coc, lo, hi) for (ou, de, coc), (lo, hi) in self.min_max_bounds.items()],
+            columns=['orgUnit', 'dataElement', 'categoryOptionCombo', 'min', 'max'],
+        )
+        merged = frame.merge(bounds, on=['orgUnit', 'dataElement', 'categoryOptionCombo'], how='inner')
+        return merged[(merged['x'] < merged['min']) | (merged['x'] > merged['max'])]
+
+    @staticmethod
+    def _records(frame):
+        return [
+            {'ou': ou, 'pe': pe, 'de': de, 'coc': coc, 'aoc': aoc, 'value': value}
+            for ou, pe, de, coc, aoc, value in zip(frame['orgUnit'], frame['period'], frame['dataElement'],
+                                                   frame['categoryOptionCombo'], frame['attributeOptionCombo'],
+                                                   frame['x'])
+        ]
@@ -0,0 +1,201 @@
+import ast
+import re
+
+import numpy as np
+import pandas as pd
+
+from app.core.period_utils import Dhis2PeriodUtils
+
+
+class LocalValidationRuleEngine:
+    """
+    Validation rules evaluated from raw data values, as an alternative to
+    ``/api/dataAnalysis/validationRules``.
+
+    Each side of a rule is compiled once into a function of NumPy arrays. The data values are
+    pivoted into one row per (org unit, period, attribute option combo) and one column per
+    referenced item, and every rule is then evaluated for all rows at once.
+
+    Expressions may use data element totals (``#{de}``), category option combos
+    (``#{de.coc}``), constants (``C{uid}``), numbers, ``+ - * / %`` and parentheses. Missing
+    values count as zero unless the side's ``missingValueStrategy`` skips them, as in DHIS2.
+    Rules are only evaluated for rows with at least one value of the group's data elements,
+    and for periods of the rule's period type.
+    """
+    OPERATORS = {
+        'equal_to': np.equal,
+        'not_equal_to': np.not_equal,
+        'greater_than': np.greater,
+        'greater_than_or_equal_to': np.greater_equal,
+        'less_than': np.less,
+        'less_than_or_equal_to': np.less_equal,
+    }
+    PAIR_OPERATORS = ('compulsory_pair', 'exclusive_pair')
+    ITEM = re.compile(r'#\{(\w{11})(?:\.(\w{11}))?\}')
+    CONSTANT = re.compile(r'C\{(\w{11})\}')
+    BINARY = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.divide, ast.Mod: np.mod}
+    UNARY = {ast.USub: np.negative, ast.UAdd: np.positive}
+
+    def __init__(self, rules, constants=None):
+        """
+        ``rules`` are DHIS2 validation rules with ``id``, ``operator``, ``periodType`` and both
+        sides' ``expression`` and ``missingValueStrategy``; ``constants`` maps uids to values.
+        Raises ValueError for a rule which cannot be evaluated locally.
+        """
+        self.constants = constants or {}
+        self.items = set()
+        self.rules = [self._compile_rule(rule) for rule in rules]
+
+    @property
+    def data_elements(self):
+        return sorted({de for de, _ in self.items})
+
+    # --- Compilation ---
+    def _compile_rule(self, rule):
+        operator = rule.get('operator')
+        if operator not in self.OPERATORS and operator not in self.PAIR_OPERATORS:
+            raise ValueError(f"Validation rule '{rule['id']}' has an unsupported operator '{operator}'")
+        return {
+            'id': rule['id'],
+            'operator': operator,
+            'period_type': rule.get('periodType'),
+            'left': self._compile_side(rule, 'leftSide'),
+            'right': self._compile_side(rule, 'rightSide'),
+        }
+
+    def _compile_side(self, rule, side):
+        expression = (rule.get(side) or {}).get('expression', '')
+        items = []
+
+        def item(match):
+            key = (match.group(1), match.group(2))
+            if key not in items:
+                items.append(key)
+            return f'_{items.index(key)}'
+
+        def constant(match):
+            if match.group(1) not in self.constants:
+                raise ValueError(f"Validation rule '{rule['id']}' uses an unknown constant '{match.group(1)}'")
+            return repr(float(self.constants[match.group(1)]))
+
+        source = self.CONSTANT.sub(constant, self.ITEM.sub(item, expression))
+        try:
+            tree = ast.parse(source.strip() or '0', mode='eval')
+            evaluate = self._compile_node(tree.body)
+        except (SyntaxError, ValueError):
+            raise ValueError(f"Validation rule '{rule['id']}' has an expression the local engine cannot "
+                             f"evaluate: {expression}")
+        self.items.update(items)
+        return {
+            'items': items,
+            'evaluate': evaluate,
+            'strategy': (rule.get(side) or {}).get('missingValueStrategy', 'SKIP_IF_ALL_VALUES_MISSING'),
+        }
+
+    def _compile_node(self, node):
+        if isinstance(node, ast.BinOp) and type(node.op) in self.BINARY:
+            op, left, right = self.BINARY[type(node.op)], self._compile_node(node.left), self._compile_node(node.right)
+            return lambda values: op(left(values), right(values))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in self.UNARY:
+            op, operand = self.UNARY[type(node.op)], self._compile_node(node.operand)
+            return lambda values: op(operand(values))
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            value = float(node.value)
+            return lambda values: value
+        if isinstance(node, ast.Name) and re.fullmatch(r'_\d+', node.id):
+            index = int(node.id[1:])
+            return lambda values: values[index]
+        raise ValueError(f"Unsupported expression element: {ast.dump(node)}")
+
+    # --- Evaluation ---
+    def _matrix(self, data_values):
+        """Item values (NaN when missing) with one row per (orgUnit, period, attributeOptionCombo)."""
+        keys = ['orgUnit', 'period', 'attributeOptionCombo']
+        frame = pd.DataFrame.from_records(
+            list(data_values), columns=keys + ['dataElement', 'categoryOptionCombo', 'value', 'deleted'])
+        frame = frame[frame['deleted'] != True]  # noqa: E712 (missing is NaN, not False)
+        frame = frame.assign(attributeOptionCombo=frame['attributeOptionCombo'].fillna(''),
+                             x=pd.to_numeric(frame['value'], errors='coerce'))
+        frame = frame[frame['x'].notna() & frame['dataElement'].isin(self.data_elements)]
+        columns = sorted({self._column(item) for item in self.items})
+        if frame.empty:
+            return pd.DataFrame(columns=columns)
+
+        # Data element totals, and the category option combos referred to on their own
+        combos = frame.assign(item=frame['dataElement'] + '.' + frame['categoryOptionCombo'])
+        combos = combos[combos['item'].isin(columns)]
+        matrix = frame.pivot_table(index=keys, columns='dataElement', values='x', aggfunc='sum')
+        if not combos.empty:
+            matrix = pd.concat([matrix, combos.pivot_table(index=keys, columns='item', values='x', aggfunc='sum')],
+                               axis=1)
+        return matrix.reindex(columns=columns)
+
+    @staticmethod
+    def _column(item):
+        de, coc = item
+        return f'{de}.{coc}' if coc else de
+
+    @staticmethod
+    def _side_values(side, matrix, rows):
+        if not side['items']:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = np.broadcast_to(side['evaluate']([]), rows.shape).astype(float)
+            return np.where(np.isfinite(values), values, np.nan)
+        raw = [matrix[LocalValidationRuleEngine._column(item)].to_numpy(dtype=float)[rows]
+               for item in side['items']]
+        missing = np.vstack([np.isnan(values) for values in raw])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.asarray(side['evaluate']([np.nan_to_num(v) for v in raw]), dtype=float)
+        values = np.broadcast_to(values, rows.shape).copy()
+        # DHIS2 treats a division by zero as a missing side, so the rule is not checked
+        values[~np.isfinite(values)] = np.nan
+        if side['strategy'] == 'SKIP_IF_ANY_VALUE_MISSING':
+            values[missing.any(axis=0)] = np.nan
+        elif side['strategy'] != 'NEVER_SKIP':
+            values[missing.all(axis=0)] = np.nan
+        return values
+
+    def evaluate(self, data_values):
+        """Return the violations among ``data_values``, shaped like the DHIS2 validation analysis results."""
+        matrix = self._matrix(data_values)
+        if matrix.empty:
+            return []
+        index = matrix.index.to_frame(index=False)
+        period_types = index['period'].map(
+            {pe: self._period_type(pe) for pe in index['period'].unique()}).to_numpy()
+
+        violations = []
+        for rule in self.rules:
+            rows = np.flatnonzero(period_types == rule['period_type']) if rule['period_type'] \
+                else np.arange(len(index))
+            if not len(rows):
+                continue
+            left = self._side_values(rule['left'], matrix, rows)
+            right = self._side_values(rule['right'], matrix, rows)
+            if rule['operator'] == 'compulsory_pair':
+                violated = np.isnan(left) != np.isnan(right)
+            elif rule['operator'] == 'exclusive_pair':
+                violated = ~np.isnan(left) & ~np.isnan(right)
+            else:
+                compared = ~np.isnan(left) & ~np.isnan(right)
+                with np.errstate(invalid='ignore'):
+                    holds = self.OPERATORS[rule['operator']](np.round(left, 10), np.round(right, 10))
+                violated = compared & ~holds
+            for position in np.flatnonzero(violated):
+                row = rows[position]
+                violations.append({
+                    'validationRuleId': rule['id'],
+                    'organisationUnitId': index.at[row, 'orgUnit'],
+                    'periodId': index.at[row, 'period'],
+                    'attributeOptionComboId': index.at[row, 'attributeOptionCombo'],
+                    'leftSideValue': float(left[position]),
+                    'rightSideValue': float(right[position]),
+                })
+        return violations
+
+    @staticmethod
+    def _period_type(period):
+        try:
+            return Dhis2PeriodUtils.get_period_type_from_string(period)
+        except ValueError:
+            return None
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from dataclasses import dataclass, field
+
+
+@dataclass
+class OrgUnitRequest:
+    """One analysis request: the org units sent to DHIS2 and the target org units it covers."""
+    org_units: list
+    scope: list
+
+    @property
+    def coarsened(self):
+        return self.org_units != self.scope
+
+
+@dataclass
+class PartitionResult:
+    data_values: list = field(default_factory=list)
+    analysed_org_units: list = field(default_factory=list)
+    errors: list = field(default_factory=list)
+    requests: int = 0
+    splits: int = 0
+
+
+class OrgUnitPartitioner:
+    """
+    Spread an analysis over the org unit hierarchy instead of sending one request per org unit.
+
+    Sibling org units are grouped under their parent. When the analysis accepts several org units
+    per request (outlier detection) up to ``max_org_units_per_request`` siblings are sent together.
+    When it accepts only one (validation rule analysis), the parent is queried in place of a group
+    of at most that many siblings, and results for the parent itself are dropped.
+
+    A response with ``max_results`` entries may have been truncated. Such a request is split in
+    two, and a single org unit is replaced by its children, until every response is complete.
+    Values stored on a split org unit itself (rather than on its descendants) are not covered by
+    its children; aggregate data is normally captured at the lowest level. An org unit without
+    children whose response is still truncated is reported as an error.
+    """
+    DEFAULT_MAX_ORG_UNITS_PER_REQUEST = 10
+
+    def __init__(self, api_utils, max_org_units_per_request=None, multiple_org_units=True,
+                 description='Analysis'):
+        self.api_utils = api_utils
+        self.max_org_units_per_request = max(1, int(max_org_units_per_request
+                                                    or self.DEFAULT_MAX_ORG_UNITS_PER_REQUEST))
+        self.multiple_org_units = multiple_org_units
+        self.description = description
+
+    @classmethod
+    def from_stage(cls, config, stage, api_utils, **kwargs):
+        """Build a partitioner from ``params.max_org_units_per_request`` or the server default."""
+        limit = stage['params'].get('max_org_units_per_request',
+                                    config['server'].get('max_org_units_per_request'))
+        return cls(api_utils, limit, **kwargs)
+
+    def _batches(self, org_units):
+        size = self.max_org_units_per_request if self.multiple_org_units else 1
+        return [OrgUnitRequest(org_units[i:i + size], org_units[i:i + size])
+                for i in range(0, len(org_units), size)]
+
+    async def plan(self, session, semaphore, level=None, org_units=None, parents=None):
+        """
+        Requests covering ``org_units``, or every org unit at ``level`` when no list is given
+        (only those under ``parents``, if given). Only complete groups of siblings can be
+        grouped by parent, since only then does a group hold all of its parent's children.
+        """
+        if org_units is not None:
+            return self._batches(list(org_units))
+
+        siblings = {}
+        for ou, parent in (await self.api_utils.get_organisation_unit_parents(level, session, semaphore)).items():
+            if parents is None or parent in parents:
+                siblings.setdefault(parent, []).append(ou)
+
+        requests = []
+        for parent, group in siblings.items():
+            if (not self.multiple_org_units and parent is not None
+                    and 1 < len(group) <= self.max_org_units_per_request):
+                requests.append(OrgUnitRequest([parent], group))
+            else:
+                requests.extend(self._batches(group))
+        return requests
+
+    async def run(self, requests, fetch, session, semaphore):
+        """
+        Run ``requests`` concurrently. ``fetch(org_units)`` returns ``(data_values, truncated)``
+        and raises on failure; truncated requests are split and fetched again.
+        """
+        result = PartitionResult()
+        await asyncio.gather(*[self._run_request(request, fetch, result, session, semaphore)
+                               for request in requests])
+        logging.info(f"{self.description}: {result.requests} requests, {result.splits} split after "
+                     f"reaching max results, {len(result.errors)} failed")
+        return result
+
+    async def _run_request(self, request, fetch, result, session, semaphore):
+        result.requests += 1
+        try:
+            data_values, truncated = await fetch(request.org_units)
+        except Exception as e:
+            msg = f"{self.description} failed for org units {', '.join(request.org_units)}: {e}"
+            logging.error(msg)
+            result.errors.append(msg)
+            return
+
+        if truncated:
+            try:
+                parts = await self._split(request, session, semaphore)
+            except Exception as e:
+                parts = None
+                msg = f"Could not split org units {', '.join(request.org_units)} after reaching max results: {e}"
+                logging.error(msg)
+                result.errors.append(msg)
+            if parts:
+                result.splits += 1
+                logging.debug(f"{self.description} reached max results for {request.org_units}, "
+                              f"splitting into {len(parts)} requests")
+                await asyncio.gather(*[self._run_request(part, fetch, result, session, semaphore)
+                                       for part in parts])
+                return
+            if parts is not None:
+                msg = (f"{self.description} results for org unit {request.org_units[0]} reached max results "
+                       f"and cannot be split further. Consider to increase max_results")
+                logging.error(msg)
+                result.errors.append(msg)
+            # Keep what was returned, but do not treat these org units as fully analysed
+            result.data_values.extend(data_values)
+            return
+
+        if request.coarsened:
+            excluded = set(request.org_units) - set(request.scope)
+            data_values = [dv for dv in data_values if dv['orgUnit'] not in excluded]
+        result.data_values.extend(data_values)
+        result.analysed_org_units.extend(request.scope)
+
+    async def _split(self, request, session, semaphore):
+        if request.coarsened:
+            return self._batches(request.scope)
+        if len(request.org_units) > 1:
+            middle = len(request.org_units) // 2
+            return [OrgUnitRequest(part, part) for part in (request.org_units[:middle], request.org_units[middle:])]
+        children = await self.api_utils.get_organisation_unit_children(request.org_units[0], session, semaphore)
+        return self._batches(children)
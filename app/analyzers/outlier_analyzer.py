@@ -1,12 +1,15 @@
 import asyncio
 import logging
 from datetime import datetime
+from app.core.numeric_value_types import NumericValueType
 from app.core.period_utils import Dhis2PeriodUtils
+from app.analyzers.local_outlier_engine import LocalOutlierEngine
+from app.analyzers.org_unit_partitioner import OrgUnitPartitioner
 from app.analyzers.stage_analyzer import StageAnalyzer
 
 class OutlierAnalyzer(StageAnalyzer):
-    def __init__(self, config, base_url, headers):
-        super().__init__(config, base_url, headers)
+    def __init__(self, config, base_url, headers, api_utils=None):
+        super().__init__(config, base_url, headers, api_utils)
 
     async def run_stage(self, stage, session, semaphore):
         try:
@@ -16,12 +19,6 @@ class OutlierAnalyzer(StageAnalyzer):
             end_date = datetime.now()
             params = stage['params']
 
-            organisation_unit = stage.get('organisation_unit')
-            if isinstance(organisation_unit, list):
-                ous = organisation_unit
-            else:
-                ous = await self.get_organisation_units_at_level(params['level'], session, semaphore)
-
             max_results = params.get('max_results', self.config['server'].get('max_results', 500))
 
             query_common = {
@@ -35,7 +32,9 @@ class OutlierAnalyzer(StageAnalyzer):
                 'threshold': params.get('threshold', 0),
                 'destination_data_element': params['destination_data_element'],
                 'destination_dataset': params.get('destination_dataset'),
-                'lower_bound': params.get('lower_bound', 0)
+                'lower_bound': params.get('lower_bound', 0),
+                # Stages which differ only in what is done with the outliers share the requests
+                'stage': stage,
             }
             #Optionally add date offsets if provided
             if 'start_date_offset' in params:
@@ -43,38 +42,89 @@ class OutlierAnalyzer(StageAnalyzer):
             if 'end_date_offset' in params:
                 query_common['end_date_offset'] = params['end_date_offset']
 
+            # Incremental runs only analyse the periods and org units which changed
+            plan = await self.incremental.plan(stage, start_date, end_date,
+                                               lambda: self._describe_source(params, session, semaphore),
+                                               session, semaphore)
+            scopes = self.analysis_scopes(stage, plan, start_date, end_date)
+            if [window for scope in scopes for window in scope.windows] != [(start_date, end_date)]:
+                # Keep computing the mean and deviation over the whole range, as a single request would
+                query_common['statistics_start_date'] = start_date.strftime('%Y-%m-%d')
+                query_common['statistics_end_date'] = end_date.strftime('%Y-%m-%d')
+
+            # Sibling org units share a request; requests that reach max_results are split
+            partitioner = OrgUnitPartitioner.from_stage(self.config, stage, self.api_utils,
+                                                        description='Outlier detection')
+            organisation_unit = stage.get('organisation_unit')
+            tasks = []
+            for scope in scopes:
+                org_units = scope.org_units
+                if org_units is None and isinstance(organisation_unit, list):
+                    org_units = organisation_unit
+                requests = await partitioner.plan(session, semaphore, level=params.get('level'), org_units=org_units,
+                                                  parents=stage.get('organisation_unit_parents'))
+                tasks.extend(
+                    self._run_window(stage, query_common, partitioner, requests, window_start, window_end,
+                                     session, semaphore)
+                    for window_start, window_end in scope.windows
+                )
+            return await self.collect_results(tasks, plan)
+
+        except Exception as e:
+            logging.error(f"Error running outlier stage '{stage['name']}': {e}")
+            return []
 
-            tasks = [
-                self._run_outlier_dataset_stage_async(session, {**query_common, 'ou': ou}, semaphore)
-                for ou in ous
-            ]
-
-            results_nested = await asyncio.gather(*tasks, return_exceptions=True)
-            results = []
-            errors = []
-
-            for i, result in enumerate(results_nested):
-                ou = ous[i]
-                if isinstance(result, Exception):
-                    msg = f"Outlier detection failed for OU '{ou}': {str(result)}"
-                    logging.error(msg)
-                    errors.append(msg)
-                elif isinstance(result, list):
-                    results.extend(result)
-                else:
-                    msg = f"Unexpected result type for OU '{ou}': {type(result)}"
-                    logging.warning(msg)
-                    errors.append(msg)
+    async def _describe_source(self, params, session, semaphore):
+        """dataValueSets parameters selecting the analysed data, and its period types."""
+        period_type = await self.api_utils.fetch_dataset_period_type(params['dataset'], session, semaphore)
+        return [[('dataSet', params['dataset'])]], [period_type]
+
+    async def _run_window(self, stage, query_common, partitioner, requests, window_start, window_end,
+                          session, semaphore):
+        params = stage['params']
+        query = {**query_common,
+                 'start_date': window_start.strftime('%Y-%m-%d'),
+                 'end_date': window_end.strftime('%Y-%m-%d')}
+        # The local engine computes the outliers from the raw data values instead of asking DHIS2
+        detect = (self._run_local_outlier_detection_async if params.get('engine') == 'local'
+                  else self._run_outlier_dataset_stage_async)
+        partitioned = await partitioner.run(
+            requests,
+            self.resumable(stage, window_start, window_end,
+                           lambda ous: detect(session, {**query, 'ou': ous}, semaphore)),
+            session, semaphore
+        )
+        results = partitioned.data_values
+        errors = partitioned.errors
+
+        # Counts stored by earlier runs for org units and periods that no longer have
+        # outliers are deleted; counts that did not change are not posted again
+        try:
+            existing_data_values = await self.fetch_existing_data_values(
+                params['destination_data_element'], partitioned.analysed_org_units, window_start, window_end,
+                session, semaphore
+            )
+        except Exception as e:
+            msg = f"Could not fetch existing outlier counts, posting all counts without cleanup: {e}"
+            logging.warning(msg)
+            errors.append(msg)
             return {
                 'dataValues': results,
                 'errors': errors
             }
-
-        except Exception as e:
-            logging.error(f"Error running outlier stage '{stage['name']}': {e}")
-            return []
+        reconciled = self.reconcile(stage, existing_data_values, results)
+        return {
+            'dataValues': reconciled.upserts,
+            'deletions': reconciled.deletions,
+            'unchanged': reconciled.unchanged,
+            'errors': errors
+        }
 
     async def _run_outlier_dataset_stage_async(self, session, params, semaphore):
+        """
+        Outlier counts for the org units in ``params['ou']``, and whether the response
+        reached ``max_results`` and so may have been truncated.
+        """
         url = f"{self.base_url}/api/outlierDetection"
         parameters = [
             ('ds', params['outlier_dataset']),
@@ -83,31 +133,87 @@ class OutlierAnalyzer(StageAnalyzer):
             ('algorithm', params['algorithm']),
             ('maxResults', str(params['max_results'])),
             ('orderBy', 'MEAN_ABS_DEV'),
-            ('threshold', str(params['threshold'])),
-            ('ou', params['ou'])
+            ('threshold', str(params['threshold']))
         ]
-
+        parameters.extend(('ou', ou) for ou in params['ou'])
+
+        data_start_date, data_end_date = self._statistics_dates(params)
+        if data_start_date:
+            parameters.append(('dataStartDate', data_start_date))
+        if data_end_date:
+            parameters.append(('dataEndDate', data_end_date))
+
+        outlier_json = await self.shared_request(
+            session, ('outlierDetection', tuple(parameters)),
+            lambda: self._fetch_outlier_detection_async(session, url, parameters, semaphore),
+            params.get('stage')
+        )
+
+        truncated = len(outlier_json.get('outlierValues', [])) >= int(params['max_results'])
+        return self._process_outlier_results(outlier_json, params['destination_data_element'],
+                                             params['lower_bound'], params.get('destination_dataset')), truncated
+
+    async def _fetch_outlier_detection_async(self, session, url, parameters, semaphore):
+        async with self.api_utils.request(session, 'GET', url, semaphore, params=parameters) as response:
+            if response.status >= 400:
+                text = await response.text()
+                raise RuntimeError(f"{response.status} from DHIS2: {response.url} — {text.strip()}")
+            return await response.json()
+
+    @staticmethod
+    def _statistics_dates(params):
+        """The dataStartDate and dataEndDate (or None) the mean and deviation are computed over."""
+        data_start_date = params.get('statistics_start_date')
         if params.get('start_date_offset'):
-            start_date = Dhis2PeriodUtils.get_start_date_from_today(params.get('start_date_offset'))
-            parameters.append(('dataStartDate', start_date.strftime('%Y-%m-%d')))
+            data_start_date = Dhis2PeriodUtils.get_start_date_from_today(
+                params['start_date_offset']).strftime('%Y-%m-%d')
+        data_end_date = params.get('statistics_end_date')
         if params.get('end_date_offset'):
-            end_date = Dhis2PeriodUtils.get_start_date_from_today(params.get('end_date_offset'))
-            parameters.append(('dataEndDate', end_date.strftime('%Y-%m-%d')))
-
-        try:
-            async with semaphore:
-                async with session.get(url, params=parameters) as response:
-                    if response.status >= 400:
-                        # Don't raise — just return detailed error
-                        text = await response.text()
-                        raise RuntimeError(f"{response.status} from DHIS2: {response.url} — {text.strip()}")
-                    outlier_json = await response.json()
-
-            return self._process_outlier_results(outlier_json, params['destination_data_element'],
-                                                 params['lower_bound'], params.get('destination_dataset'))
+            data_end_date = Dhis2PeriodUtils.get_start_date_from_today(
+                params['end_date_offset']).strftime('%Y-%m-%d')
+        return data_start_date, data_end_date
+
+    async def _run_local_outlier_detection_async(self, session, params, semaphore):
+        """
+        Outlier counts for the org units in ``params['ou']``, computed by ``LocalOutlierEngine``
+        from the raw data values of the data set. There is no ``max_results`` limit, so the
+        result is never truncated.
+        """
+        dataset = params['outlier_dataset']
+        value_types = await self.api_utils.fetch_dataset_value_types(dataset, session, semaphore)
+        numeric = {de for de, value_type in value_types.items() if value_type in NumericValueType.list()}
+        min_max_bounds = None
+        if params['algorithm'] == 'MIN_MAX':
+            min_max_bounds = await self.api_utils.fetch_min_max_bounds(numeric, session, semaphore)
+
+        check_range = (datetime.strptime(params['start_date'], '%Y-%m-%d'),
+                       datetime.strptime(params['end_date'], '%Y-%m-%d'))
+        data_start_date, data_end_date = self._statistics_dates(params)
+        statistics_range = (datetime.strptime(data_start_date, '%Y-%m-%d') if data_start_date else check_range[0],
+                            datetime.strptime(data_end_date, '%Y-%m-%d') if data_end_date else check_range[1])
+        if params['algorithm'] == 'MIN_MAX':
+            statistics_range = check_range
+
+        query = [('dataSet', dataset)] + [('orgUnit', ou) for ou in params['ou']] + [
+            ('startDate', min(check_range[0], statistics_range[0]).strftime('%Y-%m-%d')),
+            ('endDate', max(check_range[1], statistics_range[1]).strftime('%Y-%m-%d')),
+            ('children', 'true'),
+        ]
 
-        except Exception as e:
-            return e
+        async def detect():
+            # Values of non-numeric data elements are dropped as they arrive
+            data_value_set = await self.api_utils.fetch_datavalue_sets(
+                query, session, lambda dv: dv.get('dataElement') in numeric, semaphore
+            )
+            engine = LocalOutlierEngine(params['algorithm'], params['threshold'], check_range, statistics_range,
+                                        numeric_data_elements=numeric, min_max_bounds=min_max_bounds)
+            return engine.detect(data_value_set['dataValues'])
+
+        key = ('localOutlierDetection', tuple(query), params['algorithm'], str(params['threshold']),
+               check_range, statistics_range)
+        outliers = await self.shared_request(session, key, detect, params.get('stage'))
+        return self._process_outlier_results({'outlierValues': outliers}, params['destination_data_element'],
+                                             params['lower_bound'], params.get('destination_dataset')), False
 
     def _process_outlier_results(self, results, destination_data_element, lower_bound, destination_dataset=None):
         outliers_by_ou_and_period = {}
@@ -0,0 +1,62 @@
+from dataclasses import dataclass, field
+
+
+@dataclass
+class ReconciliationResult:
+    upserts: list = field(default_factory=list)
+    deletions: list = field(default_factory=list)
+    unchanged: int = 0
+    # Number of calculated values, duplicates included
+    calculated: int = 0
+
+
+class DataValueReconciler:
+    """
+    Compares the data values a stage calculated with the values already stored in DHIS2.
+
+    Both sides are indexed once by (dataElement, orgUnit, period, categoryOptionCombo), so
+    reconciling is linear in the number of values. Calculated values that are new or whose
+    value changed are upserts, stored values that were not calculated again are deletions,
+    and values that did not change are only counted.
+    """
+
+    def __init__(self, default_coc):
+        self.default_coc = default_coc
+
+    def key(self, dv):
+        return dv['dataElement'], dv['orgUnit'], dv['period'], dv.get('categoryOptionCombo') or self.default_coc
+
+    def index(self, data_values):
+        """Map each key to its first data value; later duplicates are ignored."""
+        indexed = {}
+        for dv in data_values:
+            indexed.setdefault(self.key(dv), dv)
+        return indexed
+
+    @staticmethod
+    def same_value(a, b):
+        a, b = a.get('value'), b.get('value')
+        if a == b:
+            return True
+        try:
+            return float(a) == float(b)
+        except (TypeError, ValueError):
+            return str(a) == str(b)
+
+    def reconcile(self, existing_data_values, calculated_data_values):
+        existing = self.index(existing_data_values)
+        result = ReconciliationResult()
+        seen = set()
+        for dv in calculated_data_values:
+            result.calculated += 1
+            key = self.key(dv)
+            if key in seen:
+                continue
+            seen.add(key)
+            stored = existing.get(key)
+            if stored is not None and self.same_value(stored, dv):
+                result.unchanged += 1
+            else:
+                result.upserts.append(dv)
+        result.deletions = [dv for key, dv in existing.items() if key not in seen]
+        return result
@@ -1,14 +1,17 @@
 import asyncio
 import logging
+import re
 from datetime import datetime
+from app.analyzers.incremental import IncrementalPlanner
+from app.analyzers.local_validation_engine import LocalValidationRuleEngine
+from app.analyzers.org_unit_partitioner import OrgUnitPartitioner
 from app.analyzers.stage_analyzer import StageAnalyzer
 
 class ValidationRuleAnalyzer(StageAnalyzer):
-    def __init__(self, config, base_url, headers):
-        super().__init__(config, base_url, headers)
+    def __init__(self, config, base_url, headers, api_utils=None):
+        super().__init__(config, base_url, headers, api_utils)
         
     async def data_values_urls_for_orgunits(self,stage,session, semaphore):
-        urls = []
         start_date = self.get_start_date(stage)
         params = stage['params']
         data_element = params['destination_data_element']
@@ -19,105 +22,90 @@ class ValidationRuleAnalyzer(StageAnalyzer):
         else:
             ous = await self.get_organisation_units_at_level(params['level'], session, semaphore)
 
-        params = {
-            'dataElement': data_element,
-            'startDate': start_date.strftime('%Y-%m-%d'),
-            'endDate': datetime.now().strftime('%Y-%m-%d'),
-            'children': 'true'}
-        
-        for ou in ous:
-            params['orgUnit'] = ou
-            query_string = '&'.join(f"{key}={value}" for key, value in params.items())
-            url = f"{self.base_url}/api/dataValueSets.json?{query_string}"
-            urls.append(url)
-        return urls
-
-    async def fetch_existing_datvalues(self,stage, session, semaphore):
-        urls = await self.data_values_urls_for_orgunits(stage, session, semaphore)
-        tasks = [
-              self.fetch_datavalues_async(
-                session, url, semaphore
-            )
-            for url in urls
-        ]
+        return [self.existing_data_values_url(data_element, ou, start_date, datetime.now()) for ou in ous]
 
-        results = await asyncio.gather(*tasks)
-
-        data_values = []
-        for result in results:
-            if isinstance(result, Exception):
-                logging.error(f"Error fetching data values: {result}")
-            elif isinstance(result, dict):
-                data_values.extend(result.get('dataValues', []))
+    async def fetch_existing_datvalues(self,stage, session, semaphore, org_units=None):
+        params = stage['params']
+        if org_units is None:
+            organisation_unit = stage.get('organisation_unit')
+            if isinstance(organisation_unit, list):
+                org_units = organisation_unit
             else:
-                logging.warning(f"Unexpected result type: {type(result)} from fetch_existing_datvalues")
-        return data_values
-    
+                org_units = await self.get_organisation_units_at_level(params['level'], session, semaphore)
+        return await self.fetch_existing_data_values(params['destination_data_element'], org_units,
+                                                     self.get_start_date(stage), datetime.now(), session, semaphore)
 
     def classify_data(self, existing_data_values, calculated_data_values):
-        existing_set = {
-            (dv['dataElement'], dv['orgUnit'], dv['period'], dv.get('categoryOptionCombo', self.default_coc))
-            for dv in existing_data_values
-        }
-
-        calculated_set = {
-            (dv['dataElement'], dv['orgUnit'], dv['period'], dv.get('categoryOptionCombo', self.default_coc))
-            for dv in calculated_data_values
-        }
-
-        to_delete = existing_set - calculated_set
-        upserts = calculated_set - existing_set
-
-        upsert_values = []
-        delete_values = []
-        #Filter the calculated set with the final upserts
-        for upsert in upserts:
-            for dv in calculated_data_values:
-                if (dv['dataElement'], dv['orgUnit'], dv['period'], dv.get('categoryOptionCombo', self.default_coc)) == upsert:
-                    upsert_values.append(dv)
-                    break
-        #Filter the existing set with the final deletions
-        for deletion in to_delete:
-            for dv in existing_data_values:
-                if (dv['dataElement'], dv['orgUnit'], dv['period'], dv.get('categoryOptionCombo', self.default_coc)) == deletion:
-                    delete_values.append(dv)
-                    break
+        result = self.reconciler.reconcile(existing_data_values, calculated_data_values)
         #Return the original length of data
-        calculated_data_length = len(calculated_data_values)
-        return upsert_values, delete_values, calculated_data_length
+        return result.upserts, result.deletions, result.calculated
 
 
     async def _fetch_validation_rule_analysis_async(self, session, vrg, ou, start_date, data_element, max_results,
-                                                    semaphore):
+                                                    semaphore, end_date=None, stage=None):
+        """
+        Violation counts for ``ou`` and its descendants, and whether the response reached
+        ``max_results`` and so may have been truncated.
+        """
         url = f'{self.base_url}/api/dataAnalysis/validationRules'
         body = {
             'notification': False,
             'persist': False,
             'ou': ou,
             'startDate': start_date.strftime('%Y-%m-%d'),
-            'endDate': datetime.now().strftime('%Y-%m-%d'),
+            'endDate': (end_date or datetime.now()).strftime('%Y-%m-%d'),
             'vrg': vrg,
             'maxResults': max_results
         }
 
-        try:
-            async with semaphore:
-                logging.debug("Running validation rule analysis for ou '%s' and vrg '%s'", ou, vrg)
-                logging.debug("Making POST request to URL: %s", url)
-                logging.debug("Request body: %s", body)
-                async with session.post(url, json=body) as response:
-                    if response.status >= 400:
-                        text = await response.text()
-                        raise RuntimeError(f"{response.status} from DHIS2: {response.url} — {text.strip()}")
-                    response_data = await response.json()
-        except Exception as e:
-            logging.error(f"Error fetching validation rule analysis: {e}")
-            return e
+        logging.debug("Running validation rule analysis for ou '%s' and vrg '%s'", ou, vrg)
+        logging.debug("Making POST request to URL: %s", url)
+        logging.debug("Request body: %s", body)
+
+        async def analyse():
+            # Validation analysis with persist=False only reads, so it can be retried
+            async with self.api_utils.request(session, 'POST', url, semaphore, idempotent=True,
+                                              json=body) as response:
+                if response.status >= 400:
+                    text = await response.text()
+                    raise RuntimeError(f"{response.status} from DHIS2: {response.url} — {text.strip()}")
+                return await response.json()
+
+        # Stages on the same rule group share the analysis
+        response_data = await self.shared_request(
+            session, ('validationRules', tuple(sorted(body.items()))), analyse, stage
+        )
 
         if not isinstance(response_data, list):
             logging.warning(f"Expected list from DHIS2 validation API but got {type(response_data)}: {response_data}")
-            return []
+            return [], False
+
+        return self._count_violations(response_data, data_element), len(response_data) >= max_results
+
+    async def _evaluate_validation_rules_locally_async(self, session, engine, org_units, start_date, end_date,
+                                                       data_element, semaphore, stage=None, vrg=None):
+        """
+        Violation counts for ``org_units`` and their descendants, evaluated by ``engine`` from
+        the raw data values. There is no ``max_results`` limit, so the result is never truncated.
+        """
+        common = [('orgUnit', ou) for ou in org_units] + [
+            ('startDate', start_date.strftime('%Y-%m-%d')),
+            ('endDate', end_date.strftime('%Y-%m-%d')),
+            ('children', 'true'),
+        ]
+
+        async def evaluate():
+            data_value_sets = await asyncio.gather(*[
+                self.api_utils.fetch_datavalue_sets(params + common, session, semaphore=semaphore)
+                for params in IncrementalPlanner.chunked('dataElement', engine.data_elements)
+            ])
+            return engine.evaluate(dv for data_value_set in data_value_sets for dv in data_value_set['dataValues'])
 
+        violations = await self.shared_request(session, ('localValidationRules', vrg, tuple(common)), evaluate,
+                                               stage)
+        return self._count_violations(violations, data_element), False
+
+    def _count_violations(self, response_data, data_element):
         violations = {}
         for result in response_data:
             if 'organisationUnitId' not in result or 'periodId' not in result:
@@ -127,11 +115,6 @@ class ValidationRuleAnalyzer(StageAnalyzer):
             key = (result['organisationUnitId'], result['periodId'])
             violations[key] = violations.get(key, 0) + 1
 
-        #Warn if the number of violations is exactly equal to the max_results
-        if max_results == len(response_data):
-            msg = "Validation rule violations may be truncated. Consider to increase max_results"
-            logging.error(msg)
-
         return [{
             'dataElement': data_element,
             'orgUnit': ou_id,
@@ -139,58 +122,134 @@ class ValidationRuleAnalyzer(StageAnalyzer):
             'categoryOptionCombo': self.default_coc,
             'value': str(count)
         } for (ou_id, period_id), count in violations.items()]
-    
+
 
     async def run_stage(self, stage, session, semaphore):
         logging.info(f"Running validation rule stage '{stage['name']}'")
 
         start_date = self.get_start_date(stage)
+        end_date = datetime.now()
+        params = stage['params']
+
+        # Incremental runs only analyse the periods and org units which changed. Otherwise long
+        # durations can be analysed as concurrent, period-aligned windows
+        plan = await self.incremental.plan(stage, start_date, end_date,
+                                           lambda: self._describe_source(params, session, semaphore),
+                                           session, semaphore)
+
+        engine = None
+        if params.get('engine') == 'local':
+            engine = await self._local_engine(stage, session, semaphore)
+
+        # The API takes one org unit per request, so small groups of siblings are analysed
+        # through their parent; requests that reach max_results are split. The local engine
+        # reads dataValueSets, which take any number of org units
+        partitioner = OrgUnitPartitioner.from_stage(self.config, stage, self.api_utils,
+                                                    multiple_org_units=engine is not None,
+                                                    description='Validation rule analysis')
+        organisation_unit = stage.get('organisation_unit')
+        tasks = []
+        for scope in self.analysis_scopes(stage, plan, start_date, end_date):
+            org_units = scope.org_units
+            if org_units is None and isinstance(organisation_unit, list):
+                org_units = organisation_unit
+            requests = await partitioner.plan(session, semaphore, level=params.get('level'), org_units=org_units,
+                                              parents=stage.get('organisation_unit_parents'))
+            tasks.extend(
+                self._run_window(stage, partitioner, requests, window_start, window_end, session, semaphore,
+                                 engine)
+                for window_start, window_end in scope.windows
+            )
+        return await self.collect_results(tasks, plan)
+
+    async def _describe_source(self, params, session, semaphore):
+        """
+        dataValueSets parameters selecting the data elements the rules of the group use, and
+        the rules' period types. Rules referring to anything but data elements, constants and
+        org unit groups cannot be tracked this way, and raise.
+        """
+        rules = await self.api_utils.fetch_metadata_list_async(
+            'validationRules', session, 'validationRules',
+            filters=[f"validationRuleGroups.id:eq:{params['validation_rule_group']}"],
+            fields=['id', 'periodType', 'leftSide[expression]', 'rightSide[expression]'], semaphore=semaphore
+        )
+        data_elements = set()
+        for rule in rules:
+            for side in ('leftSide', 'rightSide'):
+                expression = (rule.get(side) or {}).get('expression', '')
+                data_elements.update(re.findall(r'#\{(\w{11})', expression))
+                if '{' in re.sub(r'(#|C|OUG)\{[^}]*\}', '', expression):
+                    raise ValueError(f"Validation rule '{rule['id']}' uses items other than data elements")
+        if not data_elements:
+            raise ValueError("The validation rules do not refer to any data elements")
+        return (IncrementalPlanner.chunked('dataElement', sorted(data_elements)),
+                sorted({rule['periodType'] for rule in rules}))
+
+    async def _local_engine(self, stage, session, semaphore):
+        """
+        The rules of the stage's group compiled for local evaluation, or None (with a warning)
+        when they use anything the local engine does not support.
+        """
+        side_fields = 'expression,missingValueStrategy'
+        rules = await self.api_utils.fetch_metadata_list_async(
+            'validationRules', session, 'validationRules',
+            filters=[f"validationRuleGroups.id:eq:{stage['params']['validation_rule_group']}"],
+            fields=['id', 'operator', 'periodType', f'leftSide[{side_fields}]', f'rightSide[{side_fields}]'],
+            semaphore=semaphore
+        )
+        expressions = [(rule.get(side) or {}).get('expression', '') for rule in rules for side in ('leftSide', 'rightSide')]
+        constant_ids = sorted({uid for expression in expressions for uid in re.findall(r'C\{(\w{11})\}', expression)})
+        constants = {}
+        if constant_ids:
+            constants = {c['id']: c.get('value') for c in await self.api_utils.fetch_metadata_list_async(
+                'constants', session, 'constants', filters=[f"id:in:[{','.join(constant_ids)}]"],
+                fields=['id', 'value'], semaphore=semaphore
+            )}
+        try:
+            return LocalValidationRuleEngine(rules, constants)
+        except ValueError as e:
+            logging.warning(f"Stage '{stage['name']}' cannot be evaluated locally, "
+                            f"using the DHIS2 validation rule analysis: {e}")
+            return None
+
+    async def _run_window(self, stage, partitioner, requests, window_start, window_end, session, semaphore,
+                          engine=None):
         params = stage['params']
         vrg = params['validation_rule_group']
         max_results = params.get('max_results', self.config['server'].get('max_results', 500))
         data_element = params['destination_data_element']
 
-        organisation_unit = stage.get('organisation_unit')
-        ous = []
-        if isinstance(organisation_unit, list):
-            ous = organisation_unit
+        # Stages which differ only in where the counts go share the analysis requests
+        if engine is not None:
+            def fetch(ous):
+                return self._evaluate_validation_rules_locally_async(session, engine, ous, window_start, window_end,
+                                                                     data_element, semaphore, stage, vrg)
         else:
-            ous = await self.get_organisation_units_at_level(params['level'], session, semaphore)
-
-        tasks = [
-            self._fetch_validation_rule_analysis_async(
-                session, vrg, ou, start_date, data_element, max_results, semaphore
-            )
-            for ou in ous
-        ]
-
-        results_nested = await asyncio.gather(*tasks)
-        results = []
-        errors = []
-
-        for result in results_nested:
-            if isinstance(result, Exception):
-                logging.error(f"Validation rule analysis failed: {result}")
-                errors.append(str(result))
-            elif isinstance(result, list):
-                results.extend(result)
-            else:
-                msg = f"Unexpected result in validation rule analysis: {type(result)}"
-                logging.warning(msg)
-                errors.append(msg)
+            def fetch(ous):
+                return self._fetch_validation_rule_analysis_async(session, vrg, ous[0], window_start, data_element,
+                                                                  max_results, semaphore, end_date=window_end,
+                                                                  stage=stage)
+        partitioned = await partitioner.run(requests, self.resumable(stage, window_start, window_end, fetch),
+                                            session, semaphore)
+        results = partitioned.data_values
+        errors = partitioned.errors
 
         destination_dataset = params.get('destination_dataset')
         if destination_dataset:
             for dv in results:
                 dv['_dataset'] = destination_dataset
 
-        existing_data_values = await self.fetch_existing_datvalues(stage, session, semaphore)
-        upserts, deletions, calculated_data_length = self.classify_data(existing_data_values, results)
+        # Only compare against org units that were analysed, so a failed request
+        # does not turn that org unit's stored counts into deletions
+        existing_data_values = await self.fetch_existing_data_values(
+            data_element, partitioned.analysed_org_units, window_start, window_end, session, semaphore
+        )
+        reconciled = self.reconcile(stage, existing_data_values, results)
 
         return {
-            'dataValues': upserts,
-            'deletions': deletions,
-            'calculated_data_length' : calculated_data_length,
+            'dataValues': reconciled.upserts,
+            'deletions': reconciled.deletions,
+            'calculated_data_length' : reconciled.calculated,
+            'unchanged': reconciled.unchanged,
             'errors': errors
         }
-
@@ -1,23 +1,43 @@
+import asyncio
+import json
+import logging
 from abc import ABC, abstractmethod
+from urllib.parse import urlencode
 
 from aiohttp import ClientResponseError
 
+from app.analyzers.incremental import AnalysisScope, IncrementalPlanner
+from app.analyzers.reconciliation import DataValueReconciler
 from app.core.period_type import PeriodType
 
 from app.core.period_utils import Dhis2PeriodUtils
 from app.core.api_utils import Dhis2ApiUtils
+from app.core.json_stream import iter_json_array
 import re
 from app.core.time_unit import TimeUnit
 from typing import Optional
 
 class StageAnalyzer(ABC):
-    def __init__(self, config, base_url, headers):
+    # Parameters which only change what is done with the analysis results, not the analysis
+    POST_PROCESSING_PARAMS = ('destination_data_element', 'destination_dataset', 'lower_bound')
+
+    def __init__(self, config, base_url, headers, api_utils=None):
         self.config = config
         self.base_url = config['server'].get('base_url', base_url)
         self.d2_token = config['server'].get('d2_token', '')
         self.headers = headers
         self.default_coc = config['server'].get('default_coc', 'HllvX50cXC0')
-        self.api_utils = Dhis2ApiUtils(self.base_url, self.d2_token)
+        self.api_utils = api_utils or Dhis2ApiUtils(self.base_url, self.d2_token)
+        self.reconciler = DataValueReconciler(self.default_coc)
+        self.incremental = IncrementalPlanner(self.api_utils)
+        # Names of the unfinished stages of the run with each analysis signature, set by the monitor
+        self.shared_analyses = {}
+        # The stages which may still ask for each shared result (see shared_request)
+        self._shared_pending = {}
+        # Receives the values of each window as soon as it is reconciled, set by the monitor
+        self.result_sink = None
+        # Progress of the run (a RunProgress) when it can be resumed, set by the monitor
+        self.run_progress = None
 
     @abstractmethod
     async def run_stage(self, stage: dict, session, semaphore):
@@ -26,11 +46,136 @@ class StageAnalyzer(ABC):
         """
         pass
     
+    @classmethod
+    def analysis_signature(cls, stage):
+        """Stages with the same signature make the same analysis requests and can share them."""
+        params = {k: v for k, v in stage.get('params', {}).items() if k not in cls.POST_PROCESSING_PARAMS}
+        return json.dumps([stage.get('type'), params, stage.get('organisation_unit'),
+                           stage.get('organisation_unit_parents')], sort_keys=True, default=str)
+
+    async def shared_request(self, session, key, factory, stage=None):
+        """
+        Run the analysis request ``factory()`` once for the unfinished stages of the run with the
+        same analysis signature as ``stage``, and hand each of them the same raw result to
+        post-process. Such stages may still make different requests (their incremental plans
+        differ, or a resumed run takes some from its progress), so the result is dropped once
+        every one of them has either used it or finished (see ``release_shared``).
+        """
+        sharers = self.shared_analyses.get(self.analysis_signature(stage), ()) if stage is not None else ()
+        if len(sharers) < 2:
+            return await factory()
+        memo = self.api_utils.client.memo(session)
+        memo_key = ('shared_analysis', key)
+        pending = self._shared_pending.setdefault(memo_key, set(sharers))
+        try:
+            return await memo.do(memo_key, factory)
+        finally:
+            self._release(memo, memo_key, pending, stage['name'])
+
+    def release_shared(self, stage, session):
+        """Drop ``stage`` from the shared results it has not used, once it has finished."""
+        sharers = self.shared_analyses.get(self.analysis_signature(stage))
+        if sharers is not None:
+            sharers.discard(stage['name'])
+        memo = self.api_utils.client.memo(session)
+        for memo_key, pending in list(self._shared_pending.items()):
+            self._release(memo, memo_key, pending, stage['name'])
+
+    def _release(self, memo, memo_key, pending, name):
+        pending.discard(name)
+        if not pending and self._shared_pending.get(memo_key) is pending:
+            del self._shared_pending[memo_key]
+            memo.forget(memo_key)
+
     @staticmethod
     def get_start_date(stage):
         """Convenience wrapper for getting start date from duration"""
         return Dhis2PeriodUtils.get_start_date_from_today(stage['params']['duration'])
 
+    @staticmethod
+    def get_time_windows(stage, start_date, end_date):
+        """
+        The windows a stage analyses: the whole range, or period-aligned windows of
+        ``params.shard_duration`` which are analysed concurrently.
+        """
+        shard_duration = stage['params'].get('shard_duration')
+        if not shard_duration:
+            return [(start_date, end_date)]
+        return Dhis2PeriodUtils.split_date_range(start_date, end_date, shard_duration)
+
+    def analysis_scopes(self, stage, plan, start_date, end_date):
+        """What to analyse: the scopes of an incremental ``plan``, or the whole range for every org unit."""
+        if plan is None or plan.full:
+            return [AnalysisScope(self.get_time_windows(stage, start_date, end_date))]
+        return plan.scopes
+
+    def merge_results(self, results, plan=None):
+        """
+        Combine the results of the windows of a stage. A value reconciled in overlapping
+        windows is posted once. Incremental runs add the checkpoint to save once posted.
+        """
+        merged = {'dataValues': [], 'deletions': [], 'errors': []}
+        seen = {'dataValues': set(), 'deletions': set()}
+        for result in results:
+            for key, value in result.items():
+                if key in seen:
+                    for dv in value:
+                        dv_key = self.reconciler.key(dv)
+                        if dv_key not in seen[key]:
+                            seen[key].add(dv_key)
+                            merged[key].append(dv)
+                elif isinstance(value, list):
+                    merged.setdefault(key, []).extend(value)
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        if plan is not None:
+            merged['checkpoint'] = plan.checkpoint()
+        return merged
+
+    def resumable(self, stage, window_start, window_end, fetch):
+        """
+        Wrap the partitioner's ``fetch(org_units)`` so that the output of every request is saved
+        as a completed unit of the run, and taken from there instead when the run is resumed.
+        """
+        if self.run_progress is None:
+            return fetch
+
+        async def fetch_or_resume(org_units):
+            unit_key = json.dumps([stage['name'], window_start.strftime('%Y-%m-%d'),
+                                   window_end.strftime('%Y-%m-%d'), list(org_units)])
+            # The store commits every unit, so it is kept off the event loop
+            saved = await asyncio.to_thread(self.run_progress.get_unit, unit_key)
+            if saved is not None:
+                data_values, truncated = saved
+                return data_values, truncated
+            data_values, truncated = await fetch(org_units)
+            await asyncio.to_thread(self.run_progress.save_unit, unit_key, [data_values, truncated])
+            return data_values, truncated
+
+        return fetch_or_resume
+
+    async def collect_results(self, tasks, plan=None):
+        """
+        Await the windows of a stage and merge their results. With a ``result_sink``, the values
+        of each window are handed to it as soon as the window finishes, so they can be posted
+        while the rest of the run is analysing; the merged result then only holds the counts,
+        errors and checkpoint. Values reconciled in overlapping windows are still passed on once.
+        """
+        if self.result_sink is None:
+            return self.merge_results(await asyncio.gather(*tasks), plan)
+
+        seen = {'dataValues': set(), 'deletions': set()}
+        results = []
+        for task in asyncio.as_completed(tasks):
+            result = await task
+            streamed = {}
+            for key in seen:
+                streamed[key] = [dv for dv in result.pop(key, []) if self.reconciler.key(dv) not in seen[key]]
+                seen[key].update(self.reconciler.key(dv) for dv in streamed[key])
+            self.result_sink(streamed)
+            results.append(result)
+        return self.merge_results(results, plan)
+
     async def get_organisation_units_at_level(self, level, session, semaphore):
         return await self.api_utils.get_organisation_units_at_level(level, session, semaphore)
 
@@ -48,11 +193,53 @@ class StageAnalyzer(ABC):
 
         return None
 
-    async def fetch_datavalues_async(self, session, url, semaphore):
-        async with semaphore:
-            async with session.get(url, headers=self.headers) as response:
-                if response.status != 200:
-                    raise ClientResponseError(response.request_info, response.history,
-                                              status=response.status,
-                                              message=f"Failed to fetch data values from {url}")
-                return await response.json()
+    async def fetch_datavalues_async(self, session, url, semaphore, predicate=None):
+        """
+        Fetch a dataValueSet, decoding the data values as they stream in. Only values
+        accepted by ``predicate`` (all of them if it is None) are kept.
+        """
+        async with self.api_utils.request(session, 'GET', url, semaphore, headers=self.headers) as response:
+            if response.status != 200:
+                raise ClientResponseError(response.request_info, response.history,
+                                          status=response.status,
+                                          message=f"Failed to fetch data values from {url}")
+            result = {}
+            data_values = [
+                dv async for dv in iter_json_array(response.content, 'dataValues', envelope=result)
+                if predicate is None or predicate(dv)
+            ]
+            result['dataValues'] = data_values
+            return result
+
+    def existing_data_values_url(self, data_element, org_unit, start_date, end_date):
+        query_string = urlencode({
+            'dataElement': data_element,
+            'startDate': start_date.strftime('%Y-%m-%d'),
+            'endDate': end_date.strftime('%Y-%m-%d'),
+            'children': 'true',
+            'orgUnit': org_unit,
+        })
+        return f"{self.base_url}/api/dataValueSets.json?{query_string}"
+
+    async def fetch_existing_data_values(self, data_element, org_units, start_date, end_date, session, semaphore):
+        """
+        Fetch the values of ``data_element`` stored for ``org_units`` and their descendants.
+        Any failure is raised, so that a stage never reconciles against a partial picture.
+        """
+        results = await asyncio.gather(*[
+            self.fetch_datavalues_async(
+                session, self.existing_data_values_url(data_element, ou, start_date, end_date), semaphore
+            )
+            for ou in org_units
+        ])
+        data_values = []
+        for result in results:
+            data_values.extend(result.get('dataValues', []))
+        return data_values
+
+    def reconcile(self, stage, existing_data_values, calculated_data_values):
+        """Split calculated values into upserts and deletions; values that did not change are skipped."""
+        result = self.reconciler.reconcile(existing_data_values, calculated_data_values)
+        logging.info(f"Stage '{stage['name']}': {len(result.upserts)} values to upsert, "
+                     f"{len(result.deletions)} to delete, {result.unchanged} unchanged")
+        return result
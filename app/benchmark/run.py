@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import socket
+import time
+
+import requests
+from aiohttp import web
+
+from app.benchmark.stub_server import add_instance_arguments, app_from_args, instance_from_args
+from app.cli import DataQualityMonitor
+from app.core.api_utils import Dhis2ApiUtils
+from app.core.concurrency import create_limiter
+from app.core.dhis2_client import Dhis2Client
+from app.core.http_metrics import HttpMetrics
+from app.minmax.min_max_factory import MinMaxFactory
+
+BENCHMARK_TOKEN = 'd2p_benchmark'
+STAGE_TYPES = ('outlier', 'validation_rules', 'integrity_checks', 'min_max')
+
+
+def build_config(instance, base_url, level=3, stages=STAGE_TYPES, max_concurrent_requests=10, max_results=50000,
+                 adaptive=False, min_max_datasets=1, min_max_org_units=5, logging_level='WARNING'):
+    """
+    Workbench configuration that exercises every stage type against a ``SyntheticInstance``:
+    one outlier stage per data set and one validation rule stage per rule group, run per
+    org unit at ``level``, an integrity stage, and a min/max stage over the first
+    ``min_max_datasets`` data sets for the first ``min_max_org_units`` org units at ``level``.
+    """
+    server = {
+        'base_url': base_url,
+        'd2_token': BENCHMARK_TOKEN,
+        'logging_level': logging_level,
+        'max_concurrent_requests': max_concurrent_requests,
+        'max_results': max_results,
+        'root_org_unit': instance.root,
+    }
+    if adaptive:
+        server['adaptive_concurrency'] = {'enabled': True, 'max_concurrent_requests': max_concurrent_requests * 4}
+
+    analyzer_stages = []
+    if 'outlier' in stages:
+        analyzer_stages.extend({
+            'name': f'Outliers {ds["name"]}',
+            'type': 'outlier',
+            'params': {
+                'dataset': ds['id'], 'level': level, 'duration': '12 months', 'algorithm': 'MOD_Z_SCORE',
+                'threshold': 3, 'destination_data_element': instance.outlier_data_elements[ds['id']]['id'],
+                'destination_dataset': instance.results_data_set['id'],
+            },
+        } for ds in instance.data_sets)
+    if 'validation_rules' in stages:
+        analyzer_stages.extend({
+            'name': f'Violations {vrg["name"]}',
+            'type': 'validation_rules',
+            'params': {
+                'validation_rule_group': vrg['id'], 'level': level, 'duration': '12 months',
+                'destination_data_element': instance.validation_data_elements[vrg['id']]['id'],
+                'destination_dataset': instance.results_data_set['id'],
+            },
+        } for vrg in instance.validation_rule_groups)
+    if 'integrity_checks' in stages:
+        analyzer_stages.append({
+            'name': 'Metadata integrity',
+            'type': 'integrity_checks',
+            'params': {'dataset': instance.integrity_data_set['id'], 'monitoring_group': instance.integrity_group['id']},
+        })
+
+    min_max_stages = []
+    if 'min_max' in stages:
+        min_max_stages.append({
+            'name': 'Min/max',
+            'datasets': [ds['id'] for ds in instance.data_sets[:min_max_datasets]],
+            'org_units': instance.levels[min(level, max(instance.levels))][:min_max_org_units],
+            'previous_periods': 12,
+            'completeness_threshold': 0.5,
+            'groups': [
+                {'limitMedian': 50, 'method': 'PREV_MAX', 'threshold': 1.5},
+                {'limitMedian': 500, 'method': 'MAD', 'threshold': 3},
+                {'limitMedian': 1e12, 'method': 'ZSCORE', 'threshold': 3},
+            ],
+        })
+
+    return {'server': server, 'analyzer_stages': analyzer_stages, 'min_max_stages': min_max_stages}
+
+
+async def run_min_max(config):
+    """Run every min/max stage in ``config`` and return timing, results and request metrics."""
+    client = Dhis2Client.from_config(config)
+    http_metrics = HttpMetrics()
+    client.add_listener(http_metrics)
+    factory = MinMaxFactory(config, Dhis2ApiUtils(client.base_url, client.d2_token, client=client))
+    started = time.monotonic()
+    async with client.session() as session:
+        semaphore = create_limiter(config, client, default_max_concurrent_requests=5)
+        for stage in config['min_max_stages']:
+            await factory.run_stage(stage, session, semaphore)
+    return {
+        'duration_seconds': round(time.monotonic() - started, 3),
+        'summary': factory.result_tracker.get_summary(),
+        'http_metrics': http_metrics.summary(),
+    }
+
+
+def run_benchmark(config):
+    results = {}
+    if config['analyzer_stages']:
+        started = time.monotonic()
+        result = asyncio.run(DataQualityMonitor(config).run_all_stages())
+        results['monitor'] = {
+            'duration_seconds': round(time.monotonic() - started, 3),
+            'data_values_posted': result['data_values_posted'],
+            'data_values_deleted': result['data_values_deleted'],
+            'errors': len(result['errors']),
+            'resilience': result['resilience'],
+            'http_metrics': result['http_metrics'],
+        }
+    if config['min_max_stages']:
+        results['min_max'] = asyncio.run(run_min_max(config))
+    return results
+
+
+# --- Stub server process ---
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _serve(args, port):
+    logging.basicConfig(level=logging.WARNING)
+    web.run_app(app_from_args(args), host='127.0.0.1', port=port, access_log=None, print=None)
+
+
+def start_stub_server(args, timeout=120):
+    """
+    Serve the synthetic instance from a separate process, so that the stub's own CPU
+    time does not compete with the workbench for the event loop being measured.
+    """
+    port = _free_port()
+    process = multiprocessing.Process(target=_serve, args=(args, port), daemon=True)
+    process.start()
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f'{base_url}/stub/stats', timeout=1)
+            return process, base_url
+        except requests.exceptions.ConnectionError:
+            if not process.is_alive():
+                break
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('The stub server did not start')
+
+
+def _print_report(results, stub_stats):
+    for name, result in results.items():
+        print(f"\n{name}: {result['duration_seconds']:.1f}s")
+        for key in ('data_values_posted', 'data_values_deleted', 'errors', 'summary'):
+            if key in result:
+                print(f"  {key}: {result[key]}")
+        for family, stats in result['http_metrics'].items():
+            latency = stats['latency_seconds']
+            mean = latency['sum'] / latency['count'] if latency['count'] else 0
+            print(f"  {family:<30} {stats['requests']:>6} requests  {stats['retries']:>4} retries  "
+                  f"{mean:7.3f}s mean  {stats['bytes_received'] / 1e6:9.1f} MB received  "
+                  f"{stats['semaphore_wait_seconds']:8.1f}s waiting for a slot")
+    print(f"\nstub server requests: {stub_stats}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the workbench against a synthetic DHIS2 instance')
+    add_instance_arguments(parser)
+    parser.add_argument('--base-url', help='Use a stub server that is already running instead of starting one '
+                                           '(it must be started with the same instance options)')
+    parser.add_argument('--level', type=int, default=3, help='Org unit level the analysis stages run at')
+    parser.add_argument('--stages', default=','.join(STAGE_TYPES),
+                        help='Comma separated stage types to run (default: %(default)s)')
+    parser.add_argument('--max-concurrent-requests', type=int, default=10)
+    parser.add_argument('--adaptive', action='store_true', help='Use adaptive concurrency')
+    parser.add_argument('--min-max-datasets', type=int, default=1)
+    parser.add_argument('--min-max-org-units', type=int, default=5)
+    parser.add_argument('--output', help='Also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    instance = instance_from_args(args)
+    process = None
+    base_url = args.base_url
+    if not base_url:
+        process, base_url = start_stub_server(args)
+    try:
+        config = build_config(instance, base_url, level=args.level, stages=args.stages.split(','),
+                              max_concurrent_requests=args.max_concurrent_requests, adaptive=args.adaptive,
+                              min_max_datasets=args.min_max_datasets, min_max_org_units=args.min_max_org_units)
+        results = run_benchmark(config)
+        stub_stats = requests.get(f'{base_url}/stub/stats', timeout=10).json()
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+
+    _print_report(results, stub_stats)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'options': vars(args), 'results': results, 'stub_stats': stub_stats}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
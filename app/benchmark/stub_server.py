@@ -0,0 +1,553 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from aiohttp import web
+
+from app.benchmark.synthetic import SyntheticInstance
+from app.core.http_metrics import metrics_family
+
+# Data values are written to the response in batches of this many records
+STREAM_BATCH_SIZE = 5000
+DEFAULT_PAGE_SIZE = 50
+
+INSTANCE = web.AppKey('instance', SyntheticInstance)
+INTEGRITY_JOBS = web.AppKey('integrity_jobs', dict)
+INTEGRITY_JOB_SECONDS = web.AppKey('integrity_job_seconds', float)
+IMPORT_JOBS = web.AppKey('import_jobs', dict)
+IMPORT_JOB_SECONDS = web.AppKey('import_job_seconds', float)
+STATS = web.AppKey('stats', Counter)
+
+
+# --- Metadata queries ---
+def parse_fields(fields):
+    """
+    Parse a DHIS2 ``fields`` expression such as ``id,name,dataSetElements[dataElement[id]]``
+    into a dict of field name -> nested fields (None for a plain field). None means all fields.
+    """
+    if not fields or fields in ('*', ':all'):
+        return None
+    tree, stack, name = {}, [], ''
+    current = tree
+    for char in fields:
+        if char == ',':
+            if name:
+                current.setdefault(name.strip(), None)
+            name = ''
+        elif char == '[':
+            child = {}
+            current[name.strip()] = child
+            stack.append(current)
+            current, name = child, ''
+        elif char == ']':
+            if name:
+                current.setdefault(name.strip(), None)
+            current, name = stack.pop(), ''
+        else:
+            name += char
+    if name:
+        current.setdefault(name.strip(), None)
+    return tree
+
+
+def select_fields(obj, tree):
+    if tree is None or '*' in tree:
+        return obj
+    if isinstance(obj, list):
+        return [select_fields(item, tree) for item in obj]
+    if not isinstance(obj, dict):
+        return obj
+    selected = {}
+    for name, subtree in tree.items():
+        if name in obj:
+            value = obj[name]
+            selected[name] = select_fields(value, subtree) if subtree is not None else value
+    return selected
+
+
+def _resolve(obj, prop):
+    values = [obj]
+    for part in prop.split('.'):
+        next_values = []
+        for value in values:
+            value = value.get(part) if isinstance(value, dict) else None
+            if isinstance(value, list):
+                next_values.extend(value)
+            elif value is not None:
+                next_values.append(value)
+        values = next_values
+    return values
+
+
+def _compare(op, actual, expected):
+    if op in ('gt', 'ge', 'lt', 'le'):
+        try:
+            actual, expected = float(actual), float(expected)
+        except (TypeError, ValueError):
+            actual, expected = str(actual), str(expected)
+        return {'gt': actual > expected, 'ge': actual >= expected,
+                'lt': actual < expected, 'le': actual <= expected}[op]
+    actual = str(actual)
+    if op == 'eq':
+        return actual == expected
+    if op == 'ne':
+        return actual != expected
+    if op == 'in':
+        return actual in expected.strip('[]').split(',')
+    if op in ('like', 'ilike', '$like', '$ilike', 'token'):
+        return expected.lower() in actual.lower()
+    raise web.HTTPBadRequest(reason=f'Unsupported filter operator: {op}')
+
+
+def matches(obj, filter_expression):
+    prop, op, expected = (filter_expression.split(':', 2) + ['', ''])[:3]
+    if op == 'ne':
+        return all(_compare(op, v, expected) for v in _resolve(obj, prop))
+    return any(_compare(op, v, expected) for v in _resolve(obj, prop))
+
+
+def query_metadata(instance, endpoint, filters, fields, paging=True, page=1, page_size=DEFAULT_PAGE_SIZE):
+    """Filter, page and project a metadata collection the way ``/api/<endpoint>`` does."""
+    if endpoint not in instance.collections:
+        raise web.HTTPNotFound(reason=f'Unknown endpoint: {endpoint}')
+    objects = instance.collections[endpoint]
+    # Look ids up in the index first rather than scanning tens of thousands of org units
+    for f in sorted(filters, key=lambda f: not f.startswith('id:eq:')):
+        if f.startswith('id:eq:') and objects is instance.collections[endpoint]:
+            obj = instance.get(endpoint, f[len('id:eq:'):])
+            objects = [obj] if obj is not None else []
+        else:
+            objects = [obj for obj in objects if matches(obj, f)]
+    tree = parse_fields(fields)
+    response = {}
+    if paging:
+        total = len(objects)
+        page_count = max(1, -(-total // page_size))
+        objects = objects[(page - 1) * page_size:page * page_size]
+        response['pager'] = {'page': page, 'pageCount': page_count, 'total': total, 'pageSize': page_size}
+    response[endpoint] = [select_fields(obj, tree) for obj in objects]
+    return response
+
+
+# --- Request helpers ---
+def _instance(request):
+    return request.app[INSTANCE]
+
+
+def _date(value, name):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise web.HTTPConflict(reason=f'{name} must be a date (yyyy-MM-dd)')
+
+
+def _periods(instance, params):
+    if params.getall('period', []):
+        return params.getall('period')
+    return instance.periods_between(_date(params.get('startDate'), 'startDate'),
+                                    _date(params.get('endDate'), 'endDate'))
+
+
+def _import_summary(counts):
+    return {
+        'httpStatus': 'OK', 'httpStatusCode': 200, 'status': 'OK', 'message': 'Import was successful.',
+        'response': {'responseType': 'ImportSummary', 'status': 'SUCCESS', 'importCount': counts},
+    }
+
+
+async def _stream_json_array(request, envelope, key, items):
+    """Write ``{**envelope, key: [items]}`` in batches so large exports are not built in memory."""
+    response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+    response.enable_compression()
+    await response.prepare(request)
+    head = json.dumps(envelope)[:-1]
+    await response.write(f'{head}{", " if envelope else ""}"{key}": ['.encode())
+    batch, first = [], True
+    for item in items:
+        batch.append(json.dumps(item))
+        if len(batch) >= STREAM_BATCH_SIZE:
+            await response.write((('' if first else ',') + ','.join(batch)).encode())
+            batch, first = [], False
+            # Let other requests make progress between batches
+            await asyncio.sleep(0)
+    if batch:
+        await response.write((('' if first else ',') + ','.join(batch)).encode())
+    await response.write(b']}')
+    await response.write_eof()
+    return response
+
+
+# --- Handlers ---
+async def system_info(request):
+    return web.json_response({'version': _instance(request).version, 'revision': 'synthetic',
+                              'serverDate': datetime.now(timezone.utc).isoformat()})
+
+
+async def me(request):
+    return web.json_response({'id': 'benchmarkUsr', 'username': 'benchmark', 'authorities': ['ALL']})
+
+
+async def system_settings(request):
+    return web.json_response({'keyMaxDataQualityResults': 50000})
+
+
+async def get_data_value_sets(request):
+    instance = _instance(request)
+    params = request.query
+    data_elements = list(params.getall('dataElement', []))
+    for ds in params.getall('dataSet', []):
+        data_elements.extend(dse['dataElement']['id']
+                             for dse in (instance.get('dataSets', ds) or {}).get('dataSetElements', []))
+    org_units = params.getall('orgUnit', [])
+    if not data_elements or not org_units:
+        raise web.HTTPConflict(reason='At least one data set or data element and one org unit must be specified')
+    values = instance.data_values(data_elements, org_units, _periods(instance, params),
+                                  children=params.get('children') == 'true',
+                                  last_updated_since=_last_updated_since(params),
+                                  include_deleted=params.get('includeDeleted') == 'true')
+    return await _stream_json_array(request, {}, 'dataValues', values)
+
+
+_DURATION_UNITS = {'d': 86400, 'h': 3600, 'm': 60, 's': 1}
+
+
+def _last_updated_since(params):
+    """The UTC cut-off of ``lastUpdatedDuration`` (e.g. ``90m``) or ``lastUpdated``, formatted like stored values."""
+    duration = params.get('lastUpdatedDuration')
+    if duration:
+        try:
+            seconds = int(duration[:-1]) * _DURATION_UNITS[duration[-1]]
+        except (KeyError, ValueError):
+            raise web.HTTPConflict(reason=f'Invalid lastUpdatedDuration: {duration}')
+        return (datetime.now(timezone.utc) - timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%S.000')
+    last_updated = params.get('lastUpdated')
+    if last_updated:
+        return last_updated if 'T' in last_updated else f'{last_updated}T00:00:00.000'
+    return None
+
+
+async def post_data_value_sets(request):
+    payload = await request.json()
+    strategy = request.query.get('importStrategy', 'CREATE_AND_UPDATE')
+    if request.query.get('async') == 'true':
+        # Queued as a job which imports the values once it has run for import_job_seconds
+        jobs = request.app[IMPORT_JOBS]
+        job_id = f'importJob{len(jobs):03d}'
+        jobs[job_id] = {'done_at': time.monotonic() + request.app[IMPORT_JOB_SECONDS], 'payload': payload,
+                        'strategy': strategy, 'summary': None}
+        request.app[STATS]['import_jobs'] += 1
+        return web.json_response({
+            'httpStatus': 'OK', 'httpStatusCode': 200, 'status': 'OK', 'message': 'Initiated DATAVALUE_IMPORT',
+            'response': {'name': 'DATAVALUE_IMPORT', 'id': job_id, 'jobType': 'DATAVALUE_IMPORT',
+                         'relativeNotifierEndpoint': f'/api/system/tasks/DATAVALUE_IMPORT/{job_id}'},
+        })
+    counts = _instance(request).import_data_values(payload, strategy)
+    return web.json_response(_import_summary(counts))
+
+
+def _import_job(request):
+    """The import job of the request, imported first if it has finished running."""
+    job = request.app[IMPORT_JOBS].get(request.match_info['job_id'])
+    if job is not None and job['summary'] is None and job['done_at'] <= time.monotonic():
+        counts = _instance(request).import_data_values(job.pop('payload'), job['strategy'])
+        job['summary'] = _import_summary(counts)['response']
+    return job
+
+
+async def import_job_notifications(request):
+    job = _import_job(request)
+    if job is None:
+        return web.json_response([])
+    # Newest notification first, as DHIS2 returns them
+    notifications = [{'level': 'INFO', 'category': 'DATAVALUE_IMPORT', 'message': 'Process started',
+                      'completed': False}]
+    if job['summary'] is not None:
+        notifications.insert(0, {'level': 'INFO', 'category': 'DATAVALUE_IMPORT', 'message': 'Import done',
+                                 'completed': True})
+    return web.json_response(notifications)
+
+
+async def import_job_summary(request):
+    job = _import_job(request)
+    if job is None or job['summary'] is None:
+        raise web.HTTPNotFound(reason='Task summary not found')
+    return web.json_response(job['summary'])
+
+
+async def outlier_detection(request):
+    instance = _instance(request)
+    params = request.query
+    datasets, org_units = params.getall('ds', []), params.getall('ou', [])
+    if not datasets or not org_units:
+        raise web.HTTPConflict(reason='At least one data set and one org unit must be specified')
+    max_results = int(params.get('maxResults', 500))
+    # dataStartDate/dataEndDate only widen the data the statistics are computed from; the
+    # synthetic outliers are injected, so only the periods being checked matter here
+    periods = instance.periods_between(_date(params.get('startDate'), 'startDate'),
+                                       _date(params.get('endDate'), 'endDate'))
+    outliers = sorted(instance.outliers(datasets, org_units, periods), key=lambda o: o['absDev'], reverse=True)
+    return web.json_response({
+        'metadata': {'algorithm': params.get('algorithm', 'Z_SCORE'), 'maxResults': max_results,
+                     'count': min(len(outliers), max_results), 'orderBy': params.get('orderBy', 'Z_SCORE')},
+        'outlierValues': outliers[:max_results],
+    })
+
+
+async def validation_rule_analysis(request):
+    instance = _instance(request)
+    body = await request.json()
+    periods = instance.periods_between(_date(body.get('startDate'), 'startDate'),
+                                       _date(body.get('endDate'), 'endDate'))
+    violations = []
+    max_results = int(body.get('maxResults', 500))
+    for violation in instance.validation_violations(body.get('vrg'), [body.get('ou')], periods):
+        violations.append(violation)
+        if len(violations) >= max_results:
+            break
+    return web.json_response(violations)
+
+
+async def integrity_checks(request):
+    return web.json_response(_instance(request).integrity_checks)
+
+
+def _requested_checks(request):
+    checks = _instance(request).integrity_checks
+    requested = [c for c in request.query.get('checks', '').split(',') if c]
+    if not requested:
+        return checks
+    return [c for c in checks if c['name'] in requested or c['code'] in requested]
+
+
+async def trigger_integrity_summary(request):
+    seconds, jobs, now = request.app[INTEGRITY_JOB_SECONDS], request.app[INTEGRITY_JOBS], time.monotonic()
+    finished_at = (datetime.now(timezone.utc) + timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+    for check in _requested_checks(request):
+        request.app[STATS]['integrity_checks_triggered'] += 1
+        # While a check runs again, its summary still reports the previous run
+        job = jobs.get(check['name'])
+        previous = job and (job[1] if job[0] <= now else job[2])
+        jobs[check['name']] = (now + seconds, finished_at, previous)
+    return web.json_response({'httpStatus': 'OK', 'httpStatusCode': 200, 'status': 'OK',
+                              'message': 'Initiated data integrity summary',
+                              'response': {'jobType': 'DATA_INTEGRITY', 'id': 'synthJob001'}})
+
+
+async def running_integrity_summaries(request):
+    now = time.monotonic()
+    return web.json_response({name: {'name': name} for name, (finish, _, _) in request.app[INTEGRITY_JOBS].items()
+                              if finish > now})
+
+
+async def integrity_summaries(request):
+    instance, jobs, now = _instance(request), request.app[INTEGRITY_JOBS], time.monotonic()
+    summaries = {}
+    for check in _requested_checks(request):
+        finish, finished_at, previous = jobs.get(check['name'], (None, None, None))
+        finished_at = finished_at if finish is not None and finish <= now else previous
+        if finished_at:
+            summaries[check['name']] = {'name': check['name'], 'code': check['code'],
+                                        'displayName': check['displayName'],
+                                        'count': instance.integrity_count(check['name']), 'percentage': None,
+                                        'finishedTime': finished_at}
+    return web.json_response(summaries)
+
+
+def _min_max_record(instance, ou, de, coc, min_value, max_value, generated=True):
+    record = {'source': {'id': ou}, 'dataElement': {'id': de}, 'optionCombo': {'id': coc},
+              'min': min_value, 'max': max_value, 'generated': generated}
+    instance.min_max_values[(ou, de, coc)] = record
+
+
+async def upsert_min_max(request):
+    instance = _instance(request)
+    payload = await request.json()
+    successful = ignored = 0
+    for value in payload.get('values', []):
+        if value.get('minValue') is None or value.get('maxValue') is None:
+            ignored += 1
+            continue
+        _min_max_record(instance, value['orgUnit'], value['dataElement'], value['optionCombo'],
+                        value['minValue'], value['maxValue'])
+        successful += 1
+    return web.json_response({'successful': successful, 'ignored': ignored})
+
+
+async def post_legacy_min_max(request):
+    value = await request.json()
+    _min_max_record(_instance(request), value['orgUnit'], value['dataElement'], value['categoryOptionCombo'],
+                    value['minValue'], value['maxValue'])
+    return web.json_response({'status': 'OK'})
+
+
+async def get_min_max(request):
+    params = request.query
+    records = list(_instance(request).min_max_values.values())
+    for f in params.getall('filter', []):
+        records = [r for r in records if matches(r, f)]
+    response = {}
+    if params.get('paging', 'true') != 'false':
+        page, page_size = int(params.get('page', 1)), int(params.get('pageSize', DEFAULT_PAGE_SIZE))
+        response['pager'] = {'page': page, 'pageCount': max(1, -(-len(records) // page_size)),
+                             'total': len(records), 'pageSize': page_size}
+        records = records[(page - 1) * page_size:page * page_size]
+    response['minMaxDataElements'] = records
+    return web.json_response(response)
+
+
+async def metadata_collection(request):
+    endpoint = request.match_info['endpoint'].removesuffix('.json')
+    params = request.query
+    response = query_metadata(
+        _instance(request), endpoint, params.getall('filter', []), params.get('fields'),
+        paging=params.get('paging', 'true') != 'false',
+        page=int(params.get('page', 1)), page_size=int(params.get('pageSize', DEFAULT_PAGE_SIZE)),
+    )
+    return web.json_response(response)
+
+
+async def metadata_object(request):
+    endpoint = request.match_info['endpoint']
+    uid = request.match_info['uid'].removesuffix('.json')
+    obj = _instance(request).get(endpoint, uid)
+    if obj is None:
+        raise web.HTTPNotFound(reason=f'{endpoint}/{uid} not found')
+    return web.json_response(select_fields(obj, parse_fields(request.query.get('fields'))))
+
+
+async def stats(request):
+    return web.json_response(dict(request.app[STATS]))
+
+
+# --- Application ---
+def _simulation_middleware(latency, jitter, latency_by_endpoint, error_rate, error_status, seed):
+    rng = random.Random(seed)
+
+    @web.middleware
+    async def simulate(request, handler):
+        if not request.path.startswith('/api/'):
+            return await handler(request)
+        family = metrics_family(request.path)
+        request.app[STATS][family] += 1
+        if 'Authorization' not in request.headers:
+            return web.json_response({'httpStatus': 'Unauthorized', 'httpStatusCode': 401, 'status': 'ERROR'},
+                                     status=401)
+        delay = latency_by_endpoint.get(family, latency) + (rng.random() * jitter if jitter else 0)
+        if delay:
+            await asyncio.sleep(delay)
+        if error_rate and rng.random() < error_rate:
+            request.app[STATS]['injected_errors'] += 1
+            return web.json_response({'httpStatus': 'Service Unavailable', 'httpStatusCode': error_status,
+                                      'status': 'ERROR', 'message': 'Injected error'}, status=error_status)
+        return await handler(request)
+
+    return simulate
+
+
+def create_app(instance, latency=0.0, jitter=0.0, latency_by_endpoint=None, error_rate=0.0, error_status=503,
+               integrity_job_seconds=0.0, import_job_seconds=0.0, seed=None):
+    """
+    Build an aiohttp application that answers the DHIS2 API calls made by the workbench
+    from a ``SyntheticInstance``.
+
+    Every ``/api`` request is delayed by ``latency`` seconds (or the value for its endpoint
+    family in ``latency_by_endpoint``, e.g. ``{'outlierDetection': 2.0}``) plus up to ``jitter``
+    seconds, and fails with ``error_status`` with probability ``error_rate``. Integrity
+    summaries report as running for ``integrity_job_seconds`` after they are triggered, and
+    asynchronous dataValueSet imports for ``import_job_seconds`` after they are submitted.
+    Request counts per endpoint family are served at ``/stub/stats``.
+    """
+    app = web.Application(client_max_size=1024 ** 3, middlewares=[
+        _simulation_middleware(latency, jitter, latency_by_endpoint or {}, error_rate, error_status,
+                               instance.seed if seed is None else seed),
+    ])
+    app[INSTANCE] = instance
+    app[INTEGRITY_JOBS] = {}
+    app[INTEGRITY_JOB_SECONDS] = integrity_job_seconds
+    app[IMPORT_JOBS] = {}
+    app[IMPORT_JOB_SECONDS] = import_job_seconds
+    app[STATS] = Counter()
+
+    routes = [
+        ('GET', '/api/system/info', system_info),
+        ('GET', '/api/me', me),
+        ('GET', '/api/systemSettings', system_settings),
+        ('GET', '/api/dataValueSets', get_data_value_sets),
+        ('POST', '/api/dataValueSets', post_data_value_sets),
+        ('GET', '/api/outlierDetection', outlier_detection),
+        ('POST', '/api/dataAnalysis/validationRules', validation_rule_analysis),
+        ('GET', '/api/dataIntegrity', integrity_checks),
+        ('POST', '/api/dataIntegrity/summary', trigger_integrity_summary),
+        ('GET', '/api/dataIntegrity/summary', integrity_summaries),
+        ('GET', '/api/dataIntegrity/summary/running', running_integrity_summaries),
+        ('GET', '/api/system/tasks/DATAVALUE_IMPORT/{job_id}', import_job_notifications),
+        ('GET', '/api/system/taskSummaries/DATAVALUE_IMPORT/{job_id}', import_job_summary),
+        ('GET', '/api/minMaxDataElements', get_min_max),
+        ('POST', '/api/minMaxDataElements/upsert', upsert_min_max),
+        ('POST', '/api/dataEntry/minMaxValues', post_legacy_min_max),
+    ]
+    for method, path, handler in routes:
+        app.router.add_route(method, path, handler)
+        app.router.add_route(method, f'{path}.json', handler)
+    app.router.add_get('/api/{endpoint}', metadata_collection)
+    app.router.add_get('/api/{endpoint}/{uid}', metadata_object)
+    app.router.add_get('/stub/stats', stats)
+    return app
+
+
+def add_instance_arguments(parser):
+    """Command line options shared by the stub server and the benchmark runner."""
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--branching', default='10,15,20,10',
+                        help='Children per org unit on each level below the root (default: %(default)s, '
+                             'about 33,000 org units)')
+    parser.add_argument('--data-elements', type=int, default=200)
+    parser.add_argument('--data-sets', type=int, default=4)
+    parser.add_argument('--months', type=int, default=24, help='Months of generated data')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra seconds per request')
+    parser.add_argument('--analysis-latency', type=float,
+                        help='Seconds added to outlier, validation rule and dataValueSet requests instead')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with an error')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--integrity-job-seconds', type=float, default=0.0)
+    parser.add_argument('--import-job-seconds', type=float, default=0.0)
+
+
+def instance_from_args(args):
+    return SyntheticInstance(seed=args.seed, branching=[int(b) for b in args.branching.split(',')],
+                             data_elements=args.data_elements, data_sets=args.data_sets, months=args.months)
+
+
+def app_from_args(args, instance=None):
+    latency_by_endpoint = {}
+    if args.analysis_latency is not None:
+        latency_by_endpoint = {family: args.analysis_latency for family in (
+            'dataValueSets', 'outlierDetection', 'dataAnalysis/validationRules')}
+    return create_app(instance or instance_from_args(args), latency=args.latency, jitter=args.jitter,
+                      latency_by_endpoint=latency_by_endpoint, error_rate=args.error_rate,
+                      error_status=args.error_status, integrity_job_seconds=args.integrity_job_seconds,
+                      import_job_seconds=args.import_job_seconds, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a synthetic DHIS2 instance for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8085)
+    add_instance_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    instance = instance_from_args(args)
+    logging.info(f"Synthetic instance: {len(instance.collections['organisationUnits'])} org units, "
+                 f"{len(instance.data_elements)} data elements, {len(instance.data_sets)} data sets")
+    web.run_app(app_from_args(args, instance), host=args.host, port=args.port, access_log=None)
+
+
+if __name__ == '__main__':
+    main()
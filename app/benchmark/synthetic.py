@@ -0,0 +1,450 @@
+import hashlib
+import random
+import string
+from datetime import datetime, timezone
+
+from app.core.period_utils import Dhis2PeriodUtils
+
+_UID_ALPHABET = string.ascii_letters + string.digits
+_LEVEL_NAMES = ('National', 'Region', 'District', 'Chiefdom', 'Facility', 'Village')
+
+
+class SyntheticInstance:
+    """
+    A deterministic, made-up DHIS2 instance served by the stub server.
+
+    Metadata (the org unit hierarchy, data elements, data sets, groups, validation rule
+    groups and integrity checks) is built up front. Data values are never stored: each one
+    is derived from a hash of ``(seed, org unit, data element, option combo, period)``, so a
+    hierarchy with tens of thousands of facilities and hundreds of data elements costs no
+    more memory than its metadata. Values and min/max bounds posted to the stub are kept in
+    ``stored_values`` and ``min_max_values`` and override the generated ones.
+
+    ``branching`` gives the number of children per org unit on each level below the root,
+    e.g. ``(10, 15, 20, 10)`` builds 1 + 10 + 150 + 3,000 + 30,000 org units. Only the
+    lowest level (facilities) reports data.
+    """
+    DEFAULT_COC = 'HllvX50cXC0'
+    DEFAULT_CATEGORY_COMBO = 'bjDvmb4bfuf'
+    LAST_UPDATED = '2024-01-01T00:00:00.000'
+
+    def __init__(self, seed=1, branching=(10, 15, 20, 10), data_elements=200, data_sets=4, months=24,
+                 completeness=0.8, outlier_rate=0.02, disaggregated_share=0.25, validation_rule_groups=3,
+                 rules_per_group=10, violation_rate=0.05, integrity_checks=20, version='2.41.5'):
+        self.seed = seed
+        self.branching = tuple(branching)
+        self.completeness = completeness
+        self.outlier_rate = outlier_rate
+        self.violation_rate = violation_rate
+        self.version = version
+        self._key = str(seed).encode()[:64]
+        self._cell_hasher = hashlib.blake2b(digest_size=16, key=self._key)
+        self.period_utils = Dhis2PeriodUtils()
+
+        self.collections = {}
+        self._build_periods(months)
+        self._build_category_combos()
+        self._build_org_units()
+        self._build_data_elements(data_elements, disaggregated_share)
+        self._build_data_sets(data_sets)
+        self._build_validation_rule_groups(validation_rule_groups, rules_per_group)
+        self._build_integrity_checks(integrity_checks)
+        self._build_results_metadata()
+        self._index = {
+            name: {obj['id']: obj for obj in objects} for name, objects in self.collections.items()
+        }
+
+        # Posted state: (dataElement, orgUnit, period, categoryOptionCombo) -> data value, or None if deleted
+        self.stored_values = {}
+        # Deleted values as DHIS2 reports them with includeDeleted=true
+        self.deleted_values = {}
+        # (orgUnit, dataElement, optionCombo) -> min/max record
+        self.min_max_values = {}
+        self._facilities_under = {}
+
+    # --- Hashing helpers ---
+    def _units(self, *parts):
+        """Two deterministic floats in [0, 1) for the given key."""
+        digest = hashlib.blake2b('|'.join(map(str, parts)).encode(), digest_size=16, key=self._key).digest()
+        return int.from_bytes(digest[:8], 'big') / 2 ** 64, int.from_bytes(digest[8:], 'big') / 2 ** 64
+
+    def uid(self, *parts):
+        digest = hashlib.blake2b('|'.join(map(str, ('uid',) + parts)).encode(), digest_size=11,
+                                 key=self._key).digest()
+        return string.ascii_lowercase[digest[0] % 26] + ''.join(_UID_ALPHABET[b % 62] for b in digest[1:])
+
+    # --- Metadata ---
+    def _add(self, collection, obj):
+        obj.setdefault('lastUpdated', self.LAST_UPDATED)
+        self.collections.setdefault(collection, []).append(obj)
+        return obj
+
+    def _build_periods(self, months):
+        # Complete months only, ending with the previous month
+        current = self.period_utils.current_monthly_period()
+        self.periods = sorted(self.period_utils.previous_monthly_periods(current, months))
+        self.period_bounds = {
+            pe: (self.period_utils.get_start_date_from_period(pe), self.period_utils.get_end_date_from_period(pe))
+            for pe in self.periods
+        }
+        self._period_index = {pe: i for i, pe in enumerate(self.periods)}
+
+    def _build_category_combos(self):
+        self._add('categoryOptionCombos', {'id': self.DEFAULT_COC, 'name': 'default'})
+        self.sex_cocs = [self.uid('coc', name) for name in ('Female', 'Male')]
+        for coc, name in zip(self.sex_cocs, ('Female', 'Male')):
+            self._add('categoryOptionCombos', {'id': coc, 'name': name})
+        self.category_combos = {
+            'default': {'id': self.DEFAULT_CATEGORY_COMBO, 'name': 'default',
+                        'categoryOptionCombos': [{'id': self.DEFAULT_COC}]},
+            'sex': {'id': self.uid('categoryCombo', 'sex'), 'name': 'Sex',
+                    'categoryOptionCombos': [{'id': coc} for coc in self.sex_cocs]},
+        }
+        for combo in self.category_combos.values():
+            self._add('categoryCombos', combo)
+
+    def _build_org_units(self):
+        self.children = {}
+        self.levels = {}
+        root_id = self.uid('ou', 'root')
+        self._add('organisationUnits', {'id': root_id, 'name': 'Synthetic Country', 'code': 'OU_ROOT',
+                                        'level': 1, 'path': f'/{root_id}'})
+        self.levels[1] = [root_id]
+        parents = [(root_id, f'/{root_id}', 'Synthetic Country')]
+        for depth, count in enumerate(self.branching, start=2):
+            level_name = _LEVEL_NAMES[min(depth - 1, len(_LEVEL_NAMES) - 1)]
+            next_parents = []
+            for parent_id, parent_path, _ in parents:
+                child_ids = []
+                for i in range(count):
+                    ou_id = self.uid('ou', parent_id, i)
+                    path = f'{parent_path}/{ou_id}'
+                    name = f'{level_name} {len(next_parents) + 1}'
+                    self._add('organisationUnits', {'id': ou_id, 'name': name, 'code': f'OU_{ou_id}',
+                                                    'level': depth, 'path': path, 'parent': {'id': parent_id}})
+                    child_ids.append(ou_id)
+                    next_parents.append((ou_id, path, name))
+                self.children[parent_id] = child_ids
+            self.levels[depth] = [ou_id for ou_id, _, _ in next_parents]
+            parents = next_parents
+        self.root = root_id
+        self.facilities = self.levels[max(self.levels)]
+
+    def _build_data_elements(self, count, disaggregated_share):
+        self.data_elements = []
+        every = round(1 / disaggregated_share) if disaggregated_share else 0
+        for i in range(count):
+            combo = self.category_combos['sex' if every and i % every == 0 else 'default']
+            de = self._add('dataElements', {
+                'id': self.uid('de', i), 'name': f'Synthetic data element {i + 1}', 'code': f'DE_{i + 1:04d}',
+                'valueType': 'NUMBER' if i % 10 == 9 else 'INTEGER_ZERO_OR_POSITIVE',
+                'aggregationType': 'SUM', 'domainType': 'AGGREGATE',
+                'categoryCombo': {'id': combo['id']},
+            })
+            self.data_elements.append(de)
+        self._cocs_by_de = {
+            de['id']: [c['id'] for c in self._combo(de['categoryCombo']['id'])['categoryOptionCombos']]
+            for de in self.data_elements
+        }
+
+    def _combo(self, combo_id):
+        return next(c for c in self.category_combos.values() if c['id'] == combo_id)
+
+    def _build_data_sets(self, count):
+        self.data_sets = []
+        self._data_elements_by_dataset = {}
+        facilities = [{'id': ou} for ou in self.facilities]
+        for i in range(count):
+            members = self.data_elements[i::count]
+            ds = self._add('dataSets', {
+                'id': self.uid('ds', i), 'name': f'Synthetic data set {i + 1}', 'periodType': 'Monthly',
+                'organisationUnits': facilities,
+                'dataSetElements': [
+                    {'dataElement': {'id': de['id'], 'valueType': de['valueType']},
+                     'categoryCombo': self._combo(de['categoryCombo']['id'])}
+                    for de in members
+                ],
+            })
+            self.data_sets.append(ds)
+            self._data_elements_by_dataset[ds['id']] = [de['id'] for de in members]
+            self._add('dataElementGroups', {
+                'id': self.uid('deg', i), 'name': f'Synthetic data set {i + 1} elements',
+                'dataElements': [{'id': de['id'], 'valueType': de['valueType']} for de in members],
+            })
+        # A sample of facilities, e.g. for min/max stages that target org unit groups
+        self._add('organisationUnitGroups', {
+            'id': self.uid('oug', 'hospitals'), 'name': 'Hospitals',
+            'organisationUnits': [{'id': ou} for ou in self.facilities[::10]],
+        })
+
+    def _build_validation_rule_groups(self, count, rules_per_group):
+        self.validation_rule_groups = []
+        for g in range(count):
+            rules = []
+            for r in range(rules_per_group):
+                left, right = self.data_elements[(g * rules_per_group + r) % len(self.data_elements)], \
+                    self.data_elements[(g * rules_per_group + r + 1) % len(self.data_elements)]
+                rules.append(self._add('validationRules', {
+                    'id': self.uid('vr', g, r), 'name': f'{left["code"]} <= {right["code"]}',
+                    'importance': 'MEDIUM', 'operator': 'less_than_or_equal_to', 'periodType': 'Monthly',
+                    'leftSide': {'expression': f'#{{{left["id"]}}}'},
+                    'rightSide': {'expression': f'#{{{right["id"]}}}'},
+                    'validationRuleGroups': [{'id': self.uid('vrg', g)}],
+                }))
+            self.validation_rule_groups.append(self._add('validationRuleGroups', {
+                'id': self.uid('vrg', g), 'name': f'Synthetic rule group {g + 1}',
+                'validationRules': [{'id': rule['id']} for rule in rules],
+            }))
+
+    def _build_integrity_checks(self, count):
+        self.integrity_checks = [
+            {'name': f'synthetic_check_{i + 1}', 'code': f'SYN_{i + 1:02d}',
+             'displayName': f'Synthetic integrity check {i + 1}', 'section': 'Synthetic', 'severity': 'WARNING',
+             'isSlow': i % 7 == 6}
+            for i in range(count)
+        ]
+
+    def _build_results_metadata(self):
+        """Destination data elements and data sets for the workbench's own results."""
+        # One destination per stage, since each stage owns the values of its data element
+        self.outlier_data_elements = {
+            ds['id']: self._add('dataElements', {
+                'id': self.uid('de', 'outliers', ds['id']), 'name': f'DQ outliers {ds["name"]}',
+                'code': f'DQ_OUTLIERS_{i + 1}', 'valueType': 'INTEGER_ZERO_OR_POSITIVE',
+                'categoryCombo': {'id': self.DEFAULT_CATEGORY_COMBO}})
+            for i, ds in enumerate(self.data_sets)
+        }
+        self.validation_data_elements = {
+            vrg['id']: self._add('dataElements', {
+                'id': self.uid('de', 'violations', vrg['id']), 'name': f'DQ violations {vrg["name"]}',
+                'code': f'DQ_VIOLATIONS_{i + 1}', 'valueType': 'INTEGER_ZERO_OR_POSITIVE',
+                'categoryCombo': {'id': self.DEFAULT_CATEGORY_COMBO}})
+            for i, vrg in enumerate(self.validation_rule_groups)
+        }
+        integrity_elements = [
+            self._add('dataElements', {
+                'id': self.uid('de', 'integrity', check['code']), 'name': f'[MI] {check["displayName"]}',
+                'code': f'MI_{check["code"]}', 'valueType': 'INTEGER_ZERO_OR_POSITIVE',
+                'categoryCombo': {'id': self.DEFAULT_CATEGORY_COMBO}})
+            for check in self.integrity_checks
+        ]
+        self.results_data_set = self._add('dataSets', {
+            'id': self.uid('ds', 'results'), 'name': 'DQ results', 'periodType': 'Monthly',
+            'organisationUnits': [{'id': ou} for ou in self.facilities],
+            'dataSetElements': [{'dataElement': {'id': de['id'], 'valueType': de['valueType']}}
+                                for de in [*self.outlier_data_elements.values(),
+                                           *self.validation_data_elements.values()]],
+        })
+        self.integrity_data_set = self._add('dataSets', {
+            'id': self.uid('ds', 'integrity'), 'name': 'Metadata integrity', 'periodType': 'Monthly',
+            'organisationUnits': [{'id': self.root}],
+            'dataSetElements': [{'dataElement': {'id': de['id'], 'valueType': de['valueType']}}
+                                for de in integrity_elements],
+        })
+        self.integrity_group = self._add('dataElementGroups', {
+            'id': self.uid('deg', 'integrity'), 'name': 'Metadata integrity',
+            'dataElements': [{'id': de['id'], 'code': de['code'], 'name': de['name'], 'valueType': de['valueType']}
+                             for de in integrity_elements],
+        })
+
+    def get(self, collection, uid):
+        return self._index.get(collection, {}).get(uid)
+
+    def data_elements_for_dataset(self, dataset_id):
+        return self._data_elements_by_dataset.get(dataset_id, [])
+
+    def option_combos(self, de_id):
+        return self._cocs_by_de.get(de_id, [self.DEFAULT_COC])
+
+    # --- Hierarchy ---
+    def ou_path(self, ou_id):
+        ou = self.get('organisationUnits', ou_id)
+        return ou['path'] if ou else ''
+
+    def facilities_under(self, ou_id):
+        """Facilities in the subtree rooted at ``ou_id`` (including itself if it is one)."""
+        facilities = self._facilities_under.get(ou_id)
+        if facilities is None:
+            children = self.children.get(ou_id)
+            if children is None:
+                facilities = (ou_id,) if self.get('organisationUnits', ou_id) else ()
+            else:
+                facilities = tuple(f for child in children for f in self.facilities_under(child))
+            self._facilities_under[ou_id] = facilities
+        return facilities
+
+    def periods_between(self, start_date, end_date):
+        """Periods that lie completely within ``[start_date, end_date]`` (``date`` or ``datetime``)."""
+        start = datetime(start_date.year, start_date.month, start_date.day)
+        end = datetime(end_date.year, end_date.month, end_date.day, 23, 59, 59)
+        return [pe for pe, (pe_start, pe_end) in self.period_bounds.items() if pe_start >= start and pe_end <= end]
+
+    # --- Data ---
+    def _cell_key(self, ou_id, de_id, coc_id):
+        """Seed for a facility/data element/option combo series, and the period of its outlier (or None)."""
+        hasher = self._cell_hasher.copy()
+        hasher.update(f'{ou_id}|{de_id}|{coc_id}'.encode())
+        digest = hasher.digest()
+        u = int.from_bytes(digest[8:], 'big') / 2 ** 64
+        outlier = int(u / self.outlier_rate * len(self.periods)) if u < self.outlier_rate else None
+        return int.from_bytes(digest[:8], 'big'), outlier
+
+    def _cell(self, ou_id, de_id, coc_id):
+        """
+        The usual level of a series, two draws per period (reported?, noise) and the index of
+        its outlier period. Hashing once per series keeps large dataValueSet requests cheap.
+        """
+        seed, outlier = self._cell_key(ou_id, de_id, coc_id)
+        rng = random.Random(seed)
+        base = 10 ** (1 + 2 * rng.random())
+        return base, [rng.random() for _ in range(2 * len(self.periods))], outlier
+
+    def _value_from_cell(self, cell, period):
+        base, draws, outlier = cell
+        i = self._period_index[period]
+        if i == outlier:
+            return base * 8 * (0.7 + 0.6 * draws[2 * i + 1])
+        if draws[2 * i] >= self.completeness:
+            return None
+        return base * (0.7 + 0.6 * draws[2 * i + 1])
+
+    def generated_value(self, ou_id, de_id, coc_id, period):
+        """
+        The generated value for a facility, or None if it was not reported. About
+        ``outlier_rate`` of the series contain one value far beyond their usual range.
+        """
+        if period not in self._period_index:
+            return None
+        return self._value_from_cell(self._cell(ou_id, de_id, coc_id), period)
+
+    def data_values(self, data_elements, org_units, periods, children=False, last_updated_since=None,
+                    include_deleted=False):
+        """
+        Yield data values (DHIS2 JSON shape) for the given selection, posted values included.
+        ``last_updated_since`` (a timestamp string like ``LAST_UPDATED``) keeps only values
+        changed since then; ``include_deleted`` adds deleted values flagged ``deleted``.
+        """
+        data_elements = list(data_elements)
+        periods = [pe for pe in periods if pe in self._period_index]
+        selected_ous = set()
+        for ou in org_units:
+            selected_ous.update(self.facilities_under(ou) if children else (ou,))
+        generated_des = [de for de in data_elements if de in self._cocs_by_de]
+        if last_updated_since is not None and last_updated_since > self.LAST_UPDATED:
+            generated_des = []
+        for ou in sorted(selected_ous):
+            for de in generated_des:
+                for coc in self._cocs_by_de[de]:
+                    cell = self._cell(ou, de, coc)
+                    for pe in periods:
+                        value = self._value_from_cell(cell, pe)
+                        if value is not None and (de, ou, pe, coc) not in self.stored_values:
+                            yield self._data_value(de, ou, pe, coc, str(round(value)))
+
+        wanted_des, wanted_periods = set(data_elements), set(periods)
+        prefixes = tuple(f'/{ou}' for ou in org_units)
+        posted = list(self.stored_values.items())
+        if include_deleted:
+            posted.extend(self.deleted_values.items())
+        for (de, ou, pe, coc), dv in posted:
+            if dv is None or de not in wanted_des or pe not in wanted_periods:
+                continue
+            if last_updated_since is not None and dv['lastUpdated'] < last_updated_since:
+                continue
+            if ou in selected_ous or (children and any(p in self.ou_path(ou) for p in prefixes)):
+                yield dv
+
+    def _data_value(self, de, ou, pe, coc, value):
+        return {
+            'dataElement': de, 'period': pe, 'orgUnit': ou, 'categoryOptionCombo': coc,
+            'attributeOptionCombo': self.DEFAULT_COC, 'value': value, 'storedBy': 'synthetic',
+            'created': self.LAST_UPDATED, 'lastUpdated': self.LAST_UPDATED, 'followup': False,
+        }
+
+    def import_data_values(self, payload, strategy='CREATE_AND_UPDATE'):
+        """Apply a posted dataValueSet and return DHIS2-style import counts."""
+        counts = {'imported': 0, 'updated': 0, 'ignored': 0, 'deleted': 0}
+        header = {k: payload.get(k) for k in ('period', 'orgUnit')}
+        now = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000')
+        for dv in payload.get('dataValues', []):
+            de = dv.get('dataElement')
+            ou = dv.get('orgUnit') or header['orgUnit']
+            pe = dv.get('period') or header['period']
+            coc = dv.get('categoryOptionCombo') or self.DEFAULT_COC
+            if not (de and ou and pe) or not self.get('organisationUnits', ou):
+                counts['ignored'] += 1
+                continue
+            key = (de, ou, pe, coc)
+            exists = self.stored_values.get(key) is not None or (
+                key not in self.stored_values and de in self._cocs_by_de and pe in self.period_bounds
+                and self.generated_value(ou, de, coc, pe) is not None)
+            if strategy == 'DELETE':
+                if exists:
+                    self.stored_values[key] = None
+                    self.deleted_values[key] = {**self._data_value(de, ou, pe, coc, ''), 'deleted': True,
+                                                'lastUpdated': now}
+                    counts['deleted'] += 1
+                else:
+                    counts['ignored'] += 1
+                continue
+            if dv.get('value') in (None, ''):
+                counts['ignored'] += 1
+                continue
+            stored = self._data_value(de, ou, pe, coc, str(dv['value']))
+            stored['lastUpdated'] = now
+            self.stored_values[key] = stored
+            self.deleted_values.pop(key, None)
+            counts['updated' if exists else 'imported'] += 1
+        return counts
+
+    # --- Analysis ---
+    def outliers(self, dataset_ids, org_units, periods):
+        """Outlier records (DHIS2 ``outlierDetection`` shape) for the injected outliers."""
+        data_elements = [de for ds in dataset_ids for de in self.data_elements_for_dataset(ds)]
+        periods = set(periods)
+        for ou in org_units:
+            for facility in self.facilities_under(ou):
+                for de in data_elements:
+                    for coc in self._cocs_by_de[de]:
+                        _, outlier = self._cell_key(facility, de, coc)
+                        if outlier is None or self.periods[outlier] not in periods:
+                            continue
+                        pe = self.periods[outlier]
+                        cell = self._cell(facility, de, coc)
+                        mean, value = cell[0], self._value_from_cell(cell, pe)
+                        value = round(value)
+                        std_dev = mean * 0.17
+                        yield {
+                            'de': de, 'pe': pe, 'ou': facility, 'coc': coc, 'aoc': self.DEFAULT_COC,
+                            'value': value, 'mean': round(mean, 2), 'stdDev': round(std_dev, 2),
+                            'absDev': round(abs(value - mean), 2),
+                            'zScore': round(abs(value - mean) / std_dev, 2),
+                            'lowerBound': round(mean - 3 * std_dev, 2),
+                            'upperBound': round(mean + 3 * std_dev, 2),
+                            'followup': False,
+                        }
+
+    def validation_violations(self, group_id, org_units, periods):
+        """Validation rule violations (DHIS2 ``dataAnalysis/validationRules`` shape)."""
+        group = self.get('validationRuleGroups', group_id)
+        if group is None:
+            return
+        rules = [self.get('validationRules', r['id']) for r in group['validationRules']]
+        for ou in org_units:
+            for facility in self.facilities_under(ou):
+                for pe in periods:
+                    hit, spread = self._units('violations', group_id, facility, pe)
+                    if hit >= self.violation_rate:
+                        continue
+                    for i in range(1 + int(spread * 3)):
+                        rule = rules[(int(spread * 1000) + i) % len(rules)]
+                        yield {
+                            'validationRuleId': rule['id'], 'validationRuleDescription': rule['name'],
+                            'organisationUnitId': facility, 'periodId': pe, 'periodDisplayName': pe,
+                            'attributeOptionComboId': self.DEFAULT_COC, 'importance': rule['importance'],
+                            'leftSideValue': 20.0 + i, 'operator': '<=', 'rightSideValue': 10.0,
+                        }
+
+    def integrity_count(self, check_name):
+        count, _ = self._units('integrity', check_name)
+        return int(count * 200)
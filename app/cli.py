@@ -1,17 +1,26 @@
 import argparse
 import asyncio
 import logging
+import subprocess
 import sys
+import time
+from collections import defaultdict
 from datetime import datetime
 import os
 
-import aiohttp
-
 from app.analyzers.integrity_analyzer import IntegrityCheckAnalyzer
 from app.analyzers.outlier_analyzer import OutlierAnalyzer
 from app.analyzers.rule_analyzer import ValidationRuleAnalyzer
 from app.core.config_loader import ConfigManager
 from app.core.api_utils import Dhis2ApiUtils
+from app.core.dhis2_client import Dhis2Client
+from app.core.concurrency import create_limiter
+from app.core.http_metrics import HttpMetrics, write_prometheus_textfile
+from app.core.result_poster import ResultPoster
+from app.core.run_state import RunStateStore
+from app.distributed.coordinator import Coordinator
+from app.distributed.work_queue import WorkQueue
+from app.distributed.worker import Worker
 
 
 def _format_duration(delta) -> str:
@@ -23,8 +32,16 @@ def _format_duration(delta) -> str:
 
 
 class DataQualityMonitor:
-    def __init__(self, config):
+    # Scope of the analyzer stages in the client's run state store
+    RUN_STATE_SCOPE = 'analyzer_stages'
+
+    def __init__(self, config, client=None, resume=False, record_progress=False):
         self.config = config
+        # Record the progress of the run in the client's run state store (command line runs
+        # only, so other runs never discard the progress an interrupted one needs to resume)
+        self.record_progress = record_progress
+        # Continue the interrupted run of the same stages, if any, instead of starting afresh
+        self.resume = resume
 
         self.base_url = config['server']['base_url']
         self.d2_token = config['server']['d2_token']
@@ -34,15 +51,17 @@ class DataQualityMonitor:
             'Content-Type': 'application/json'
         }
 
+        # One pooled client per server, shared by every analyzer
+        self.client = client or Dhis2Client.from_config(config)
+        self.api_utils = Dhis2ApiUtils(self.base_url, self.d2_token, client=self.client)
+
         # Map stage types to analyzer instances
         self.analyzers = {
-            'outlier': OutlierAnalyzer(config, self.base_url, self.request_headers),
-            'validation_rules': ValidationRuleAnalyzer(config, self.base_url, self.request_headers),
-            'integrity_checks': IntegrityCheckAnalyzer(config, self.base_url, self.request_headers)
+            'outlier': OutlierAnalyzer(config, self.base_url, self.request_headers, self.api_utils),
+            'validation_rules': ValidationRuleAnalyzer(config, self.base_url, self.request_headers, self.api_utils),
+            'integrity_checks': IntegrityCheckAnalyzer(config, self.base_url, self.request_headers, self.api_utils)
         }
 
-        self.api_utils = Dhis2ApiUtils(self.base_url, self.d2_token)
-
         log_file = config['server'].get("log_file")
         log_level = config['server'].get("logging_level", "INFO").upper()
 
@@ -69,125 +88,168 @@ class DataQualityMonitor:
 
             analyzer = self.analyzers[stage_type]
             logging.info(f"Dispatching stage '{stage['name']}' of type '{stage_type}'")
-            return await analyzer.run_stage(stage, session, semaphore)
+            try:
+                return await analyzer.run_stage(stage, session, semaphore)
+            finally:
+                analyzer.release_shared(stage, session)
 
         except Exception as e:
             logging.error(f"Error running stage '{stage.get('name', '<unnamed>')}': {e}")
             return []
 
+    async def run_integrity_stages(self, session, stages, semaphore):
+        if not stages:
+            return []
+        logging.info(f"Dispatching {len(stages)} integrity stages with one summary job")
+        try:
+            return await self.analyzers['integrity_checks'].run_stages(stages, session, semaphore)
+        except Exception as e:
+            logging.error(f"Error running integrity stages: {e}")
+            return [[] for _ in stages]
+
     async def run_all_stages(self):
-        semaphore = asyncio.Semaphore(self.max_concurrent_requests)
-        async with aiohttp.ClientSession(headers=self.request_headers) as session:
-            logging.info(f"Running all stages with max {self.max_concurrent_requests} concurrent requests")
-            clock_start = datetime.now()
-            stage_names = [stage['name'] for stage in self.config['analyzer_stages']]
-            tasks = [
-                self.run_stage(session, stage, semaphore)
-                for stage in self.config['analyzer_stages']
-            ]
-
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            combined_import_summary, num_upserts, num_deletes, errors = await self._process_tasks(results, session, stage_names)
-
-            clock_end = datetime.now()
-            logging.info("All stages completed")
-            logging.info(f"Process took: {clock_end - clock_start}")
+        semaphore = create_limiter(self.config, self.client)
+        resilience_before = self.client.resilience.snapshot()
+        http_metrics = HttpMetrics()
+        with self.client.listening(http_metrics):
+            async with self.client.session() as session:
+                logging.info(f"Running all stages with max {self.max_concurrent_requests} concurrent requests")
+                clock_start = datetime.now()
+                # Integrity stages share one summary job, so overlapping checks are only run once
+                stages = [stage for stage in self.config['analyzer_stages'] if stage.get('type') != 'integrity_checks']
+                integrity_stages = [stage for stage in self.config['analyzer_stages']
+                                    if stage.get('type') == 'integrity_checks']
+                stage_names = [stage['name'] for stage in stages + integrity_stages]
+                self._plan_shared_analyses(stages)
+
+                # Completed units of work and acknowledged uploads are recorded, so an interrupted
+                # run can be resumed
+                progress = None
+                if self.record_progress and self.client.run_state is not None:
+                    progress = await asyncio.to_thread(self.client.run_state.begin, self.RUN_STATE_SCOPE,
+                                                       RunStateStore.fingerprint(self.config['analyzer_stages']),
+                                                       self.resume)
+
+                # Results are posted as the stages (and their windows) finish, while others still analyse
+                poster = self.result_poster(session, semaphore, progress)
+                for analyzer in self.analyzers.values():
+                    analyzer.result_sink = poster.add
+                    analyzer.run_progress = progress
+                try:
+                    tasks = [
+                        self._post_when_done(poster, self.run_stage(session, stage, semaphore))
+                        for stage in stages
+                    ]
+                    tasks.append(self._post_when_done(poster, self.run_integrity_stages(session, integrity_stages,
+                                                                                         semaphore), many=True))
+
+                    *results, integrity_results = await asyncio.gather(*tasks, return_exceptions=True)
+                finally:
+                    for analyzer in self.analyzers.values():
+                        analyzer.result_sink = None
+                        analyzer.run_progress = None
+                if isinstance(integrity_results, BaseException):
+                    integrity_results = [integrity_results] * len(integrity_stages)
+                results.extend(integrity_results)
+                combined_import_summary, num_upserts, num_deletes, errors = await self._process_tasks(results, poster,
+                                                                                                   stage_names)
+                if progress is not None:
+                    if errors:
+                        logging.warning("The run did not complete without errors; run again with --resume "
+                                        "to continue it")
+                    else:
+                        await asyncio.to_thread(progress.finish)
+
+                clock_end = datetime.now()
+                logging.info("All stages completed")
+                logging.info(f"Process took: {clock_end - clock_start}")
+
+        return self.run_result(errors, num_upserts, num_deletes, combined_import_summary, clock_start, clock_end,
+                               resilience_before, http_metrics, poster.failed_upserts, poster.failed_deletes)
+
+    def result_poster(self, session, semaphore, progress=None):
+        """A ``ResultPoster`` configured by the ``server`` settings."""
+        server = self.config['server']
+        return ResultPoster(self.api_utils, session,
+                            server.get('post_batch_size', ResultPoster.DEFAULT_BATCH_SIZE),
+                            server.get('post_batch_bytes', ResultPoster.DEFAULT_BATCH_BYTES),
+                            semaphore=semaphore,
+                            async_import=server.get('async_import', False),
+                            progress=progress)
+
+    def run_result(self, errors, num_upserts, num_deletes, import_summary, clock_start, clock_end,
+                   resilience_before, http_metrics, failed_upserts=0, failed_deletes=0):
+        resilience = self.client.resilience.summary(since=resilience_before)
+        if resilience['retries'] or resilience['circuit_opened']:
+            logging.info(f"Retried {resilience['retries']} requests, gave up on {resilience['gave_up']}, "
+                         f"opened {resilience['circuit_opened']} circuit breakers")
 
         return {
             "errors": errors,
             "data_values_posted": num_upserts,
             "data_values_deleted": num_deletes,
+            # Values of the chunks DHIS2 did not accept
+            "data_values_failed": failed_upserts,
+            "data_value_deletes_failed": failed_deletes,
             "duration": _format_duration(clock_end - clock_start),
-            "import_summary": combined_import_summary or {}
+            "duration_seconds": (clock_end - clock_start).total_seconds(),
+            "import_summary": import_summary or {},
+            "resilience": resilience,
+            "http_metrics": http_metrics.summary()
         }
 
-    async def _process_tasks(self, results, session, stage_names):
-        upserts = []
-        deletes = []
-        integrity_payloads = []  # header-style dataValueSet payloads (e.g. from integrity stages)
+    def _plan_shared_analyses(self, stages):
+        """
+        Tell the analyzers which stages make each analysis, so stages which differ only in where
+        their results go share the requests instead of repeating them.
+        """
+        for analyzer in self.analyzers.values():
+            analyzer.shared_analyses = defaultdict(set)
+            for stage in stages:
+                analyzer.shared_analyses[analyzer.analysis_signature(stage)].add(stage['name'])
+
+    @staticmethod
+    async def _post_when_done(poster, stage_run, many=False):
+        """
+        Hand what ``stage_run`` (one stage, or a list of stages with ``many``) has not streamed
+        yet to the poster once it finishes, and start posting it.
+        """
+        result = await stage_run
+        for stage_result in (result if many else [result]):
+            if isinstance(stage_result, dict):
+                poster.add(stage_result)
+        poster.flush()
+        return result
+
+    async def _process_tasks(self, results, poster, stage_names):
+        checkpoints = []  # incremental stages which completed without errors
         errors = []
         for name, result in zip(stage_names, results):
             if isinstance(result, Exception):
                 logging.error(f"Task failed with exception: {result}")
                 errors.append(f"{name}: {str(result)}")
             elif isinstance(result, dict):
-                upserts.extend(result.get("dataValues", []))
-                deletes.extend(result.get("deletions", []))
                 errors.extend(result.get("errors", []))
-                if result.get("dataValueSet"):
-                    integrity_payloads.append(result["dataValueSet"])
+                if result.get("checkpoint") and not result.get("errors"):
+                    checkpoints.append(result["checkpoint"])
             else:
                 msg = f"Unexpected result type from stage '{name}': {type(result)}"
                 logging.warning(msg)
                 errors.append(msg)
 
-        import_summary = None
-        delete_import_summary = None
-        integrity_import_summary = None
+        combined_import_summary = await poster.close()
+        errors.extend(poster.errors)
 
-        if upserts:
-            logging.info(f"Posting {len(upserts)} data value upserts")
-            try:
-                groups = {}
-                for dv in upserts:
-                    ds = dv.pop('_dataset', None)
-                    groups.setdefault(ds, []).append(dv)
-
-                group_summaries = []
-                for ds, values in groups.items():
-                    payload = {'dataValues': values}
-                    if ds:
-                        payload['dataSet'] = ds
-                    response = await self.api_utils.post_data_value_set(payload, session)
-                    group_summaries.append(Dhis2ApiUtils.parse_import_summary(response))
-                import_summary = self._merge_import_summaries(*group_summaries) if group_summaries else None
-            except Exception as post_err:
-                logging.error(f"Error posting data values: {post_err}")
-                errors.append(f"Post failed: {post_err}")
-
-        if deletes:
-            logging.info(f"Posting {len(deletes)} data value deletes")
-            try:
-                response = await self.api_utils.post_data_value_set(
-                    {'dataValues': deletes}, session, {'importStrategy': 'DELETE'}
-                )
-                delete_import_summary = Dhis2ApiUtils.parse_import_summary(response)
-            except Exception as delete_err:
-                logging.error(f"Error deleting data values: {delete_err}")
-                errors.append(f"Delete failed: {delete_err}")
-
-        for payload in integrity_payloads:
-            num_values = len(payload.get('dataValues', []))
-            logging.info(f"Posting integrity dataValueSet with {num_values} values "
-                         f"(dataSet={payload.get('dataSet')}, period={payload.get('period')}, "
-                         f"orgUnit={payload.get('orgUnit')})")
-            try:
-                response = await self.api_utils.post_data_value_set(payload, session)
-                integrity_import_summary = Dhis2ApiUtils.parse_import_summary(response)
-            except Exception as integrity_err:
-                logging.error(f"Error posting integrity data values: {integrity_err}")
-                errors.append(f"Integrity post failed: {integrity_err}")
-
-        combined_import_summary = self._merge_import_summaries(
-            delete_import_summary, import_summary, integrity_import_summary
-        )
-        num_deletes = len(deletes)
-        num_upserts = len(upserts) + sum(len(p.get('dataValues', [])) for p in integrity_payloads)
-        return combined_import_summary, num_upserts, num_deletes, errors
+        # A checkpoint only moves forward once the stage's results are stored
+        if checkpoints and self.client.checkpoints is not None:
+            if not poster.errors:
+                for checkpoint in checkpoints:
+                    await asyncio.to_thread(self.client.checkpoints.save, checkpoint['stage'],
+                                            checkpoint['fingerprint'], checkpoint['started_at'], checkpoint['full'])
+            else:
+                logging.warning("Not saving run checkpoints because posting the results failed")
 
-    @staticmethod
-    def _merge_import_summaries(*summaries):
-        combined = {"imported": 0, "updated": 0, "deleted": 0, "ignored": 0, "status": "OK"}
-        for s in summaries:
-            if not s:
-                continue
-            combined["imported"] += s.get("imported", 0)
-            combined["updated"] += s.get("updated", 0)
-            combined["deleted"] += s.get("deleted", 0)
-            combined["ignored"] += s.get("ignored", 0)
-            if s.get("status") != "OK":
-                combined["status"] = s.get("status")
-        return combined
+        return combined_import_summary, poster.upserts, poster.deletes, errors
 
 
 def run_main():
@@ -195,7 +257,29 @@ def run_main():
     parser.add_argument('--config', required=True, help='Path to configuration file')
     parser.add_argument('--log-level', help='Override logging level (DEBUG, INFO, WARNING, ERROR)')
     parser.add_argument('--log-file', help='Override log file path')
+    parser.add_argument('--metrics-file',
+                        help='Write Prometheus textfile-collector metrics for this run to this path')
+    parser.add_argument('--clear-metadata-cache', action='store_true',
+                        help='Discard cached metadata for this server before running')
+    parser.add_argument('--full-run', action='store_true',
+                        help='Ignore the checkpoints of incremental runs and analyse everything')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run: skip the work it completed and post only '
+                             'what it did not')
+    parser.add_argument('--coordinator', metavar='QUEUE',
+                        help='Split the run into work units in this queue file, for --worker processes to '
+                             'run, and post their results')
+    parser.add_argument('--worker', metavar='QUEUE',
+                        help='Run work units from this queue file until it stays empty')
+    parser.add_argument('--local-workers', type=int, default=0,
+                        help='With --coordinator, also start this many worker processes on this host')
+    parser.add_argument('--min-max', action='store_true',
+                        help='With --coordinator, also run the min/max stages')
     args = parser.parse_args()
+    if (args.local_workers or args.min_max) and not args.coordinator:
+        parser.error('--local-workers and --min-max require --coordinator')
+    if args.coordinator and args.worker:
+        parser.error('--coordinator and --worker are mutually exclusive')
 
     # Load and validate configuration
     config_manager = ConfigManager(config_path=args.config, config=None, validate_structure=True, validate_runtime=True)
@@ -203,6 +287,13 @@ def run_main():
         logging.error("Failed to load configuration.")
         sys.exit(1)
     config = config_manager.config
+    client = Dhis2Client.from_config(config)
+    if args.clear_metadata_cache and client.metadata_cache is not None:
+        client.metadata_cache.invalidate()
+    if args.full_run and client.checkpoints is not None:
+        client.checkpoints.clear()
+    # Command line runs record their progress unless server.run_state disables it
+    client.run_state = RunStateStore.from_config(config, enabled_by_default=True)
 
     # Apply CLI overrides for logging without editing the file
     if args.log_level:
@@ -210,8 +301,52 @@ def run_main():
     if args.log_file:
         config.setdefault('server', {})['log_file'] = args.log_file
 
-    monitor = DataQualityMonitor(config)
-    asyncio.run(monitor.run_all_stages())
+    monitor = DataQualityMonitor(config, client=client, resume=args.resume, record_progress=True)
+    if args.worker:
+        asyncio.run(Worker(monitor, WorkQueue.from_config(args.worker, config)).run())
+        return
+    if args.coordinator:
+        queue = WorkQueue.from_config(args.coordinator, config)
+        worker_command = [sys.executable, '-m', 'app.cli', '--config', args.config, '--worker', args.coordinator]
+        if args.log_level:
+            worker_command += ['--log-level', args.log_level]
+        workers = [subprocess.Popen(worker_command) for _ in range(args.local_workers)]
+
+        def workers_failed():
+            # Workers exit cleanly once the queue stays empty; a failure (e.g. a bad configuration)
+            # of all of them means the run would otherwise wait for its timeout
+            exit_codes = [worker.poll() for worker in workers]
+            if workers and all(code is not None and code != 0 for code in exit_codes):
+                return f"All local worker processes failed (exit codes {exit_codes})"
+            return None
+
+        try:
+            result = asyncio.run(Coordinator(monitor, queue, include_min_max=args.min_max,
+                                             workers_failed=workers_failed).run())
+        finally:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.wait()
+    else:
+        result = asyncio.run(monitor.run_all_stages())
+
+    metrics_file = args.metrics_file or config['server'].get('metrics_textfile')
+    if metrics_file:
+        run_gauges = {
+            'duration_seconds': result['duration_seconds'],
+            'errors': len(result['errors']),
+            'data_values_posted': result['data_values_posted'],
+            'data_values_deleted': result['data_values_deleted'],
+            'data_values_failed': result['data_values_failed'],
+            'data_value_deletes_failed': result['data_value_deletes_failed'],
+            'last_completed_timestamp_seconds': int(time.time()),
+        }
+        try:
+            write_prometheus_textfile(metrics_file, result['http_metrics'], run_gauges)
+            logging.info(f"Wrote run metrics to {metrics_file}")
+        except OSError as e:
+            logging.error(f"Could not write metrics file '{metrics_file}': {e}")
 
 if __name__ == '__main__':
     run_main()
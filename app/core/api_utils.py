@@ -1,24 +1,39 @@
+import asyncio
 import logging
 
 import requests
 
+from app.core.dhis2_client import Dhis2Client
+from app.core.json_stream import iter_json_array
+
 
 class Dhis2ApiUtils:
-    def __init__(self, base_url, d2_token=None, require_token=True):
+    # Polling of asynchronous import jobs: the interval doubles up to the maximum
+    IMPORT_POLL_INITIAL_INTERVAL = 0.25
+    IMPORT_POLL_MAX_INTERVAL = 10
+    IMPORT_POLL_TIMEOUT = 3600
+
+    def __init__(self, base_url, d2_token=None, require_token=True, client=None, metadata_cache=None):
         self.base_url = base_url
         if require_token and not d2_token:
             raise ValueError("A DHIS2 API token is required unless 'require_token=False' for testing.")
         self.d2_token = d2_token
-        self.request_headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Accept-Encoding': 'gzip',
-            'Authorization': f'ApiToken {d2_token}'
-        }
+        # Share one connection pool per server unless the caller injects its own client
+        self.client = client or Dhis2Client.for_server(base_url, d2_token)
+        self.request_headers = self.client.request_headers
+        # Optional persistent cache for metadata list queries (see MetadataCache)
+        self.metadata_cache = metadata_cache if metadata_cache is not None else self.client.metadata_cache
+
+    def request(self, session, method, url, semaphore=None, **kwargs):
+        """
+        Async context manager yielding the response to ``method url`` after the client's
+        retry and circuit-breaker policy has been applied (see ``ResiliencePolicy.request``).
+        """
+        return self.client.resilience.request(session, method, url, semaphore, **kwargs)
 
     async def get_system_info(self, session):
         url = f'{self.base_url}/api/system/info.json'
-        async with session.get(url) as response:
+        async with self.request(session, 'GET', url) as response:
             response.raise_for_status()
             return await response.json()
 
@@ -32,15 +47,15 @@ class Dhis2ApiUtils:
         :return: Response from the API.
         """
         url = f'{self.base_url}/api/metadata'
-        #Add the 'Content-Type' header if not already set
-        if 'Content-Type' not in self.request_headers:
-            self.request_headers['Content-Type'] = 'application/json'
-        response = requests.post(url, json=metadata, headers=self.request_headers)
+        response = self.client.http.post(url, json=metadata)
         return response
 
 
     async def get_server_version(self, session):
-        settings = await self.get_system_info(session)
+        # The version cannot change during a run, so every caller shares one lookup
+        settings = await self.client.memo(session).do(
+            ('system_info',), lambda: self.get_system_info(session)
+        )
         version = settings.get('version')
         if not version:
             raise ValueError("Server version not found in system settings")
@@ -64,23 +79,76 @@ class Dhis2ApiUtils:
         }
 
     async def get_organisation_units_at_level(self, level, session, semaphore):
-        url = f'{self.base_url}/api/organisationUnits.json?filter=level:eq:{level}&fields=id&paging=false'
-        async with semaphore:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                data = await response.json()
-                return [ou['id'] for ou in data['organisationUnits']]
-
-    async def fetch_datavalue_sets(self, query_params, session):
+        org_unit_ids = await self.client.memo(session).do(
+            ('organisation_units_at_level', level),
+            lambda: self._fetch_organisation_units_at_level(level, session, semaphore)
+        )
+        # Callers get their own copy of the shared result
+        return list(org_unit_ids)
+
+    async def _fetch_organisation_units_at_level(self, level, session, semaphore):
+        org_units = await self._fetch_organisation_units(session, semaphore, [f'level:eq:{level}'], ['id'])
+        return [ou['id'] for ou in org_units]
+
+    async def get_organisation_unit_parents(self, level, session, semaphore):
+        """Map each org unit at ``level`` to the id of its parent (None at the top level)."""
+        parents = await self.client.memo(session).do(
+            ('organisation_unit_parents', level),
+            lambda: self._fetch_organisation_units(session, semaphore, [f'level:eq:{level}'], ['id', 'parent[id]'])
+        )
+        return {ou['id']: (ou.get('parent') or {}).get('id') for ou in parents}
+
+    async def get_organisation_unit_children(self, org_unit, session, semaphore):
+        children = await self.client.memo(session).do(
+            ('organisation_unit_children', org_unit),
+            lambda: self._fetch_organisation_units(session, semaphore, [f'parent.id:eq:{org_unit}'], ['id'])
+        )
+        return [ou['id'] for ou in children]
+
+    async def _fetch_organisation_units(self, session, semaphore, filters, fields):
+        async def fetch(filters, fields):
+            org_units = self.iter_metadata_async('organisationUnits', session, filters=filters,
+                                                 fields=fields, semaphore=semaphore)
+            return [ou async for ou in org_units]
+
+        if self.metadata_cache is not None:
+            return await self.metadata_cache.get_or_fetch_async('organisationUnits', fetch, filters, fields)
+        return await fetch(filters, fields)
+
+    async def get_organisation_unit_paths(self, org_units, session, semaphore, chunk_size=100):
+        """Map each of ``org_units`` to its hierarchy path, e.g. ``/ImspTQPwCqd/O6uvpzGd5pu``."""
+        async def fetch(chunk):
+            # One-off lookups, so they bypass the metadata cache
+            return [ou async for ou in self.iter_metadata_async(
+                'organisationUnits', session, filters=[f"id:in:[{','.join(chunk)}]"], fields=['id', 'path'],
+                semaphore=semaphore
+            )]
+
+        org_units = sorted(set(org_units))
+        chunks = await asyncio.gather(*[fetch(org_units[i:i + chunk_size])
+                                        for i in range(0, len(org_units), chunk_size)])
+        return {ou['id']: ou.get('path', '') for chunk in chunks for ou in chunk}
+
+    async def fetch_datavalue_sets(self, query_params, session, predicate=None, semaphore=None):
+        """
+        Fetch a dataValueSet. Data values are decoded as they arrive and only those
+        accepted by ``predicate`` (all of them if it is None) are kept in memory.
+        """
         url = f'{self.base_url}/api/dataValueSets.json'
-        async with session.get(url, params=query_params) as response:
+        async with self.request(session, 'GET', url, semaphore, params=query_params) as response:
             if response.status != 200:
                 logging.error(f"Failed to fetch data value sets: {response.status}")
                 logging.error(await response.text())
                 raise requests.exceptions.RequestException(f"Failed to fetch data value sets: {response.status}")
-            return await response.json()
-
-    async def post_data_value_set(self, payload, session, params=None):
+            result = {}
+            data_values = [
+                dv async for dv in iter_json_array(response.content, 'dataValues', envelope=result)
+                if predicate is None or predicate(dv)
+            ]
+            result['dataValues'] = data_values
+            return result
+
+    async def post_data_value_set(self, payload, session, params=None, semaphore=None):
         """Post a dataValueSet payload to DHIS2.
 
         ``payload`` is the full request body dict, e.g.::
@@ -96,40 +164,89 @@ class Dhis2ApiUtils:
             query = '&'.join([f"{key}={value}" for key, value in params.items()])
             url = f'{url}?{query}'
 
-        async with session.post(url, json=payload) as response:
+        # Imports are upserts (or deletes) keyed by the data value, so a retry is safe
+        async with self.request(session, 'POST', url, semaphore, idempotent=True, json=payload) as response:
             if response.status != 200:
                 logging.error(f"Failed to post data value set: {response.status}")
                 logging.error(await response.text())
                 raise requests.exceptions.RequestException(f"Failed to post data value set: {response.status}")
             return await response.json()
 
+    async def import_data_value_set_async(self, payload, session, params=None, semaphore=None):
+        """
+        Submit a dataValueSet payload as an asynchronous DHIS2 import job and wait for it.
+
+        Only the submission and each poll hold a connection: the job runs in DHIS2's import
+        queue while its notifications are polled with backoff. Returns the job's import summary
+        in the shape ``post_data_value_set`` returns, so ``parse_import_summary`` handles both.
+        """
+        submitted = await self.post_data_value_set(payload, session, {**(params or {}), 'async': 'true'}, semaphore)
+        job_id = (submitted.get('response') or {}).get('id')
+        if not job_id:
+            raise RuntimeError(f"DHIS2 did not return an import job: {submitted}")
+
+        tasks_url = f'{self.base_url}/api/system/tasks/DATAVALUE_IMPORT/{job_id}'
+        deadline = asyncio.get_running_loop().time() + self.IMPORT_POLL_TIMEOUT
+        interval = self.IMPORT_POLL_INITIAL_INTERVAL
+        while True:
+            async with self.request(session, 'GET', tasks_url, semaphore) as response:
+                response.raise_for_status()
+                notifications = await response.json()
+            if any(n.get('completed') for n in notifications or []):
+                break
+            if asyncio.get_running_loop().time() + interval > deadline:
+                raise RuntimeError(f"Import job {job_id} did not finish within {self.IMPORT_POLL_TIMEOUT} seconds")
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, self.IMPORT_POLL_MAX_INTERVAL)
+
+        summary_url = f'{self.base_url}/api/system/taskSummaries/DATAVALUE_IMPORT/{job_id}'
+        async with self.request(session, 'GET', summary_url, semaphore) as response:
+            response.raise_for_status()
+            summary = await response.json()
+        # The job reports SUCCESS, WARNING or ERROR where the synchronous import reports OK
+        status = summary.get('status')
+        return {'status': 'OK' if status == 'SUCCESS' else status, 'response': summary}
+
     # --- Generic Metadata Utilities ---
-    def fetch_metadata_list(self, endpoint, key=None, filters=None, fields=None, extra_params=None):
+    @staticmethod
+    def _metadata_params(filters=None, fields=None, extra_params=None):
+        """
+        Build metadata query params as a list of tuples so repeated ``filter`` keys
+        survive in both requests and aiohttp. ``fields`` may be a list or a preformatted string.
+        """
         if fields is None:
             fields = ['id', 'name']
         if extra_params is None:
             extra_params = {'paging': 'false'}
         if filters is None:
             filters = []
+        fields = fields if isinstance(fields, str) else ','.join(fields)
+        params = [('fields', fields)]
+        params.extend(('filter', f) for f in filters)
+        params.extend((k, str(v).lower() if isinstance(v, bool) else str(v)) for k, v in extra_params.items())
+        return params
+
+    def fetch_metadata_list(self, endpoint, key=None, filters=None, fields=None, extra_params=None):
+        if self.metadata_cache is not None and key:
+            return self.metadata_cache.get_or_fetch(
+                endpoint,
+                lambda f, flds: self._fetch_metadata_list_remote(endpoint, key, f, flds, extra_params),
+                filters, fields, extra_params
+            )
+        return self._fetch_metadata_list_remote(endpoint, key, filters, fields, extra_params)
 
+    def _fetch_metadata_list_remote(self, endpoint, key=None, filters=None, fields=None, extra_params=None):
         base_url = f"{self.base_url.rstrip('/')}/api/{endpoint}.json"
-        params = {
-            'fields': ','.join(fields),
-            'filter': filters,
-            **extra_params
-        }
+        params = self._metadata_params(filters, fields, extra_params)
 
         logging.debug(f"Fetching metadata from URL: {base_url} with params: {params}")
-        resp = requests.get(base_url, headers=self.request_headers, params=params)
+        resp = self.client.http.get(base_url, params=params)
         logging.debug("Got response "f"status: {resp.status_code}, content: {resp.text[:100]}...")
         resp.raise_for_status()
         json_resp = resp.json()
         return json_resp.get(key, []) if key else json_resp
 
-    def fetch_metadata_item_by_id(self, endpoint, uid):
-        """
-        Fetch a single metadata item (e.g., dataElement) by UID.
-        """
+    def _metadata_item_url(self, endpoint, uid):
         # Supported endpoints
         allowed_endpoints = {'dataElements', 'dataSets', 'validationRuleGroups', 'categoryOptionCombos',
                              'dataElementGroups'}
@@ -140,9 +257,15 @@ class Dhis2ApiUtils:
         if not uid.isalnum() or len(uid) != 11 or not uid[0].isalpha():
             raise ValueError(f"Invalid UID: {uid}")
 
-        url = f"{self.base_url.rstrip('/')}/api/{endpoint}/{uid}?fields=id,name"
+        return f"{self.base_url.rstrip('/')}/api/{endpoint}/{uid}?fields=id,name"
 
-        response = requests.get(url, headers=self.request_headers)
+    def fetch_metadata_item_by_id(self, endpoint, uid):
+        """
+        Fetch a single metadata item (e.g., dataElement) by UID.
+        """
+        url = self._metadata_item_url(endpoint, uid)
+
+        response = self.client.http.get(url)
         response.raise_for_status()
         return response.json()
 
@@ -184,15 +307,58 @@ class Dhis2ApiUtils:
         return resp[0] if resp else None
 
     async def fetch_dataset_period_type(self, uid, session, semaphore):
+        return await self.client.memo(session).do(
+            ('dataset_period_type', uid), lambda: self._fetch_dataset_period_type(uid, session, semaphore)
+        )
+
+    async def _fetch_dataset_period_type(self, uid, session, semaphore):
         url = f'{self.base_url}/api/dataSets/{uid}.json?fields=periodType'
-        async with semaphore:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get('periodType')
-                raise requests.exceptions.RequestException(
-                    f"Failed to fetch dataset '{uid}': {response.status}"
-                )
+        async with self.request(session, 'GET', url, semaphore) as response:
+            if response.status == 200:
+                data = await response.json()
+                return data.get('periodType')
+            raise requests.exceptions.RequestException(
+                f"Failed to fetch dataset '{uid}': {response.status}"
+            )
+
+    async def fetch_dataset_value_types(self, uid, session, semaphore):
+        """Map each data element of data set ``uid`` to its value type."""
+        return await self.client.memo(session).do(
+            ('dataset_value_types', uid), lambda: self._fetch_dataset_value_types(uid, session, semaphore)
+        )
+
+    async def _fetch_dataset_value_types(self, uid, session, semaphore):
+        data_sets = await self.fetch_data_sets_async(
+            session, filters=[f'id:eq:{uid}'], fields=['id', 'dataSetElements[dataElement[id,valueType]]'],
+            semaphore=semaphore
+        )
+        if not data_sets:
+            raise requests.exceptions.RequestException(f"Dataset '{uid}' not found")
+        return {dse['dataElement']['id']: dse['dataElement'].get('valueType')
+                for dse in data_sets[0].get('dataSetElements', [])}
+
+    async def fetch_min_max_bounds(self, data_elements, session, semaphore, chunk_size=50):
+        """Map (org unit, data element, category option combo) to the stored (min, max) of ``data_elements``."""
+        data_elements = sorted(set(data_elements))
+        return await self.client.memo(session).do(
+            ('min_max_bounds', tuple(data_elements)),
+            lambda: self._fetch_min_max_bounds(data_elements, session, semaphore, chunk_size)
+        )
+
+    async def _fetch_min_max_bounds(self, data_elements, session, semaphore, chunk_size):
+        async def fetch(chunk):
+            return [record async for record in self.iter_metadata_async(
+                'minMaxDataElements', session, filters=[f"dataElement.id:in:[{','.join(chunk)}]"],
+                fields=['source[id]', 'dataElement[id]', 'optionCombo[id]', 'min', 'max'], semaphore=semaphore
+            )]
+
+        chunks = await asyncio.gather(*[fetch(data_elements[i:i + chunk_size])
+                                        for i in range(0, len(data_elements), chunk_size)])
+        return {
+            (record['source']['id'], record['dataElement']['id'], record['optionCombo']['id']):
+                (float(record['min']), float(record['max']))
+            for chunk in chunks for record in chunk
+        }
 
     def fetch_validation_rule_group_by_id(self, uid):
         resp = self.fetch_metadata_list('validationRuleGroups', 'validationRuleGroups', filters=[f'id:eq:{uid}'], fields=['id', 'name'])
@@ -204,7 +370,7 @@ class Dhis2ApiUtils:
 
     def fetch_me(self):
         url = f"{self.base_url.rstrip('/')}/api/me"
-        response = requests.get(url, headers=self.request_headers)
+        response = self.client.http.get(url)
         response.raise_for_status()
         return response.json()
 
@@ -215,6 +381,7 @@ class Dhis2ApiUtils:
             ('unreachable', reason)     — network/connection failure
             ('auth_failed', reason)     — server responded but rejected the token (4xx)
         """
+        # One-shot health check with its own short timeout; kept outside the pooled session
         try:
             response = requests.get(
                 f"{self.base_url}/api/me",
@@ -259,14 +426,158 @@ class Dhis2ApiUtils:
         Fetch system settings from the DHIS2 API.
         """
         url = f"{self.base_url.rstrip('/')}/api/systemSettings"
-        response = requests.get(url, headers=self.request_headers)
+        response = self.client.http.get(url)
         response.raise_for_status()
         return response.json()
 
     def get_metadata_integrity_checks(self):
         # GET /api/dataIntegrity
         url = f"{self.base_url}/api/dataIntegrity"
-        headers = {k: v for k, v in self.request_headers.items() if k.lower() != 'content-type'}
-        resp = requests.get(url, headers=headers, timeout=30)
+        # A None value drops the session-level Content-Type header for this request
+        resp = self.client.http.get(url, headers={'Content-Type': None}, timeout=30)
         resp.raise_for_status()
         return resp.json()
+
+    # --- Async Metadata Utilities ---
+    # Mirrors of the synchronous helpers above for use inside coroutines, so that
+    # metadata lookups do not block the event loop and can be gathered concurrently.
+    async def _request_json_async(self, session, method, url, semaphore=None, **kwargs):
+        async with self.request(session, method, url, semaphore, **kwargs) as response:
+            logging.debug(f"{method} {response.url} -> {response.status}")
+            response.raise_for_status()
+            return await response.json()
+
+    async def fetch_metadata_list_async(self, endpoint, session, key=None, filters=None, fields=None,
+                                        extra_params=None, semaphore=None):
+        if self.metadata_cache is not None and key:
+            async def fetch(f, flds):
+                return await self._fetch_metadata_list_remote_async(endpoint, session, key, f, flds,
+                                                                    extra_params, semaphore)
+
+            return await self.metadata_cache.get_or_fetch_async(endpoint, fetch, filters, fields, extra_params)
+        return await self._fetch_metadata_list_remote_async(endpoint, session, key, filters, fields,
+                                                            extra_params, semaphore)
+
+    async def _fetch_metadata_list_remote_async(self, endpoint, session, key=None, filters=None, fields=None,
+                                                extra_params=None, semaphore=None):
+        base_url = f"{self.base_url.rstrip('/')}/api/{endpoint}.json"
+        params = self._metadata_params(filters, fields, extra_params)
+        logging.debug(f"Fetching metadata from URL: {base_url} with params: {params}")
+        json_resp = await self._request_json_async(session, 'GET', base_url, semaphore, params=params)
+        return json_resp.get(key, []) if key else json_resp
+
+    @staticmethod
+    def _has_next_page(pager, page, item_count, page_size):
+        if item_count < page_size:
+            return False
+        if 'pageCount' in pager:
+            return page < pager['pageCount']
+        # Without totalPages DHIS2 omits pageCount; a full page means there may be more
+        return True
+
+    async def iter_metadata_async(self, endpoint, session, key=None, filters=None, fields=None,
+                                  page_size=None, semaphore=None):
+        """
+        Walk a paged metadata endpoint and yield its items one at a time.
+
+        The next page is requested while the caller consumes the current one, so only
+        about two pages are held in memory regardless of the size of the collection.
+        Wrap the generator in ``contextlib.aclosing`` when breaking out early.
+        """
+        key = key or endpoint
+        page_size = page_size or self.client.metadata_page_size
+        base_url = f"{self.base_url.rstrip('/')}/api/{endpoint}.json"
+
+        def fetch_page(page_number):
+            params = self._metadata_params(filters, fields, {'paging': 'true', 'page': page_number,
+                                                             'pageSize': page_size})
+            return asyncio.ensure_future(
+                self._request_json_async(session, 'GET', base_url, semaphore, params=params)
+            )
+
+        page = 1
+        pending = fetch_page(page)
+        try:
+            while pending is not None:
+                resp = await pending
+                pending = None
+                items = resp.get(key, [])
+                if self._has_next_page(resp.get('pager', {}), page, len(items), page_size):
+                    page += 1
+                    pending = fetch_page(page)
+                for item in items:
+                    yield item
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def fetch_metadata_item_by_id_async(self, endpoint, uid, session, semaphore=None):
+        url = self._metadata_item_url(endpoint, uid)
+        return await self._request_json_async(session, 'GET', url, semaphore)
+
+    async def _fetch_first_by_id_async(self, endpoint, uid, session, fields=None, semaphore=None):
+        resp = await self.fetch_metadata_list_async(endpoint, session, endpoint, filters=[f'id:eq:{uid}'],
+                                                    fields=fields or ['id', 'name'], semaphore=semaphore)
+        return resp[0] if resp else None
+
+    async def fetch_data_elements_async(self, session, filters=None, fields=None, extra_params=None, semaphore=None):
+        return await self.fetch_metadata_list_async('dataElements', session, 'dataElements', filters, fields,
+                                                    extra_params, semaphore)
+
+    async def fetch_data_sets_async(self, session, filters=None, fields=None, extra_params=None, semaphore=None):
+        return await self.fetch_metadata_list_async('dataSets', session, 'dataSets', filters, fields,
+                                                    extra_params, semaphore)
+
+    async def fetch_validation_rule_groups_async(self, session, filters=None, fields=None, extra_params=None,
+                                                 semaphore=None):
+        return await self.fetch_metadata_list_async('validationRuleGroups', session, 'validationRuleGroups', filters,
+                                                    fields, extra_params, semaphore)
+
+    async def fetch_data_element_groups_async(self, session, filters=None, fields=None, extra_params=None,
+                                              semaphore=None):
+        return await self.fetch_metadata_list_async('dataElementGroups', session, 'dataElementGroups', filters,
+                                                    fields, extra_params, semaphore)
+
+    async def fetch_organisation_unit_groups_async(self, session, filters=None, fields=None, extra_params=None,
+                                                   semaphore=None):
+        return await self.fetch_metadata_list_async('organisationUnitGroups', session, 'organisationUnitGroups',
+                                                    filters, fields, extra_params, semaphore)
+
+    async def fetch_data_element_by_id_async(self, uid, session, semaphore=None):
+        return await self._fetch_first_by_id_async('dataElements', uid, session, semaphore=semaphore)
+
+    async def fetch_organisation_unit_by_id_async(self, uid, session, semaphore=None):
+        return await self._fetch_first_by_id_async('organisationUnits', uid, session, semaphore=semaphore)
+
+    async def fetch_organisation_unit_group_by_id_async(self, uid, session, semaphore=None):
+        return await self._fetch_first_by_id_async('organisationUnitGroups', uid, session, semaphore=semaphore)
+
+    async def fetch_data_element_group_by_id_async(self, uid, session, semaphore=None):
+        return await self._fetch_first_by_id_async('dataElementGroups', uid, session, semaphore=semaphore)
+
+    async def fetch_dataset_by_id_async(self, uid, session, semaphore=None):
+        return await self._fetch_first_by_id_async('dataSets', uid, session, ['id', 'name', 'periodType'], semaphore)
+
+    async def fetch_validation_rule_group_by_id_async(self, uid, session, semaphore=None):
+        return await self._fetch_first_by_id_async('validationRuleGroups', uid, session, semaphore=semaphore)
+
+    async def fetch_category_option_combo_by_id_async(self, uid, session, semaphore=None):
+        return await self._fetch_first_by_id_async('categoryOptionCombos', uid, session, semaphore=semaphore)
+
+    async def fetch_me_async(self, session, semaphore=None):
+        url = f"{self.base_url.rstrip('/')}/api/me"
+        return await self._request_json_async(session, 'GET', url, semaphore)
+
+    async def fetch_system_settings_async(self, session, semaphore=None):
+        url = f"{self.base_url.rstrip('/')}/api/systemSettings"
+        return await self._request_json_async(session, 'GET', url, semaphore)
+
+    async def get_metadata_integrity_checks_async(self, session, semaphore=None):
+        # Like the synchronous helper, sent without a Content-Type (see Dhis2Client.get_session)
+        url = f"{self.base_url}/api/dataIntegrity"
+        return await self._request_json_async(session, 'GET', url, semaphore)
+
+    async def post_metadata_async(self, metadata, session, semaphore=None):
+        """Async counterpart of ``post_metadata``; returns the decoded import report."""
+        url = f'{self.base_url}/api/metadata'
+        return await self._request_json_async(session, 'POST', url, semaphore, json=metadata)
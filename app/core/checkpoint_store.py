@@ -0,0 +1,134 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+
+class CheckpointStore:
+    """
+    Persistent, per-server record of the last completed run of each analyzer stage.
+
+    A checkpoint holds the time the run started, the time of the last full run and a
+    fingerprint of the stage configuration. Incremental runs re-analyse only what changed
+    since the checkpoint; a full run is forced when there is no checkpoint, when the stage
+    configuration changed, or once the last full run is older than ``full_run_after`` seconds.
+    """
+    DEFAULT_FULL_RUN_AFTER = 7 * 24 * 3600
+    DEFAULT_OVERLAP = 3600
+    # Files whose schema this process has created
+    _initialised = set()
+    _init_lock = threading.Lock()
+
+    def __init__(self, path, full_run_after=None, overlap=None):
+        self.path = Path(path)
+        self.full_run_after = full_run_after or self.DEFAULT_FULL_RUN_AFTER
+        # Extra seconds of changes to look back over, for clock skew and slow imports
+        self.overlap = self.DEFAULT_OVERLAP if overlap is None else overlap
+
+    @classmethod
+    def default_directory(cls):
+        return Path.home() / '.cache' / 'dq-workbench' / 'checkpoints'
+
+    @classmethod
+    def path_for_server(cls, base_url, directory=None):
+        digest = hashlib.sha256(base_url.encode('utf-8')).hexdigest()[:16]
+        return Path(directory or cls.default_directory()) / f'{digest}.sqlite'
+
+    @classmethod
+    def from_config(cls, config):
+        """Build the store described by ``server.incremental``, or return None if it is disabled."""
+        server = config.get('server', {})
+        settings = server.get('incremental') or {}
+        if settings is True:
+            settings = {'enabled': True}
+        if not settings.get('enabled', False):
+            return None
+        directory = settings.get('path')
+        if directory:
+            directory = os.path.expanduser(directory)
+        return cls(
+            cls.path_for_server(server.get('base_url', ''), directory),
+            full_run_after=settings.get('full_run_after'),
+            overlap=settings.get('overlap'),
+        )
+
+    @staticmethod
+    def fingerprint(stage):
+        """Hash of everything that decides what a stage computes; a change forces a full run."""
+        relevant = {k: v for k, v in stage.get('params', {}).items() if k != 'incremental'}
+        payload = json.dumps([stage.get('type'), relevant, stage.get('organisation_unit')],
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    # --- Storage ---
+    def _ensure_db(self):
+        # Like MetadataCache, create the schema once per file and process, on first use
+        if self.path in self._initialised:
+            return
+        with self._init_lock:
+            if self.path not in self._initialised:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._init_db()
+                self._initialised.add(self.path)
+
+    def _connect(self):
+        self._ensure_db()
+        return self._open()
+
+    def _open(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _init_db(self):
+        with closing(self._open()) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS stage_checkpoints (
+                    stage_name TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    started_at REAL NOT NULL,
+                    full_run_at REAL NOT NULL
+                )""")
+
+    def get(self, stage_name):
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT fingerprint, started_at, full_run_at FROM stage_checkpoints WHERE stage_name = ?",
+                (stage_name,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'fingerprint': row[0], 'started_at': row[1], 'full_run_at': row[2]}
+
+    def save(self, stage_name, fingerprint, started_at, full_run):
+        """Record a completed run which started at ``started_at`` (seconds since the epoch)."""
+        with closing(self._connect()) as conn, conn:
+            if full_run:
+                full_run_at = started_at
+            else:
+                row = conn.execute("SELECT full_run_at FROM stage_checkpoints WHERE stage_name = ?",
+                                   (stage_name,)).fetchone()
+                full_run_at = row[0] if row else started_at
+            conn.execute(
+                "INSERT OR REPLACE INTO stage_checkpoints (stage_name, fingerprint, started_at, full_run_at) "
+                "VALUES (?, ?, ?, ?)",
+                (stage_name, fingerprint, started_at, full_run_at)
+            )
+        logging.debug(f"Saved {'full' if full_run else 'incremental'} checkpoint for stage '{stage_name}'")
+
+    def needs_full_run(self, stage, checkpoint, now=None):
+        if checkpoint is None or checkpoint['fingerprint'] != self.fingerprint(stage):
+            return True
+        return (now or time.time()) - checkpoint['full_run_at'] >= self.full_run_after
+
+    def clear(self, stage_name=None):
+        """Forget one stage's checkpoint, or all of them, so that the next run is a full run."""
+        with closing(self._connect()) as conn, conn:
+            if stage_name is None:
+                conn.execute("DELETE FROM stage_checkpoints")
+            else:
+                conn.execute("DELETE FROM stage_checkpoints WHERE stage_name = ?", (stage_name,))
+        logging.info(f"Cleared run checkpoints{f' for stage {stage_name}' if stage_name else ''} at {self.path}")
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+
+import aiohttp
+
+OVERLOAD_STATUSES = frozenset({429, 502, 503, 504})
+
+
+class AdaptiveLimiter:
+    """
+    Drop-in replacement for ``asyncio.Semaphore`` whose permit count follows the server.
+
+    Uses additive-increase/multiplicative-decrease: every successful response while the
+    limiter is saturated grows the limit by about one permit per round of requests, and
+    an overload signal (429/502/503/504, a timeout or a dropped connection, or a response
+    slower than ``target_latency``) cuts it by ``decrease_factor``. Decreases are spaced
+    by at least one typical request latency so that a burst of failures from requests
+    sent at the same limit only counts once.
+
+    The limiter observes responses through ``Dhis2Client.add_listener``; callers only use
+    ``async with limiter:`` as they would with a semaphore.
+    """
+    DEFAULT_MIN_LIMIT = 1
+    DEFAULT_DECREASE_FACTOR = 0.5
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, initial, min_limit=None, max_limit=None, decrease_factor=None, target_latency=None):
+        self.min_limit = max(1, min_limit or self.DEFAULT_MIN_LIMIT)
+        self.max_limit = max(self.min_limit, max_limit or initial)
+        self.decrease_factor = decrease_factor or self.DEFAULT_DECREASE_FACTOR
+        self.target_latency = target_latency
+        self._limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self._in_flight = 0
+        self._waiters = deque()
+        self._latency = None
+        self._last_decrease = 0.0
+        self.decreases = 0
+
+    @property
+    def limit(self):
+        return max(self.min_limit, math.floor(self._limit))
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def locked(self):
+        return self._in_flight >= self.limit
+
+    async def acquire(self):
+        while self._in_flight >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif not waiter.cancelled():
+                    # We were woken but will not use the permit; pass it on
+                    self._wake_waiters()
+                raise
+        self._in_flight += 1
+        return True
+
+    def release(self):
+        self._in_flight -= 1
+        self._wake_waiters()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return None
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def _wake_waiters(self):
+        free = self.limit - self._in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    # --- Feedback from Dhis2Client ---
+    def on_response(self, method, url, status, elapsed):
+        if status in OVERLOAD_STATUSES:
+            self._decrease(f"HTTP {status} from {url}")
+            return
+        self._latency = elapsed if self._latency is None else (
+            self.LATENCY_SMOOTHING * elapsed + (1 - self.LATENCY_SMOOTHING) * self._latency
+        )
+        if self.target_latency and elapsed > self.target_latency:
+            self._decrease(f"{elapsed:.1f}s response from {url}")
+        elif self._in_flight >= self.limit - 1:
+            self._increase()
+
+    def on_error(self, method, url, error, elapsed):
+        if isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError)):
+            self._decrease(f"{type(error).__name__} from {url}")
+
+    def _increase(self):
+        before = self.limit
+        self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+        if self.limit > before:
+            logging.debug(f"Concurrency limit raised to {self.limit}")
+            self._wake_waiters()
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self._last_decrease < max(self._latency or 0.0, 1.0):
+            return
+        self._last_decrease = now
+        self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+        self.decreases += 1
+        logging.info(f"Concurrency limit lowered to {self.limit} after {reason}")
+
+
+def create_limiter(config, client=None, default_max_concurrent_requests=10):
+    """
+    Build the request limiter for a run: a plain ``asyncio.Semaphore`` of
+    ``max_concurrent_requests``, or an ``AdaptiveLimiter`` when
+    ``server.adaptive_concurrency.enabled`` is set. Must be called inside the event loop
+    that will use it.
+    """
+    server = config.get('server', {})
+    max_concurrent_requests = server.get('max_concurrent_requests', default_max_concurrent_requests)
+    settings = server.get('adaptive_concurrency') or {}
+    if not settings.get('enabled', False):
+        return asyncio.Semaphore(max_concurrent_requests)
+
+    limiter = AdaptiveLimiter(
+        initial=max_concurrent_requests,
+        min_limit=settings.get('min_concurrent_requests'),
+        max_limit=settings.get('max_concurrent_requests', max_concurrent_requests),
+        decrease_factor=settings.get('decrease_factor'),
+        target_latency=settings.get('target_latency'),
+    )
+    if client is not None:
+        client.add_listener(limiter)
+    return limiter
@@ -3,6 +3,7 @@ import re
 import yaml
 
 from app.core.api_utils import Dhis2ApiUtils
+from app.core.dhis2_client import Dhis2Client
 from app.core.time_unit import TimeUnit
 import logging
 from typing import Any, Dict, Sequence
@@ -10,7 +11,7 @@ from app.core.period_utils import Dhis2PeriodUtils
 
 
 class ConfigManager:
-    def __init__(self, config_path, config, validate_structure=True, validate_runtime=True):
+    def __init__(self, config_path, config, validate_structure=True, validate_runtime=True, client=None):
         if config_path:
             with open(config_path, 'r') as stream:
                 config = yaml.safe_load(stream)
@@ -25,11 +26,12 @@ class ConfigManager:
         if not isinstance(server, dict):
             raise ValueError("Missing or invalid 'server' section in config.")
         self.server: Dict[str, Any] = server
+        self.client = client
 
         if validate_structure:
             self.validate_structure(self.config)
         if validate_runtime:
-            self._validate_runtime(self.config)
+            self._validate_runtime(self.config, client)
 
 
     @staticmethod
@@ -62,7 +64,7 @@ class ConfigManager:
             yaml.dump(self.config, f)
 
     @classmethod
-    def _validate_runtime(cls, config):
+    def _validate_runtime(cls, config, client=None):
         # Check base_url format
         url = config['server'].get('base_url', '')
         if not url.startswith(('http://', 'https://')):
@@ -71,7 +73,7 @@ class ConfigManager:
             raise ValueError("Base URL should not end with a slash")
 
         # Attempt to ping the server
-        api_utils = Dhis2ApiUtils(url, config['server'].get('d2_token', ''))
+        api_utils = Dhis2ApiUtils(url, config['server'].get('d2_token', ''), client=client)
         status, reason = api_utils.ping()
         if status == 'unreachable':
             raise ValueError(f"DHIS2 server is unreachable: {reason}")
@@ -79,7 +81,7 @@ class ConfigManager:
             raise ValueError(f"API token was rejected by the server: {reason}")
 
         cls._validate_max_results(api_utils, config)
-        cls._validate_default_coc(config)
+        cls._validate_default_coc(config, api_utils)
 
     @classmethod
     def _validate_max_results(cls, api_utils, config):
@@ -103,7 +105,7 @@ class ConfigManager:
 
     def validate_structure(self, config: dict):
         self._validate_base_url(config['server']['base_url'])
-        self._validate_api_token(config['server']['base_url'], config['server']['d2_token'])
+        self._validate_api_token(config['server']['base_url'], config['server']['d2_token'], self.client)
         self._validate_max_results_within_bounds(config)
         #We need at least analyzer_stages or min_max_stages
         if 'analyzer_stages' not in config and 'min_max_stages' not in config:
@@ -118,6 +120,8 @@ class ConfigManager:
                 self._validate_stage_params(stage)
                 if stage['type'] in ['validation_rules', 'outlier']:
                     self._is_valid_duration(stage['params']['duration'], stage['name'])
+                    if stage['params'].get('shard_duration'):
+                        self._is_valid_duration(stage['params']['shard_duration'], stage['name'])
 
         # Validate min_max stages
         if 'min_max_stages' in config:
@@ -137,13 +141,20 @@ class ConfigManager:
         stage_type = stage['type']
         if stage_type == 'validation_rules':
             required = ['validation_rule_group', 'destination_data_element', 'level', 'duration']
+            self._validate_engine(stage)
         elif stage_type == 'outlier':
             required = ['dataset', 'algorithm', 'destination_data_element', 'level', 'duration']
             self._validate_outlier_start_end_dates(stage)
+            self._validate_outlier_engine(stage)
         elif stage_type == 'min_max':
             required = ['dataset', 'destination_data_element']
         elif stage_type == 'integrity_checks':
             required = ['monitoring_group', 'dataset']
+            max_age = params.get('max_age')
+            if max_age is not None and (isinstance(max_age, bool) or not isinstance(max_age, (int, float))
+                                        or max_age < 0):
+                raise ValueError(f"Invalid max_age '{max_age}' in stage '{stage['name']}'. "
+                                 "Must be a number of seconds >= 0")
         else:
             raise ValueError(f"Unknown stage type '{stage_type}' in stage '{stage['name']}'")
         for param in required:
@@ -161,11 +172,12 @@ class ConfigManager:
 
 
     @staticmethod
-    def _validate_default_coc(config):
-        api_utils = Dhis2ApiUtils(
-            base_url=config['server']['base_url'],
-            d2_token=config['server']['d2_token']
-        )
+    def _validate_default_coc(config, api_utils=None):
+        if api_utils is None:
+            api_utils = Dhis2ApiUtils(
+                base_url=config['server']['base_url'],
+                d2_token=config['server']['d2_token']
+            )
         default_coc = config['server'].get('default_coc')
         #This can be blank, but then we need to check to see if HllvX50cXC0 exists as this is the default
         if not default_coc:
@@ -199,17 +211,34 @@ class ConfigManager:
             raise ValueError(f"Base URL must not end with a trailing slash: '{url}'")
 
     @staticmethod
-    def _validate_api_token(base_url: str, d2_token: str):
+    def _validate_api_token(base_url: str, d2_token: str, client=None):
         import requests
+        if client is None or client.base_url != base_url or client.d2_token != d2_token:
+            client = Dhis2Client.for_server(base_url, d2_token)
         try:
-            headers = {'Authorization': f'ApiToken {d2_token}'}
             url = f"{base_url}/api/me"
-            response = requests.get(url, headers=headers, timeout=5)
+            response = client.http.get(url, timeout=5)
             if response.status_code != 200:
                 raise ValueError(f"Invalid DHIS2 API token or server unreachable: {url}")
         except requests.RequestException as e:
             raise ValueError(f"Failed to connect to DHIS2 API: {e}")
 
+    @staticmethod
+    def _validate_engine(stage):
+        engine = stage['params'].get('engine', 'server')
+        if engine not in ('server', 'local'):
+            raise ValueError(f"Invalid engine '{engine}' in stage '{stage['name']}'. Must be 'server' or 'local'")
+
+    @staticmethod
+    def _validate_outlier_engine(stage):
+        ConfigManager._validate_engine(stage)
+        params = stage['params']
+        if params.get('engine') == 'local' and params.get('algorithm') not in ('Z_SCORE', 'MOD_Z_SCORE', 'MIN_MAX'):
+            raise ValueError(
+                f"The local engine does not support algorithm '{params.get('algorithm')}' in stage "
+                f"'{stage['name']}'. Must be one of: Z_SCORE, MOD_Z_SCORE, MIN_MAX"
+            )
+
     @staticmethod
     def _validate_outlier_start_end_dates(stage):
         start_date = None
@@ -232,6 +261,7 @@ class ConfigManager:
         return Dhis2ApiUtils(
             base_url=self.config['server']['base_url'],
             d2_token=self.config['server']['d2_token'],
+            client=self.client,
         )
 
     def _validate_datasets_exist(self, datasets: Sequence[str]) -> None:
@@ -0,0 +1,304 @@
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.core.checkpoint_store import CheckpointStore
+from app.core.metadata_cache import MetadataCache
+from app.core.run_state import RunStateStore
+from app.core.resilience import ResiliencePolicy
+from app.core.single_flight import SingleFlight
+
+
+class Dhis2ConnectionPool:
+    """
+    The connections to one DHIS2 server: a ``requests`` adapter for the synchronous metadata
+    helpers and one ``aiohttp.ClientSession`` per event loop for the async analyzers. A pool
+    is shared by every ``Dhis2Client`` of the server, so runs reuse each other's connections.
+    """
+
+    def __init__(self, request_headers, max_concurrent_requests):
+        self.request_headers = request_headers
+        self.max_concurrent_requests = max_concurrent_requests
+        self.adapter = None
+        self.http_lock = threading.Lock()
+        # aiohttp sessions are bound to the loop that created them, so keep one per loop
+        self.sessions = weakref.WeakKeyDictionary()
+
+
+class Dhis2Client:
+    """
+    Connection-pooled HTTP client for a single DHIS2 server.
+
+    The connections live in a ``Dhis2ConnectionPool`` and are kept alive between calls, so a
+    run pays for one TLS handshake per connection rather than one per request. Everything a
+    run changes (its stores, resilience policy and listeners) belongs to the client, so runs
+    in other threads, each with a client from ``from_config``, do not affect each other.
+    """
+    DEFAULT_MAX_CONCURRENT_REQUESTS = 10
+    DEFAULT_METADATA_PAGE_SIZE = 1000
+    KEEPALIVE_TIMEOUT = 60
+    DNS_CACHE_TTL = 300
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, base_url, d2_token, max_concurrent_requests=None, pool=None):
+        self.base_url = base_url
+        self.d2_token = d2_token
+        self.metadata_page_size = self.DEFAULT_METADATA_PAGE_SIZE
+        self.metadata_cache = None
+        self.checkpoints = None
+        self.run_state = None
+        self.resilience = ResiliencePolicy(notify=self.notify)
+        self.request_headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip',
+            'Authorization': f'ApiToken {d2_token}'
+        }
+        self._pool = pool or Dhis2ConnectionPool(
+            self.request_headers, max_concurrent_requests or self.DEFAULT_MAX_CONCURRENT_REQUESTS
+        )
+        self._http = None
+        # Run-scoped memos, one per borrowed session (see memo)
+        self._memos = weakref.WeakKeyDictionary()
+        # Objects notified of every async response, with the loop they run on (see add_listener)
+        self._listeners = weakref.WeakKeyDictionary()
+
+    @property
+    def max_concurrent_requests(self):
+        return self._pool.max_concurrent_requests
+
+    @max_concurrent_requests.setter
+    def max_concurrent_requests(self, value):
+        # Only affects sessions opened from now on
+        self._pool.max_concurrent_requests = value
+
+    @classmethod
+    def for_server(cls, base_url, d2_token, max_concurrent_requests=None):
+        """Return the shared client for ``base_url``/``d2_token``, creating it on first use."""
+        key = (base_url, d2_token)
+        with cls._registry_lock:
+            client = cls._registry.get(key)
+            if client is None:
+                client = cls(base_url, d2_token, max_concurrent_requests)
+                cls._registry[key] = client
+            elif max_concurrent_requests and client.max_concurrent_requests != max_concurrent_requests:
+                client.max_concurrent_requests = max_concurrent_requests
+            return client
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        A client of its own for one run, with the stores and resilience policy ``config``
+        describes, using the connections of the shared client for the server.
+        """
+        server = config['server']
+        max_concurrent_requests = server.get('max_concurrent_requests', cls.DEFAULT_MAX_CONCURRENT_REQUESTS)
+        adaptive = server.get('adaptive_concurrency') or {}
+        if adaptive.get('enabled', False):
+            # Size the pool for the most permits the adaptive limiter may grant
+            max_concurrent_requests = max(max_concurrent_requests,
+                                          adaptive.get('max_concurrent_requests', max_concurrent_requests))
+        shared = cls.for_server(
+            server.get('base_url', ''),
+            server.get('d2_token', ''),
+            max_concurrent_requests,
+        )
+        client = cls(shared.base_url, shared.d2_token, pool=shared._pool)
+        client.metadata_page_size = server.get('metadata_page_size', cls.DEFAULT_METADATA_PAGE_SIZE)
+        client.metadata_cache = MetadataCache.from_config(config)
+        client.checkpoints = CheckpointStore.from_config(config)
+        client.run_state = RunStateStore.from_config(config)
+        client.resilience = ResiliencePolicy.from_config(config, notify=client.notify)
+        return client
+
+    # --- Synchronous pool ---
+    @property
+    def http(self):
+        """
+        The client's ``requests.Session``, with the DHIS2 auth headers already applied. Its
+        connections are pooled by the adapter shared by the clients of the server, and its
+        responses are reported to the client's listeners like those of the async sessions.
+        """
+        if self._http is None:
+            pool = self._pool
+            with pool.http_lock:
+                if pool.adapter is None:
+                    pool.adapter = HTTPAdapter(pool_connections=1,
+                                               pool_maxsize=max(pool.max_concurrent_requests, 10))
+                if self._http is None:
+                    http = requests.Session()
+                    http.headers.update(pool.request_headers)
+                    http.mount('http://', pool.adapter)
+                    http.mount('https://', pool.adapter)
+                    http.hooks['response'].append(self._on_http_response)
+                    self._http = http
+        return self._http
+
+    def _on_http_response(self, response, **kwargs):
+        # Requests of the synchronous helpers make one attempt each, so they are reported as
+        # complete requests; the adaptive limiter only follows the async requests it admits
+        request = response.request
+        path = urlsplit(request.url).path
+        body = request.body
+        if body:
+            self.notify('on_bytes_sent', request.method, path, len(body))
+        received = len(response.content)
+        # Once the content is read, the raw response has consumed the (compressed) body
+        wire_bytes = response.raw.tell() if response.headers.get('Content-Encoding') else None
+        self.notify('on_request_complete', request.method, path, response.status_code,
+                    response.elapsed.total_seconds(), received, wire_bytes)
+
+    # --- Asynchronous pool ---
+    def _make_connector(self):
+        return aiohttp.TCPConnector(
+            limit=self.max_concurrent_requests * 2,
+            limit_per_host=self.max_concurrent_requests,
+            ttl_dns_cache=self.DNS_CACHE_TTL,
+            keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+        )
+
+    def memo(self, session):
+        """
+        Return the ``SingleFlight`` memo tied to ``session``. A session lives for one run,
+        so lookups memoized here are shared by every stage of that run and dropped with it.
+        """
+        memo = self._memos.get(session)
+        if memo is None:
+            memo = SingleFlight()
+            self._memos[session] = memo
+        return memo
+
+    def add_listener(self, listener):
+        """
+        Register an object to be told about requests made through the pooled async
+        sessions and the client's ``http`` session. Listeners implement any of the hooks passed to ``notify``:
+        ``on_response(method, url, status, elapsed)``, ``on_error(method, url, error, elapsed)``,
+        ``on_bytes_sent(method, url, size)`` and the per-attempt hooks sent by
+        ``ResiliencePolicy``. Listeners are held weakly.
+
+        A listener registered inside an event loop is only told about requests made on that
+        loop, so e.g. an ``AdaptiveLimiter`` never wakes waiters of another thread's loop.
+        """
+        self._listeners[listener] = self._running_loop()
+
+    def remove_listener(self, listener):
+        self._listeners.pop(listener, None)
+
+    @contextmanager
+    def listening(self, listener):
+        """Register ``listener`` for the duration of a run."""
+        self.add_listener(listener)
+        try:
+            yield listener
+        finally:
+            self.remove_listener(listener)
+
+    def notify(self, hook, *args):
+        loop = self._running_loop()
+        for listener, listener_loop in list(self._listeners.items()):
+            if listener_loop is not None and listener_loop is not loop:
+                continue
+            callback = getattr(listener, hook, None)
+            if callback is not None:
+                callback(*args)
+
+    @staticmethod
+    def _running_loop():
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+    @staticmethod
+    def _make_trace_config(borrowers):
+        # The session is shared by the clients of the server which run on this loop, so
+        # requests name the notify of the client which sent them (see ResiliencePolicy.request).
+        # Other requests are reported to every client borrowing the session
+        def notify(ctx, hook, *args):
+            if callable(ctx.trace_request_ctx):
+                ctx.trace_request_ctx(hook, *args)
+                return
+            for client in set(borrowers):
+                client.notify(hook, *args)
+
+        async def on_request_start(session, ctx, params):
+            ctx.start = time.monotonic()
+
+        async def on_request_chunk_sent(session, ctx, params):
+            notify(ctx, 'on_bytes_sent', params.method, params.url.path, len(params.chunk))
+
+        async def on_request_end(session, ctx, params):
+            notify(ctx, 'on_response', params.method, params.url.path, params.response.status,
+                   time.monotonic() - ctx.start)
+
+        async def on_request_exception(session, ctx, params):
+            notify(ctx, 'on_error', params.method, params.url.path, params.exception,
+                   time.monotonic() - ctx.start)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_chunk_sent.append(on_request_chunk_sent)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+    def get_session(self):
+        """
+        Return the pooled ``aiohttp.ClientSession`` for the running event loop.
+        Must be called from inside a coroutine.
+        """
+        loop = asyncio.get_running_loop()
+        entry = self._pool.sessions.get(loop)
+        if entry is None or entry['session'].closed:
+            borrowers = []
+            # aiohttp sets the Content-Type of JSON bodies itself, and a session-wide one cannot be
+            # dropped per request; some endpoints (e.g. /api/dataIntegrity) reject it on a GET
+            headers = {k: v for k, v in self._pool.request_headers.items() if k != 'Content-Type'}
+            session = aiohttp.ClientSession(headers=headers, connector=self._make_connector(),
+                                            trace_configs=[self._make_trace_config(borrowers)])
+            entry = {'session': session, 'users': 0, 'borrowers': borrowers}
+            self._pool.sessions[loop] = entry
+            logging.debug(f"Opened pooled session for {self.base_url} "
+                          f"(limit per host: {self.max_concurrent_requests})")
+        return entry['session']
+
+    @asynccontextmanager
+    async def session(self):
+        """
+        Borrow the pooled session for the duration of a run. The session is closed
+        when the outermost borrower on this loop exits.
+        """
+        session = self.get_session()
+        entry = self._pool.sessions[asyncio.get_running_loop()]
+        entry['users'] += 1
+        entry['borrowers'].append(self)
+        try:
+            yield session
+        finally:
+            entry['users'] -= 1
+            entry['borrowers'].remove(self)
+            if entry['users'] == 0:
+                await self.close_session()
+
+    async def close_session(self):
+        entry = self._pool.sessions.pop(asyncio.get_running_loop(), None)
+        if entry is not None and not entry['session'].closed:
+            await entry['session'].close()
+
+    def close(self):
+        """Close the synchronous pool. Async sessions are closed by their borrowers."""
+        with self._pool.http_lock:
+            if self._pool.adapter is not None:
+                self._pool.adapter.close()
+                self._pool.adapter = None
+            self._http = None
@@ -0,0 +1,181 @@
+import os
+import tempfile
+import time
+from collections import Counter
+
+from app.core.resilience import endpoint_family
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# First path segment under /api -> reported endpoint family
+_FAMILIES = {
+    'dataValueSets': 'dataValueSets',
+    'outlierDetection': 'outlierDetection',
+    'dataAnalysis': 'dataAnalysis/validationRules',
+    'dataIntegrity': 'dataIntegrity',
+    'minMaxDataElements': 'minMaxDataElements',
+    'dataEntry': 'minMaxDataElements',
+}
+
+
+def metrics_family(url):
+    """Endpoint family used to group metrics; anything not listed counts as metadata."""
+    return _FAMILIES.get(endpoint_family(url), 'metadata')
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.status_codes = Counter()
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # Compressed size and matching decoded size, for responses where both are known
+        self.wire_bytes_received = 0
+        self.wire_decoded_bytes = 0
+        self.semaphore_wait_seconds = 0.0
+
+    def observe_latency(self, elapsed):
+        self.latency_sum += elapsed
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                self.latency_buckets[i] += 1
+                break
+
+    def as_dict(self):
+        cumulative, buckets = 0, {}
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        observed = self.requests + self.errors
+        buckets['+Inf'] = observed
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'status_codes': {str(code): n for code, n in sorted(self.status_codes.items())},
+            'latency_seconds': {'count': observed, 'sum': round(self.latency_sum, 3), 'buckets': buckets},
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'wire_bytes_received': self.wire_bytes_received,
+            'compression_ratio': (round(self.wire_decoded_bytes / self.wire_bytes_received, 2)
+                                  if self.wire_bytes_received else None),
+            'semaphore_wait_seconds': round(self.semaphore_wait_seconds, 3),
+        }
+
+
+class HttpMetrics:
+    """
+    Per-endpoint-family request metrics for one run.
+
+    Register with ``Dhis2Client.add_listener``; the client's tracing reports bytes sent and
+    the resilience policy reports each attempt, retry and semaphore wait. Requests of the
+    synchronous helpers are reported by the client's ``http`` session.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._endpoints = {}
+
+    def _endpoint(self, url):
+        family = metrics_family(url)
+        stats = self._endpoints.get(family)
+        if stats is None:
+            stats = EndpointMetrics()
+            self._endpoints[family] = stats
+        return stats
+
+    # --- Listener hooks ---
+    def on_bytes_sent(self, method, url, size):
+        self._endpoint(url).bytes_sent += size
+
+    def on_semaphore_wait(self, method, url, seconds):
+        self._endpoint(url).semaphore_wait_seconds += seconds
+
+    def on_retry(self, method, url):
+        self._endpoint(url).retries += 1
+
+    def on_request_complete(self, method, url, status, elapsed, bytes_received, wire_bytes):
+        stats = self._endpoint(url)
+        stats.requests += 1
+        stats.status_codes[status] += 1
+        stats.observe_latency(elapsed)
+        stats.bytes_received += bytes_received
+        if wire_bytes:
+            stats.wire_bytes_received += wire_bytes
+            stats.wire_decoded_bytes += bytes_received
+
+    def on_request_failed(self, method, url, error, elapsed):
+        stats = self._endpoint(url)
+        stats.errors += 1
+        stats.status_codes[type(error).__name__] += 1
+        stats.observe_latency(elapsed)
+
+    def summary(self):
+        return {family: stats.as_dict() for family, stats in sorted(self._endpoints.items())}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(summary, run=None):
+    """Render an ``HttpMetrics.summary()`` (plus optional run gauges) in Prometheus text format."""
+    prefix = 'dq_workbench_http'
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {prefix}_{name} {help_text}')
+        lines.append(f'# TYPE {prefix}_{name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+            lines.append(f'{prefix}_{name}{{{label_text}}} {value}')
+
+    metric('requests_total', 'counter', 'Requests by endpoint family and status.',
+           [({'endpoint': ep, 'status': status}, n)
+            for ep, stats in summary.items() for status, n in stats['status_codes'].items()])
+    for name, key, help_text in (
+            ('retries_total', 'retries', 'Retried attempts.'),
+            ('bytes_sent_total', 'bytes_sent', 'Request body bytes sent.'),
+            ('bytes_received_total', 'bytes_received', 'Decoded response bytes received.'),
+            ('wire_bytes_received_total', 'wire_bytes_received',
+             'Compressed response bytes, where the size on the wire is known.'),
+            ('semaphore_wait_seconds_total', 'semaphore_wait_seconds',
+             'Time spent waiting for a concurrency slot.')):
+        metric(name, 'counter', help_text, [({'endpoint': ep}, stats[key]) for ep, stats in summary.items()])
+
+    lines.append(f'# HELP {prefix}_request_duration_seconds Request latency by endpoint family.')
+    lines.append(f'# TYPE {prefix}_request_duration_seconds histogram')
+    for ep, stats in summary.items():
+        latency = stats['latency_seconds']
+        for bound, count in latency['buckets'].items():
+            lines.append(f'{prefix}_request_duration_seconds_bucket{{endpoint="{_escape(ep)}",le="{bound}"}} {count}')
+        lines.append(f'{prefix}_request_duration_seconds_sum{{endpoint="{_escape(ep)}"}} {latency["sum"]}')
+        lines.append(f'{prefix}_request_duration_seconds_count{{endpoint="{_escape(ep)}"}} {latency["count"]}')
+
+    for name, value in (run or {}).items():
+        lines.append(f'# TYPE dq_workbench_run_{name} gauge')
+        lines.append(f'dq_workbench_run_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_textfile(path, summary, run=None):
+    """
+    Write metrics for the node_exporter textfile collector. The file is written to a
+    temporary name and renamed so the collector never reads a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.dq_workbench', suffix='.prom.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(format_prometheus(summary, run))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
@@ -0,0 +1,139 @@
+import codecs
+import json
+import re
+
+_WHITESPACE = re.compile(r'\s*')
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class JsonArrayStreamParser:
+    """
+    Incremental parser for a JSON object whose interesting payload is one large
+    top-level array, such as the ``dataValues`` of a DHIS2 dataValueSet.
+
+    Bytes are fed in as they arrive and the elements of ``key`` are returned one at a
+    time, so only the current element and the unparsed tail of the input are held in
+    memory. Other top-level members are small in practice and are collected into
+    ``envelope``.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.envelope = {}
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        # start -> member -> (value | array -> item) -> ... -> end
+        self._state = 'start'
+        self._member = None
+
+    def _skip_whitespace(self):
+        self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+        return self._pos < len(self._buffer)
+
+    def _decode_value(self, final):
+        """
+        Decode one JSON value at the current position. Returns ``(True, value)`` or
+        ``(False, None)`` if more input is needed. A value that ends exactly at the end
+        of the buffer is only accepted on the final call, since a number such as ``12``
+        could still be the start of ``123``.
+        """
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if final:
+                raise
+            return False, None
+        if end >= len(self._buffer) and not final:
+            return False, None
+        self._pos = end
+        return True, value
+
+    def _expect(self, char):
+        if self._buffer[self._pos] != char:
+            raise json.JSONDecodeError(f"Expecting '{char}'", self._buffer, self._pos)
+        self._pos += 1
+
+    def _parse(self, final=False):
+        items = []
+        while self._state != 'end' and self._skip_whitespace():
+            char = self._buffer[self._pos]
+            if self._state == 'start':
+                self._expect('{')
+                self._state = 'member'
+            elif self._state == 'member':
+                if char == ',':
+                    self._pos += 1
+                    continue
+                if char == '}':
+                    self._pos += 1
+                    self._state = 'end'
+                    continue
+                ok, name = self._decode_value(final)
+                if not ok:
+                    break
+                self._member = name
+                self._state = 'colon'
+            elif self._state == 'colon':
+                self._expect(':')
+                self._state = 'array' if self._member == self.key else 'value'
+            elif self._state == 'value':
+                ok, value = self._decode_value(final)
+                if not ok:
+                    break
+                self.envelope[self._member] = value
+                self._state = 'member'
+            elif self._state == 'array':
+                if char != '[':
+                    # Not an array after all; keep it with the envelope
+                    self._state = 'value'
+                    continue
+                self._pos += 1
+                self._state = 'item'
+            elif self._state == 'item':
+                if char == ',':
+                    self._pos += 1
+                    continue
+                if char == ']':
+                    self._pos += 1
+                    self._state = 'member'
+                    continue
+                ok, item = self._decode_value(final)
+                if not ok:
+                    break
+                items.append(item)
+
+        # Drop consumed input so the buffer only holds the unparsed tail
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        return items
+
+    def feed(self, data):
+        """Feed the next chunk of bytes and return the array elements completed by it."""
+        self._buffer += self._text_decoder.decode(data)
+        return self._parse()
+
+    def close(self):
+        """Signal end of input and return any remaining elements. Raises on truncated input."""
+        self._buffer += self._text_decoder.decode(b'', final=True)
+        items = self._parse(final=True)
+        if self._state not in ('end', 'start') or self._buffer.strip():
+            raise json.JSONDecodeError('Unexpected end of JSON input', self._buffer, 0)
+        return items
+
+
+async def iter_json_array(content, key, envelope=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the elements of the top-level array ``key`` from an aiohttp ``StreamReader``
+    (``response.content``) as the body arrives. Other top-level members are written to
+    ``envelope`` if a dict is given.
+    """
+    parser = JsonArrayStreamParser(key)
+    async for chunk in content.iter_chunked(chunk_size):
+        for item in parser.feed(chunk):
+            yield item
+    for item in parser.close():
+        yield item
+    if envelope is not None:
+        envelope.update(parser.envelope)
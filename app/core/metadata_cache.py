@@ -0,0 +1,249 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+
+class MetadataCache:
+    """
+    Persistent, per-server cache of DHIS2 metadata list queries.
+
+    Each distinct query (endpoint, fields, filters) is stored in a SQLite file together
+    with the time it was last synced and the newest ``lastUpdated`` it contained. Fresh
+    entries are served locally. Once an entry is older than the TTL for its object
+    type, only objects with a newer ``lastUpdated`` are requested and merged in. A full
+    refresh is forced after ``full_refresh_after`` seconds so that deleted objects, and
+    changes to nested objects that do not bump the parent's ``lastUpdated``, drop out.
+    """
+    DEFAULT_TTL = 3600
+    DEFAULT_TTLS = {
+        'organisationUnits': 24 * 3600,
+        'organisationUnitGroups': 6 * 3600,
+        'categoryOptionCombos': 24 * 3600,
+        'dataSets': 3600,
+        'dataElements': 3600,
+        'dataElementGroups': 3600,
+        'validationRuleGroups': 3600,
+    }
+    DEFAULT_FULL_REFRESH_AFTER = 7 * 24 * 3600
+    # Files whose schema this process has created
+    _initialised = set()
+    _init_lock = threading.Lock()
+
+    def __init__(self, path, ttls=None, full_refresh_after=None):
+        self.path = Path(path)
+        self.ttls = {**self.DEFAULT_TTLS, **(ttls or {})}
+        self.full_refresh_after = full_refresh_after or self.DEFAULT_FULL_REFRESH_AFTER
+
+    @classmethod
+    def default_directory(cls):
+        return Path.home() / '.cache' / 'dq-workbench' / 'metadata'
+
+    @classmethod
+    def path_for_server(cls, base_url, directory=None):
+        digest = hashlib.sha256(base_url.encode('utf-8')).hexdigest()[:16]
+        return Path(directory or cls.default_directory()) / f'{digest}.sqlite'
+
+    @classmethod
+    def from_config(cls, config):
+        """Build the cache described by ``server.metadata_cache``, or return None if it is disabled."""
+        server = config.get('server', {})
+        settings = server.get('metadata_cache') or {}
+        if settings is True:
+            settings = {'enabled': True}
+        if not settings.get('enabled', False):
+            return None
+        directory = settings.get('path')
+        if directory:
+            directory = os.path.expanduser(directory)
+        return cls(
+            cls.path_for_server(server.get('base_url', ''), directory),
+            ttls=settings.get('ttl'),
+            full_refresh_after=settings.get('full_refresh_after'),
+        )
+
+    # --- Storage ---
+    def _ensure_db(self):
+        # The schema is created on first use rather than when the store is built, as the web
+        # interface builds the stores for every request; once per file and process is enough
+        if self.path in self._initialised:
+            return
+        with self._init_lock:
+            if self.path not in self._initialised:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._init_db()
+                self._initialised.add(self.path)
+
+    def _connect(self):
+        self._ensure_db()
+        return self._open()
+
+    def _open(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _init_db(self):
+        with closing(self._open()) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cached_queries (
+                    query_key TEXT PRIMARY KEY,
+                    endpoint TEXT NOT NULL,
+                    synced_at REAL NOT NULL,
+                    full_synced_at REAL NOT NULL,
+                    max_last_updated TEXT
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS cached_objects (
+                    query_key TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (query_key, id)
+                )""")
+
+    @staticmethod
+    def _split_fields(fields):
+        """Split a fields selector on top-level commas only, e.g. ``id,dataElements[id,code]``."""
+        if not isinstance(fields, str):
+            return list(fields)
+        parts, depth, current = [], 0, ''
+        for ch in fields:
+            if ch == '[':
+                depth += 1
+            elif ch == ']':
+                depth -= 1
+            if ch == ',' and depth == 0:
+                parts.append(current)
+                current = ''
+            else:
+                current += ch
+        if current:
+            parts.append(current)
+        return parts
+
+    @classmethod
+    def cache_fields(cls, fields):
+        """Fields to request so that cached objects can be merged by id and lastUpdated."""
+        fields = cls._split_fields(fields or ['id', 'name'])
+        for required in ('id', 'lastUpdated'):
+            if required not in fields:
+                fields.append(required)
+        return fields
+
+    @staticmethod
+    def _query_key(endpoint, filters, fields, extra_params):
+        extra = {k: v for k, v in (extra_params or {}).items() if k != 'paging'}
+        return json.dumps([endpoint, sorted(fields), sorted(filters or []), extra], sort_keys=True)
+
+    def _load(self, conn, query_key):
+        rows = conn.execute(
+            "SELECT data FROM cached_objects WHERE query_key = ? ORDER BY position", (query_key,)
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    # --- Sync policy ---
+    def plan(self, endpoint, filters=None, fields=None, extra_params=None):
+        """
+        Decide how to satisfy a query. Returns ``(query_key, mode, request_filters)`` where
+        mode is ``'hit'``, ``'delta'`` or ``'full'``.
+        """
+        fields = self.cache_fields(fields)
+        filters = list(filters or [])
+        query_key = self._query_key(endpoint, filters, fields, extra_params)
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT synced_at, full_synced_at, max_last_updated FROM cached_queries WHERE query_key = ?",
+                (query_key,)
+            ).fetchone()
+        if row is None:
+            return query_key, 'full', filters
+
+        synced_at, full_synced_at, max_last_updated = row
+        now = time.time()
+        if now - synced_at < self.ttls.get(endpoint, self.DEFAULT_TTL):
+            return query_key, 'hit', filters
+        if max_last_updated and now - full_synced_at < self.full_refresh_after:
+            return query_key, 'delta', filters + [f'lastUpdated:gt:{max_last_updated}']
+        return query_key, 'full', filters
+
+    def load(self, query_key):
+        with closing(self._connect()) as conn:
+            return self._load(conn, query_key)
+
+    def store(self, query_key, endpoint, mode, objects):
+        """Persist the result of a ``'full'`` or ``'delta'`` fetch and return the merged objects."""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            if mode == 'full':
+                conn.execute("DELETE FROM cached_objects WHERE query_key = ?", (query_key,))
+                start = 0
+                full_synced_at = now
+                max_last_updated = None
+            else:
+                start, full_synced_at, max_last_updated = conn.execute(
+                    "SELECT (SELECT COALESCE(MAX(position) + 1, 0) FROM cached_objects WHERE query_key = ?), "
+                    "full_synced_at, max_last_updated FROM cached_queries WHERE query_key = ?",
+                    (query_key, query_key)
+                ).fetchone()
+
+            for offset, obj in enumerate(objects):
+                last_updated = obj.get('lastUpdated')
+                if last_updated and (max_last_updated is None or last_updated > max_last_updated):
+                    max_last_updated = last_updated
+                existing = conn.execute(
+                    "SELECT position FROM cached_objects WHERE query_key = ? AND id = ?", (query_key, obj['id'])
+                ).fetchone()
+                position = existing[0] if existing else start + offset
+                conn.execute(
+                    "INSERT OR REPLACE INTO cached_objects (query_key, id, position, data) VALUES (?, ?, ?, ?)",
+                    (query_key, obj['id'], position, json.dumps(obj))
+                )
+
+            conn.execute(
+                "INSERT OR REPLACE INTO cached_queries "
+                "(query_key, endpoint, synced_at, full_synced_at, max_last_updated) VALUES (?, ?, ?, ?, ?)",
+                (query_key, endpoint, now, full_synced_at, max_last_updated)
+            )
+            logging.debug(f"Metadata cache {mode} sync for {endpoint}: {len(objects)} objects")
+            return self._load(conn, query_key)
+
+    def get_or_fetch(self, endpoint, fetch, filters=None, fields=None, extra_params=None):
+        """
+        Serve a metadata list query from the cache, calling ``fetch(filters, fields)`` for
+        the objects that need to come from DHIS2.
+        """
+        query_key, mode, request_filters = self.plan(endpoint, filters, fields, extra_params)
+        if mode == 'hit':
+            return self.load(query_key)
+        return self.store(query_key, endpoint, mode, fetch(request_filters, self.cache_fields(fields)))
+
+    async def get_or_fetch_async(self, endpoint, fetch, filters=None, fields=None, extra_params=None):
+        """
+        Async variant of ``get_or_fetch``; ``fetch`` is a coroutine function. The SQLite work
+        runs in a thread, so a large store does not hold up the requests of the event loop.
+        """
+        query_key, mode, request_filters = await asyncio.to_thread(self.plan, endpoint, filters, fields,
+                                                                   extra_params)
+        if mode == 'hit':
+            return await asyncio.to_thread(self.load, query_key)
+        objects = await fetch(request_filters, self.cache_fields(fields))
+        return await asyncio.to_thread(self.store, query_key, endpoint, mode, objects)
+
+    def invalidate(self, endpoint=None):
+        """Drop cached queries for one endpoint, or everything when ``endpoint`` is None."""
+        with closing(self._connect()) as conn, conn:
+            if endpoint is None:
+                conn.execute("DELETE FROM cached_objects")
+                conn.execute("DELETE FROM cached_queries")
+            else:
+                conn.execute(
+                    "DELETE FROM cached_objects WHERE query_key IN "
+                    "(SELECT query_key FROM cached_queries WHERE endpoint = ?)", (endpoint,)
+                )
+                conn.execute("DELETE FROM cached_queries WHERE endpoint = ?", (endpoint,))
+        logging.info(f"Invalidated metadata cache{f' for {endpoint}' if endpoint else ''} at {self.path}")
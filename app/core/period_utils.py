@@ -183,3 +183,60 @@ class Dhis2PeriodUtils:
             return start_date + relativedelta(years=1) - relativedelta(seconds=1)
         else:
             raise ValueError("Unsupported period type")
+
+    @staticmethod
+    def split_date_range(start_date, end_date, duration_string):
+        """
+        Split ``start_date``..``end_date`` into consecutive ``(start, end)`` windows of
+        ``duration_string`` (e.g. '1 year', '6 months'). Boundaries fall on the start of a
+        period of that unit, counted from the calendar: '3 months' windows start in January,
+        April, July and October, '2 years' windows on even years and weeks on Mondays. The
+        first and last window are clipped to the range. Each window ends the day before the
+        next one starts, so a period of the unit or shorter, aligned with it, lies entirely
+        within one window.
+        """
+        amount, unit = duration_string.split(' ')
+        amount = int(amount)
+        unit = unit.rstrip('s')
+        if amount <= 0:
+            raise ValueError(f"Invalid window duration: {duration_string}")
+
+        day = datetime(start_date.year, start_date.month, start_date.day)
+        if unit == 'day':
+            boundary, step = day, relativedelta(days=amount)
+        elif unit == 'week':
+            boundary, step = day - relativedelta(days=day.weekday()), relativedelta(weeks=amount)
+        elif unit in ('month', 'quarter'):
+            months = amount * 3 if unit == 'quarter' else amount
+            index = day.year * 12 + day.month - 1
+            index -= index % months
+            boundary, step = datetime(index // 12, index % 12 + 1, 1), relativedelta(months=months)
+        elif unit == 'year':
+            boundary, step = datetime(day.year - day.year % amount, 1, 1), relativedelta(years=amount)
+        else:
+            raise ValueError(f"Invalid duration unit: {unit}")
+
+        windows = []
+        window_start = start_date
+        while window_start <= end_date:
+            boundary += step
+            windows.append((window_start, min(boundary - relativedelta(days=1), end_date)))
+            window_start = boundary
+        return windows
+
+    def periods_ended_between(self, period_type, since, until):
+        """
+        Periods of ``period_type`` which ended after ``since`` and no later than ``until``,
+        i.e. periods that were still open at ``since`` and are complete at ``until``.
+        """
+        periods = []
+        period = self.get_current_period(period_type, since)
+        while True:
+            end = self.get_end_date_from_period(period)
+            if period_type == 'Daily':
+                end += relativedelta(days=1) - relativedelta(seconds=1)
+            if end > until:
+                return periods
+            if end > since:
+                periods.append(period)
+            period = self.get_current_period(period_type, end + relativedelta(seconds=1))
@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import re
+import secrets
+import time
+from collections import Counter
+from contextlib import asynccontextmanager, nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+from requests.exceptions import RequestException
+from yarl import URL
+
+RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+TRANSIENT_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError)
+COUNTER_NAMES = ('requests', 'retries', 'retry_after_waits', 'gave_up', 'circuit_opened', 'circuit_rejected')
+
+_API_VERSION = re.compile(r'^\d+$')
+
+
+def retry_delay(attempt, backoff_base):
+    """Exponential backoff with a little jitter: ``backoff_base * 2^(attempt-1)`` plus up to 0.2s."""
+    return backoff_base * (2 ** (attempt - 1)) + secrets.randbelow(1000) / 1000.0 * 0.2
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a ``Retry-After`` header (delta-seconds or HTTP-date), or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def endpoint_family(url):
+    """
+    Group a request URL by the first path segment under ``/api``, ignoring an API version,
+    e.g. ``/api/40/dataValueSets.json`` -> ``dataValueSets``.
+    """
+    parts = [p for p in URL(str(url)).path.split('/') if p]
+    if 'api' in parts:
+        parts = parts[parts.index('api') + 1:]
+    if parts and _API_VERSION.match(parts[0]):
+        parts = parts[1:]
+    if not parts:
+        return 'other'
+    return parts[0].split('.', 1)[0]
+
+
+class CircuitOpenError(RequestException):
+    """Raised when an endpoint's circuit breaker is open and the retry budget is used up."""
+
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker. After ``failure_threshold`` consecutive failures the
+    circuit opens and requests are held back for ``reset_timeout`` seconds. A single
+    probe request is then let through: success closes the circuit, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = None
+
+    def before_request(self):
+        """Return 0 if a request may be sent now, otherwise the number of seconds to wait."""
+        if self.state == 'closed':
+            return 0.0
+        now = time.monotonic()
+        remaining = self.opened_at + self.reset_timeout - now
+        if remaining > 0:
+            return remaining
+        # Half-open: allow one probe at a time; a probe that never reported back is abandoned
+        if self.probe_started is None or now - self.probe_started > self.reset_timeout:
+            self.probe_started = now
+            return 0.0
+        return min(1.0, self.reset_timeout)
+
+    def record_success(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.probe_started = None
+
+    def record_failure(self):
+        """Record a failure and return True if it opened the circuit."""
+        self.failures += 1
+        was_open = self.state == 'open'
+        if was_open and self.probe_started is None:
+            # Stragglers sent before the circuit opened
+            return False
+        if was_open or self.failures >= self.failure_threshold:
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.probe_started = None
+            return not was_open
+        return False
+
+
+class ResiliencePolicy:
+    """
+    Retries, ``Retry-After`` handling and per-endpoint circuit breaking for async DHIS2
+    requests. Each run has a policy of its own (see ``Dhis2Client.from_config``), so
+    breaker state carries across the stages of a run but not into other runs.
+
+    Idempotent methods are retried on transient statuses and connection errors using
+    the same jittered exponential schedule as the min/max bulk upload. POSTs are only
+    retried when the caller marks them idempotent (e.g. dataValueSet imports, which
+    are upserts, or read-only analysis requests).
+    """
+    DEFAULT_MAX_ATTEMPTS = 3
+    DEFAULT_BACKOFF_BASE = 0.5
+    DEFAULT_MAX_DELAY = 60.0
+    DEFAULT_FAILURE_THRESHOLD = 5
+    DEFAULT_RESET_TIMEOUT = 30.0
+
+    def __init__(self, max_attempts=None, backoff_base=None, max_delay=None,
+                 failure_threshold=None, reset_timeout=None, notify=None):
+        self.max_attempts = max_attempts or self.DEFAULT_MAX_ATTEMPTS
+        self.backoff_base = backoff_base if backoff_base is not None else self.DEFAULT_BACKOFF_BASE
+        self.max_delay = max_delay or self.DEFAULT_MAX_DELAY
+        self.failure_threshold = failure_threshold or self.DEFAULT_FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout or self.DEFAULT_RESET_TIMEOUT
+        self._breakers = {}
+        self._counts = Counter()
+        # Reports each attempt to the client's listeners, e.g. HttpMetrics
+        self.notify = notify or (lambda hook, *args: None)
+
+    @classmethod
+    def from_config(cls, config, notify=None):
+        server = config.get('server', {})
+        retry = server.get('retry') or {}
+        breaker = server.get('circuit_breaker') or {}
+        return cls(
+            max_attempts=retry.get('max_attempts'),
+            backoff_base=retry.get('backoff_base'),
+            max_delay=retry.get('max_delay'),
+            failure_threshold=breaker.get('failure_threshold'),
+            reset_timeout=breaker.get('reset_timeout'),
+            notify=notify,
+        )
+
+    def breaker(self, endpoint):
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            self._breakers[endpoint] = breaker
+        return breaker
+
+    # --- Counters ---
+    def _count(self, endpoint, name):
+        self._counts[(endpoint, name)] += 1
+
+    def snapshot(self):
+        """Opaque copy of the counters, to pass to ``summary(since=...)``."""
+        return Counter(self._counts)
+
+    def summary(self, since=None):
+        """Totals per counter plus a per-endpoint breakdown, optionally relative to a snapshot."""
+        counts = self._counts - since if since is not None else Counter(self._counts)
+        totals = Counter()
+        by_endpoint = {}
+        for (endpoint, name), value in sorted(counts.items()):
+            totals[name] += value
+            by_endpoint.setdefault(endpoint, {})[name] = value
+        return {**{name: totals[name] for name in COUNTER_NAMES}, 'by_endpoint': by_endpoint}
+
+    # --- Requests ---
+    def _failure(self, breaker, endpoint):
+        if breaker.record_failure():
+            self._count(endpoint, 'circuit_opened')
+            logging.warning(f"Circuit opened for /api/{endpoint} after {breaker.failures} consecutive failures; "
+                            f"holding requests for {breaker.reset_timeout:.0f}s")
+
+    def _report_complete(self, method, url, response, started):
+        content = response.content
+        wire_bytes = None
+        if content.total_bytes and getattr(content, 'total_compressed_bytes', None) is not None:
+            wire_bytes = content.total_compressed_bytes
+        elif response.headers.get('Content-Encoding') and response.headers.get('Content-Length'):
+            wire_bytes = int(response.headers['Content-Length'])
+        self.notify('on_request_complete', method, url, response.status, time.monotonic() - started,
+                    content.total_bytes, wire_bytes)
+
+    @asynccontextmanager
+    async def request(self, session, method, url, semaphore=None, idempotent=None, max_attempts=None,
+                      backoff_base=None, **kwargs):
+        """
+        Send a request and yield the final ``aiohttp.ClientResponse``, retrying transient
+        failures first. The semaphore is held for each attempt but not while backing off.
+        A response that still fails after the last attempt is yielded as is, so callers
+        keep their own status handling.
+        """
+        method = method.upper()
+        endpoint = endpoint_family(url)
+        breaker = self.breaker(endpoint)
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        attempts = (max_attempts or self.max_attempts) if idempotent else 1
+        backoff_base = self.backoff_base if backoff_base is None else backoff_base
+
+        attempt = 0
+        while True:
+            attempt += 1
+            wait = breaker.before_request()
+            if wait:
+                self._count(endpoint, 'circuit_rejected')
+                if attempt >= attempts:
+                    raise CircuitOpenError(f"Circuit open for /api/{endpoint}; {method} {url} not sent")
+                await asyncio.sleep(wait)
+                continue
+
+            delay = None
+            waiting_since = time.monotonic()
+            async with semaphore or nullcontext():
+                started = time.monotonic()
+                self.notify('on_semaphore_wait', method, url, started - waiting_since)
+                self._count(endpoint, 'requests')
+                try:
+                    # Tracing reports the request to this policy's listeners only
+                    response = await session.request(method, url, trace_request_ctx=self.notify, **kwargs)
+                except TRANSIENT_ERRORS as e:
+                    self.notify('on_request_failed', method, url, e, time.monotonic() - started)
+                    self._failure(breaker, endpoint)
+                    if attempt >= attempts:
+                        self._count(endpoint, 'gave_up')
+                        raise
+                    delay = retry_delay(attempt, backoff_base)
+                    logging.warning(f"{method} /api/{endpoint} failed ({type(e).__name__}: {e}); "
+                                    f"retry {attempt}/{attempts - 1} in {delay:.2f}s")
+                else:
+                    async with response:
+                        status = response.status
+                        if status >= 500 or status == 429:
+                            self._failure(breaker, endpoint)
+                        else:
+                            breaker.record_success()
+
+                        if status not in RETRYABLE_STATUSES or attempt >= attempts:
+                            if status in RETRYABLE_STATUSES and attempts > 1:
+                                self._count(endpoint, 'gave_up')
+                            try:
+                                yield response
+                            finally:
+                                self._report_complete(method, url, response, started)
+                            return
+
+                        self._report_complete(method, url, response, started)
+
+                        delay = retry_delay(attempt, backoff_base)
+                        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                        if retry_after is not None:
+                            self._count(endpoint, 'retry_after_waits')
+                            delay = max(delay, retry_after)
+                        delay = min(delay, self.max_delay)
+                        logging.warning(f"{method} /api/{endpoint} returned {status}; "
+                                        f"retry {attempt}/{attempts - 1} in {delay:.2f}s")
+
+            self._count(endpoint, 'retries')
+            self.notify('on_retry', method, url)
+            await asyncio.sleep(delay)
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import logging
+
+from app.core.api_utils import Dhis2ApiUtils
+
+
+class ResultPoster:
+    """
+    Posts the results of a run to DHIS2 while the stages are still analysing.
+
+    Stage results are added as they become available. Upserts (grouped by destination
+    dataset) and deletions are buffered and cut into chunks of at most ``batch_size`` values
+    and about ``batch_bytes`` bytes of JSON. A chunk is posted in the background as soon as it
+    is full or the results are flushed. Chunks are posted concurrently under ``semaphore`` and
+    retried on their own, so a failed chunk only loses its own values. With ``async_import``,
+    chunks are submitted as DHIS2 import jobs and their summaries collected once the jobs
+    finish. With a ``progress`` (``RunProgress``), acknowledged chunks are recorded and not
+    posted again when the run is resumed. ``close()`` posts whatever is left and waits for
+    every import to finish.
+
+    ``upserts`` and ``deletes`` count the values of the chunks DHIS2 accepted, and
+    ``failed_upserts`` and ``failed_deletes`` those of the chunks it did not.
+    """
+
+    DEFAULT_BATCH_SIZE = 5000
+    DEFAULT_BATCH_BYTES = 5 * 1024 * 1024
+
+    def __init__(self, api_utils, session, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES,
+                 semaphore=None, async_import=False, progress=None):
+        self.api_utils = api_utils
+        self.session = session
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.semaphore = semaphore
+        self.async_import = async_import
+        self.progress = progress
+        self.errors = []
+        self.upserts = 0
+        self.deletes = 0
+        self.failed_upserts = 0
+        self.failed_deletes = 0
+        self._buffers = {}  # (import strategy, dataset) -> (data values, their estimated size)
+        self._summaries = []
+        self._tasks = []
+
+    def add(self, result):
+        """Buffer the data values, deletions and dataValueSet payload of a (partial) stage result."""
+        # Taken out of the result, so the values are not held until the end of the run
+        for dv in result.pop('dataValues', []):
+            self._buffer(('UPSERT', dv.pop('_dataset', None)), dv)
+        for dv in result.pop('deletions', []):
+            self._buffer(('DELETE', None), dv)
+        if result.get('dataValueSet'):
+            payload = result.pop('dataValueSet')
+            header = {k: v for k, v in payload.items() if k != 'dataValues'}
+            for chunk in self.chunks(payload.get('dataValues', []), self.batch_size, self.batch_bytes):
+                self._start('UPSERT', {**header, 'dataValues': chunk})
+
+    def flush(self):
+        """Start posting everything buffered so far."""
+        for key in list(self._buffers):
+            self._post_buffer(key)
+
+    async def close(self):
+        """
+        Post what is left, wait for all imports and return their merged import summary.
+        """
+        self.flush()
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+        return self.merge_import_summaries(*self._summaries)
+
+    @staticmethod
+    def estimate_size(dv):
+        """Bytes ``dv`` adds to a JSON request body, including the separator."""
+        return len(json.dumps(dv).encode('utf-8')) + 2
+
+    @classmethod
+    def chunks(cls, values, batch_size, batch_bytes):
+        """Split ``values`` into lists of at most ``batch_size`` values and about ``batch_bytes`` bytes."""
+        chunk, size = [], 0
+        for dv in values:
+            dv_size = cls.estimate_size(dv)
+            if chunk and (len(chunk) >= batch_size or size + dv_size > batch_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(dv)
+            size += dv_size
+        if chunk:
+            yield chunk
+
+    def _buffer(self, key, dv):
+        dv_size = self.estimate_size(dv)
+        values, size = self._buffers.get(key, ([], 0))
+        if values and size + dv_size > self.batch_bytes:
+            self._post_buffer(key)
+            values, size = [], 0
+        values.append(dv)
+        self._buffers[key] = (values, size + dv_size)
+        if len(values) >= self.batch_size:
+            self._post_buffer(key)
+
+    def _post_buffer(self, key):
+        values, _ = self._buffers.pop(key)
+        payload = {'dataValues': values}
+        if key[1]:
+            payload['dataSet'] = key[1]
+        self._start(key[0], payload)
+
+    def _start(self, strategy, payload):
+        self._tasks.append(asyncio.create_task(self._post(strategy, payload)))
+
+    async def _post(self, strategy, payload):
+        num_values = len(payload.get('dataValues', []))
+        deleting = strategy == 'DELETE'
+        if self.progress is not None and await asyncio.to_thread(self.progress.is_acknowledged, [strategy, payload]):
+            logging.info(f"Skipping {num_values} data values which were posted before the run was interrupted")
+            self._count(deleting, num_values, accepted=True)
+            return
+        logging.info(f"Posting {num_values} data value {'deletes' if deleting else 'upserts'}"
+                     + (f" (dataSet={payload['dataSet']})" if payload.get('dataSet') else ''))
+        try:
+            # The requests are retried on their own by the client's resilience policy
+            post = self.api_utils.import_data_value_set_async if self.async_import \
+                else self.api_utils.post_data_value_set
+            response = await post(payload, self.session, {'importStrategy': 'DELETE'} if deleting else None,
+                                  semaphore=self.semaphore)
+        except Exception as e:
+            logging.error(f"Error {'deleting' if deleting else 'posting'} a chunk of {num_values} data values: {e}")
+            self.errors.append(f"{'Delete' if deleting else 'Post'} failed for {num_values} data values: {e}")
+            self._count(deleting, num_values, accepted=False)
+            return
+        summary = Dhis2ApiUtils.parse_import_summary(response)
+        self._summaries.append(summary)
+        # A WARNING import stored the values it did not report as conflicts
+        if summary.get('status') not in ('OK', 'WARNING'):
+            self.errors.append(f"{'Delete' if deleting else 'Import'} of {num_values} data values ended with "
+                               f"status {summary.get('status')}")
+            self._count(deleting, num_values, accepted=False)
+            return
+        self._count(deleting, num_values, accepted=True)
+        if self.progress is not None:
+            await asyncio.to_thread(self.progress.acknowledge, [strategy, payload])
+
+    def _count(self, deleting, num_values, accepted):
+        if deleting:
+            if accepted:
+                self.deletes += num_values
+            else:
+                self.failed_deletes += num_values
+        elif accepted:
+            self.upserts += num_values
+        else:
+            self.failed_upserts += num_values
+
+    @staticmethod
+    def merge_import_summaries(*summaries):
+        combined = {"imported": 0, "updated": 0, "deleted": 0, "ignored": 0, "status": "OK"}
+        for s in summaries:
+            if not s:
+                continue
+            combined["imported"] += s.get("imported", 0)
+            combined["updated"] += s.get("updated", 0)
+            combined["deleted"] += s.get("deleted", 0)
+            combined["ignored"] += s.get("ignored", 0)
+            if s.get("status") != "OK":
+                combined["status"] = s.get("status")
+        return combined
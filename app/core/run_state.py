@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+
+
+class RunStateStore:
+    """
+    Persistent, per-server progress of the runs in flight, so an interrupted run can resume.
+
+    Progress is kept per scope (e.g. the analyzer stages of a configuration, or one min/max
+    stage): the outputs of the units of work which completed, and the upload chunks DHIS2
+    acknowledged. A scope is forgotten once its run finishes without errors. Resuming is only
+    possible while the configuration the run was started with is unchanged.
+
+    The store commits synchronously, so async callers use it through ``asyncio.to_thread``.
+    """
+    # Files whose schema this process has created
+    _initialised = set()
+    _init_lock = threading.Lock()
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    @classmethod
+    def default_directory(cls):
+        return Path.home() / '.cache' / 'dq-workbench' / 'runs'
+
+    @classmethod
+    def path_for_server(cls, base_url, directory=None):
+        digest = hashlib.sha256(base_url.encode('utf-8')).hexdigest()[:16]
+        return Path(directory or cls.default_directory()) / f'{digest}.sqlite'
+
+    @classmethod
+    def from_config(cls, config, enabled_by_default=False):
+        """Build the store described by ``server.run_state``, or return None if it is disabled."""
+        server = config.get('server', {})
+        settings = server.get('run_state')
+        if settings is None:
+            settings = {'enabled': enabled_by_default}
+        elif isinstance(settings, bool):
+            settings = {'enabled': settings}
+        if not settings.get('enabled', True):
+            return None
+        directory = settings.get('path')
+        if directory:
+            directory = os.path.expanduser(directory)
+        return cls(cls.path_for_server(server.get('base_url', ''), directory))
+
+    @staticmethod
+    def fingerprint(value):
+        """Hash of a JSON-serialisable value, e.g. the stages a run was started with."""
+        payload = json.dumps(value, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    # --- Storage ---
+    def _ensure_db(self):
+        # Like MetadataCache, create the schema once per file and process, on first use
+        if self.path in self._initialised:
+            return
+        with self._init_lock:
+            if self.path not in self._initialised:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._init_db()
+                self._initialised.add(self.path)
+
+    def _connect(self):
+        self._ensure_db()
+        return self._open()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        # Progress is written once per request and chunk; with the write-ahead log a commit
+        # does not need to wait for the disk
+        conn.execute("PRAGMA synchronous = NORMAL")
+        return conn
+
+    def _init_db(self):
+        with closing(self._open()) as conn:
+            conn.execute("PRAGMA journal_mode = WAL")
+        with closing(self._open()) as conn, conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    scope TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    started_at REAL NOT NULL
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS completed_units (
+                    scope TEXT NOT NULL,
+                    unit_key TEXT NOT NULL,
+                    output TEXT NOT NULL,
+                    PRIMARY KEY (scope, unit_key)
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS acknowledged_chunks (
+                    scope TEXT NOT NULL,
+                    chunk_key TEXT NOT NULL,
+                    PRIMARY KEY (scope, chunk_key)
+                )""")
+
+    def begin(self, scope, fingerprint, resume=False):
+        """
+        Start a run of ``scope`` and return its ``RunProgress``. With ``resume``, the progress of
+        an interrupted run with the same ``fingerprint`` is kept; otherwise it is discarded.
+        """
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute("SELECT fingerprint, started_at FROM runs WHERE scope = ?", (scope,)).fetchone()
+            if resume and row is not None and row[0] == fingerprint:
+                units = conn.execute("SELECT COUNT(*) FROM completed_units WHERE scope = ?", (scope,)).fetchone()[0]
+                logging.info(f"Resuming the run of {scope} started at {time.ctime(row[1])}: "
+                             f"{units} units of work are already done")
+                return RunProgress(self, scope, resumed=True)
+            if resume:
+                logging.warning(f"There is no interrupted run of {scope} with this configuration to resume, "
+                                f"starting from scratch")
+            self._delete(conn, scope)
+            conn.execute("INSERT INTO runs (scope, fingerprint, started_at) VALUES (?, ?, ?)",
+                         (scope, fingerprint, time.time()))
+        return RunProgress(self, scope, resumed=False)
+
+    def finish(self, scope):
+        """Forget the progress of ``scope`` once its run completed."""
+        with closing(self._connect()) as conn, conn:
+            self._delete(conn, scope)
+
+    @staticmethod
+    def _delete(conn, scope):
+        for table in ('runs', 'completed_units', 'acknowledged_chunks'):
+            conn.execute(f"DELETE FROM {table} WHERE scope = ?", (scope,))
+
+    def get_unit(self, scope, unit_key):
+        """The output saved for a completed unit of work, or None."""
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT output FROM completed_units WHERE scope = ? AND unit_key = ?",
+                               (scope, unit_key)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def save_unit(self, scope, unit_key, output):
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO completed_units (scope, unit_key, output) VALUES (?, ?, ?)",
+                         (scope, unit_key, json.dumps(output)))
+
+    def is_acknowledged(self, scope, payload):
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT 1 FROM acknowledged_chunks WHERE scope = ? AND chunk_key = ?",
+                                (scope, self.fingerprint(payload))).fetchone() is not None
+
+    def acknowledge(self, scope, payload):
+        """Record that DHIS2 accepted the upload of ``payload``."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR IGNORE INTO acknowledged_chunks (scope, chunk_key) VALUES (?, ?)",
+                         (scope, self.fingerprint(payload)))
+
+
+class RunProgress:
+    """The progress of the run of one scope of a ``RunStateStore``."""
+
+    def __init__(self, store, scope, resumed=False):
+        self.store = store
+        self.scope = scope
+        self.resumed = resumed
+
+    def get_unit(self, unit_key):
+        return self.store.get_unit(self.scope, unit_key)
+
+    def save_unit(self, unit_key, output):
+        self.store.save_unit(self.scope, unit_key, output)
+
+    def is_acknowledged(self, payload):
+        return self.store.is_acknowledged(self.scope, payload)
+
+    def acknowledge(self, payload):
+        self.store.acknowledge(self.scope, payload)
+
+    def finish(self):
+        self.store.finish(self.scope)
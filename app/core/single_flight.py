@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+
+class SingleFlight:
+    """
+    Run-scoped memo for async lookups.
+
+    The first caller for a key starts the lookup; callers that arrive while it is in
+    flight await the same task, and later callers get the stored result. Failures are
+    not memoized, so the next caller tries again. A caller that is cancelled does not
+    cancel the shared lookup for the others. A result fetched for a known number of
+    callers (``uses``) is dropped once they all have it, so large results are not held
+    for the rest of the run.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self._remaining_uses = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def do(self, key, factory, uses=None):
+        """
+        Return the result for ``key``, calling ``factory()`` (a coroutine function) at most once.
+        With ``uses``, the result is forgotten after that many callers asked for it.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda t, k=key: self._forget_failure(k, t))
+            self._tasks[key] = task
+            if uses is not None:
+                self._remaining_uses[key] = uses
+        else:
+            self.hits += 1
+            logging.debug(f"Reusing in-flight or memoized result for {key}")
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._use(key, task)
+
+    def _use(self, key, task):
+        remaining = self._remaining_uses.get(key)
+        if remaining is None or self._tasks.get(key) is not task:
+            return
+        if remaining <= 1:
+            del self._remaining_uses[key]
+            del self._tasks[key]
+        else:
+            self._remaining_uses[key] = remaining - 1
+
+    def _forget_failure(self, key, task):
+        if (task.cancelled() or task.exception() is not None) and self._tasks.get(key) is task:
+            del self._tasks[key]
+            self._remaining_uses.pop(key, None)
+
+    def forget(self, key):
+        """Drop the result for ``key``, e.g. once no caller which could still want it is left."""
+        self._tasks.pop(key, None)
+        self._remaining_uses.pop(key, None)
+
+    def clear(self):
+        self._tasks.clear()
+        self._remaining_uses.clear()
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from datetime import datetime
+
+from app.core.concurrency import create_limiter
+from app.core.http_metrics import HttpMetrics
+from app.minmax.min_max_factory import MinMaxFactory
+
+
+class Coordinator:
+    """
+    Runs the stages of a configuration on a pool of ``Worker`` processes.
+
+    The stages are expanded into work units and queued in a ``WorkQueue``: each outlier and
+    validation rule stage is split into groups of whole sibling sets of org units at the stage's
+    level (or chunks of its ``organisation_unit`` list) of about ``org_units_per_unit`` org
+    units; the integrity stages are one unit, sharing their summary job; each dataset of a
+    min/max stage is a unit. The coordinator collects the results as the workers finish the
+    units and posts them, so only the coordinator writes to DHIS2.
+
+    Distributed runs always analyse the whole duration: the checkpoints of incremental runs
+    are neither used nor saved.
+
+    Units whose lease runs out are handed back to the queue. The units still outstanding are
+    given up, and reported as errors, once the run has taken ``run_timeout`` seconds, or when
+    ``workers_failed()`` (e.g. a check of the coordinator's own worker processes) returns a
+    reason why no worker is left to run them.
+    """
+    DEFAULT_ORG_UNITS_PER_UNIT = 20
+    DEFAULT_POLL_INTERVAL = 1.0
+    DEFAULT_RUN_TIMEOUT = 12 * 3600
+
+    def __init__(self, monitor, queue, include_min_max=False, poll_interval=DEFAULT_POLL_INTERVAL,
+                 workers_failed=None):
+        self.monitor = monitor
+        self.config = monitor.config
+        self.queue = queue
+        self.include_min_max = include_min_max
+        self.poll_interval = poll_interval
+        self.workers_failed = workers_failed
+        settings = self.config['server'].get('distributed') or {}
+        self.org_units_per_unit = max(1, int(settings.get('org_units_per_unit', self.DEFAULT_ORG_UNITS_PER_UNIT)))
+        self.run_timeout = settings.get('run_timeout', self.DEFAULT_RUN_TIMEOUT)
+
+    async def plan_units(self, session, semaphore):
+        """The ``(kind, payload)`` work units of the configured stages."""
+        units = []
+        integrity_stages = []
+        for stage in self.config['analyzer_stages']:
+            if stage.get('type') == 'integrity_checks':
+                integrity_stages.append(stage)
+                continue
+            scopes = await self._org_unit_scopes(stage, session, semaphore)
+            for index, scope in enumerate(scopes, start=1):
+                units.append(('stage', {
+                    'label': f"stage '{stage['name']}' (part {index} of {len(scopes)})",
+                    'stage': {**stage, **scope, 'params': {**stage['params'], 'incremental': False}},
+                }))
+        if integrity_stages:
+            units.append(('integrity', {'label': f'{len(integrity_stages)} integrity stages',
+                                        'stages': integrity_stages}))
+        if self.include_min_max:
+            for stage in self.config.get('min_max_stages', []):
+                units.extend(('min_max', {'label': f"min/max stage '{stage['name']}' (dataset {dataset})",
+                                          'stage': {**stage, 'datasets': [dataset]}})
+                             for dataset in stage.get('datasets', []))
+        return units
+
+    async def _org_unit_scopes(self, stage, session, semaphore):
+        """The parts a stage is split into, as overrides of its org unit selection."""
+        organisation_unit = stage.get('organisation_unit')
+        size = self.org_units_per_unit
+        if isinstance(organisation_unit, list):
+            return [{'organisation_unit': organisation_unit[i:i + size]}
+                    for i in range(0, len(organisation_unit), size)]
+        level = stage['params'].get('level')
+        if level is None:
+            return [{}]
+
+        # Siblings stay together, so the analyzers can still send them in one request
+        siblings = Counter(
+            (await self.monitor.api_utils.get_organisation_unit_parents(level, session, semaphore)).values()
+        )
+        scopes, parents, count = [], [], 0
+        for parent, num_children in siblings.items():
+            if parents and count + num_children > size:
+                scopes.append({'organisation_unit_parents': parents})
+                parents, count = [], 0
+            parents.append(parent)
+            count += num_children
+        if parents:
+            scopes.append({'organisation_unit_parents': parents})
+        return scopes or [{}]
+
+    async def run(self):
+        """Queue the units of the run, post their results as they arrive and return the run result."""
+        client = self.monitor.client
+        semaphore = create_limiter(self.config, client)
+        resilience_before = client.resilience.snapshot()
+        http_metrics = HttpMetrics()
+        with client.listening(http_metrics):
+            async with client.session() as session:
+                clock_start = datetime.now()
+                errors = []
+                units = await self.plan_units(session, semaphore)
+                min_max = MinMaxFactory(self.config, self.monitor.api_utils)
+                if any(kind == 'min_max' for kind, _ in units) \
+                        and not await min_max._check_can_upload_minmax_async(session, semaphore):
+                    errors.append("User does not have permission to upload min/max values")
+                    units = [(kind, payload) for kind, payload in units if kind != 'min_max']
+
+                run_id = await asyncio.to_thread(self.queue.create_run, units)
+                poster = self.monitor.result_poster(session, semaphore)
+                min_max_summary = Counter()
+                uploads = []
+                failed = 0
+                started = time.monotonic()
+                try:
+                    while True:
+                        # Everything counted as finished here is returned by the collect below
+                        outstanding = await asyncio.to_thread(self.queue.outstanding, run_id)
+                        for unit in await asyncio.to_thread(self.queue.collect, run_id):
+                            label = unit['payload'].get('label', unit['kind'])
+                            if unit['status'] == 'failed':
+                                failed += 1
+                                errors.append(f"Work unit {label} failed: {unit['error']}")
+                            elif unit['kind'] == 'min_max':
+                                min_max_summary.update(unit['result']['summary'])
+                                uploads.extend(asyncio.create_task(min_max.upload_payload(payload, session, semaphore))
+                                               for payload in unit['result']['payloads'])
+                            else:
+                                results = unit['result'] if unit['kind'] == 'integrity' else [unit['result']]
+                                self._add_results(unit['payload'], results, poster, errors)
+                        if not outstanding:
+                            break
+                        reason = self._give_up_reason(started)
+                        if reason:
+                            logging.error(f"Giving up the {outstanding} outstanding work units: {reason}")
+                            await asyncio.to_thread(self.queue.abandon, run_id, reason)
+                            continue
+                        await asyncio.to_thread(self.queue.expire)
+                        await asyncio.sleep(self.poll_interval)
+
+                    import_summary = await poster.close()
+                    errors.extend(poster.errors)
+                    for response in await asyncio.gather(*uploads, return_exceptions=True):
+                        if isinstance(response, Exception):
+                            errors.append(f"Min/max upload failed: {response}")
+                finally:
+                    await asyncio.to_thread(self.queue.finish_run, run_id)
+                min_max_summary.update(min_max.result_tracker.get_summary())
+
+                clock_end = datetime.now()
+                logging.info(f"Distributed run of {len(units)} work units took: {clock_end - clock_start}")
+
+        result = self.monitor.run_result(errors, poster.upserts, poster.deletes, import_summary, clock_start,
+                                         clock_end, resilience_before, http_metrics, poster.failed_upserts,
+                                         poster.failed_deletes)
+        result['work_units'] = {'total': len(units), 'failed': failed}
+        if self.include_min_max:
+            result['min_max'] = dict(min_max_summary)
+        return result
+
+    def _give_up_reason(self, started):
+        if self.workers_failed is not None:
+            reason = self.workers_failed()
+            if reason:
+                return reason
+        if self.run_timeout and time.monotonic() - started > self.run_timeout:
+            return f"The run did not finish within {self.run_timeout} seconds"
+        return None
+
+    @staticmethod
+    def _add_results(payload, results, poster, errors):
+        stages = payload['stages'] if 'stages' in payload else [payload['stage']]
+        for stage, result in zip(stages, results):
+            if isinstance(result, dict):
+                errors.extend(result.get('errors', []))
+                poster.add(result)
+            else:
+                errors.append(f"Stage '{stage['name']}' did not produce a result")
+        poster.flush()
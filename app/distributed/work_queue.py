@@ -0,0 +1,164 @@
+import json
+import logging
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+from pathlib import Path
+
+
+class WorkQueue:
+    """
+    A queue of work units shared by a coordinator and its workers, kept in a SQLite file.
+
+    The file may be on storage shared by several hosts, as long as it supports file locks.
+    The coordinator adds the units of a run and collects them as they finish. Workers claim
+    one unit at a time for ``lease_seconds``. A unit whose worker does not report back within
+    its lease is handed out again, up to ``max_attempts`` times. A unit which fails is retried
+    by another claim the same way.
+    """
+    DEFAULT_LEASE_SECONDS = 1800
+    DEFAULT_MAX_ATTEMPTS = 3
+
+    def __init__(self, path, lease_seconds=None, max_attempts=None):
+        self.path = Path(path)
+        self.lease_seconds = lease_seconds or self.DEFAULT_LEASE_SECONDS
+        self.max_attempts = max_attempts or self.DEFAULT_MAX_ATTEMPTS
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._init_db()
+
+    @classmethod
+    def from_config(cls, path, config):
+        settings = config.get('server', {}).get('distributed') or {}
+        return cls(path, lease_seconds=settings.get('lease_seconds'), max_attempts=settings.get('max_attempts'))
+
+    # --- Storage ---
+    def _connect(self):
+        # Claims take a write lock up front, so two workers never claim the same unit
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def _init_db(self):
+        with closing(self._connect()) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS work_units (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    run_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    claimed_at REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    collected INTEGER NOT NULL DEFAULT 0
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS work_units_status ON work_units (status, id)")
+
+    def _transaction(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    # --- Coordinator ---
+    def create_run(self, units):
+        """Queue ``units`` (``(kind, payload)`` pairs) as a new run and return its id."""
+        run_id = uuid.uuid4().hex
+        with closing(self._connect()) as conn:
+            self._transaction(conn)
+            conn.executemany("INSERT INTO work_units (run_id, kind, payload) VALUES (?, ?, ?)",
+                             [(run_id, kind, json.dumps(payload)) for kind, payload in units])
+            conn.execute("COMMIT")
+        logging.info(f"Queued {len(units)} work units for run {run_id} in {self.path}")
+        return run_id
+
+    def collect(self, run_id):
+        """
+        The units of ``run_id`` which finished since the last call, as dicts with ``kind``,
+        ``payload``, ``status`` (``done`` or ``failed``), ``result`` and ``error``.
+        """
+        with closing(self._connect()) as conn:
+            self._transaction(conn)
+            rows = conn.execute(
+                "SELECT id, kind, payload, status, result, error FROM work_units "
+                "WHERE run_id = ? AND status IN ('done', 'failed') AND collected = 0 ORDER BY id", (run_id,)
+            ).fetchall()
+            conn.executemany("UPDATE work_units SET collected = 1 WHERE id = ?", [(row[0],) for row in rows])
+            conn.execute("COMMIT")
+        return [{'id': row[0], 'kind': row[1], 'payload': json.loads(row[2]), 'status': row[3],
+                 'result': json.loads(row[4]) if row[4] is not None else None, 'error': row[5]} for row in rows]
+
+    def outstanding(self, run_id):
+        """Number of units of ``run_id`` which have not finished yet."""
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM work_units WHERE run_id = ? AND status IN ('pending', 'claimed')",
+                                (run_id,)).fetchone()[0]
+
+    def expire(self):
+        """Hand back the units whose lease ran out, giving up those on their last attempt."""
+        with closing(self._connect()) as conn:
+            self._transaction(conn)
+            expired = time.time() - self.lease_seconds
+            self._expire(conn, expired)
+            conn.execute("UPDATE work_units SET status = 'pending', worker = NULL "
+                         "WHERE status = 'claimed' AND claimed_at < ?", (expired,))
+            conn.execute("COMMIT")
+
+    def abandon(self, run_id, reason):
+        """Fail every unfinished unit of ``run_id``, e.g. when no worker is left to run them."""
+        with closing(self._connect()) as conn:
+            self._transaction(conn)
+            conn.execute("UPDATE work_units SET status = 'failed', error = ? "
+                         "WHERE run_id = ? AND status IN ('pending', 'claimed')", (reason, run_id))
+            conn.execute("COMMIT")
+
+    def finish_run(self, run_id):
+        """Drop the units of a run once the coordinator has collected them."""
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM work_units WHERE run_id = ?", (run_id,))
+
+    # --- Workers ---
+    def claim(self, worker):
+        """Claim the next unit for ``worker``: a dict with ``id``, ``kind`` and ``payload``, or None."""
+        now = time.time()
+        expired = now - self.lease_seconds
+        with closing(self._connect()) as conn:
+            self._transaction(conn)
+            self._expire(conn, expired)
+            row = conn.execute(
+                "SELECT id, kind, payload FROM work_units "
+                "WHERE status = 'pending' OR (status = 'claimed' AND claimed_at < ?) ORDER BY id LIMIT 1",
+                (expired,)
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE work_units SET status = 'claimed', worker = ?, claimed_at = ?, "
+                             "attempts = attempts + 1 WHERE id = ?", (worker, now, row[0]))
+            conn.execute("COMMIT")
+        if row is None:
+            return None
+        return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2])}
+
+    def complete(self, unit_id, worker, result):
+        """Report the result of a claimed unit. Ignored if the lease went to another worker."""
+        self._finish(unit_id, worker, "status = 'done', result = ?", (json.dumps(result, default=str),))
+
+    def fail(self, unit_id, worker, error):
+        """Report a failed unit, which is queued again until it has used up its attempts."""
+        self._finish(unit_id, worker,
+                     "status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?",
+                     (self.max_attempts, str(error)))
+
+    def _expire(self, conn, expired):
+        # Units whose worker went away are given up after their last attempt
+        conn.execute("UPDATE work_units SET status = 'failed', error = 'No worker finished the unit "
+                     "within its lease' WHERE status = 'claimed' AND claimed_at < ? AND attempts >= ?",
+                     (expired, self.max_attempts))
+
+    def _finish(self, unit_id, worker, assignments, values):
+        with closing(self._connect()) as conn:
+            self._transaction(conn)
+            updated = conn.execute(f"UPDATE work_units SET {assignments} "
+                                   f"WHERE id = ? AND worker = ? AND status = 'claimed'",
+                                   (*values, unit_id, worker)).rowcount
+            conn.execute("COMMIT")
+        if not updated:
+            logging.warning(f"Work unit {unit_id} was handed to another worker before {worker} finished it")
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+
+from app.core.concurrency import create_limiter
+from app.minmax.min_max_factory import MinMaxFactory
+
+
+class Worker:
+    """
+    Claims work units from a ``WorkQueue``, runs them and reports their results.
+
+    A unit is an analyzer stage restricted to a part of the org unit hierarchy, the integrity
+    stages, or the min/max values of one dataset. The worker only analyses: posting the results
+    is left to the coordinator. ``units_per_worker`` units run at a time, sharing the session
+    and request limiter. The worker stops once the queue has been empty for ``idle_timeout``
+    seconds (None to keep waiting for work).
+    """
+    DEFAULT_POLL_INTERVAL = 1.0
+    DEFAULT_IDLE_TIMEOUT = 300
+
+    def __init__(self, monitor, queue, name=None, poll_interval=DEFAULT_POLL_INTERVAL,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.monitor = monitor
+        self.queue = queue
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll_interval = poll_interval
+        self.idle_timeout = idle_timeout
+        settings = monitor.config['server'].get('distributed') or {}
+        self.units_per_worker = max(1, int(settings.get('units_per_worker', 1)))
+        self._idle_since = None
+
+    async def run(self):
+        """Run units until the queue stays empty, and return how many were run."""
+        client = self.monitor.client
+        semaphore = create_limiter(self.monitor.config, client)
+        self._idle_since = time.monotonic()
+        logging.info(f"Worker {self.name} waiting for work in {self.queue.path}")
+        async with client.session() as session:
+            counts = await asyncio.gather(*[self._run_units(session, semaphore)
+                                            for _ in range(self.units_per_worker)])
+        logging.info(f"Worker {self.name} ran {sum(counts)} work units")
+        return sum(counts)
+
+    async def _run_units(self, session, semaphore):
+        count = 0
+        while True:
+            unit = await asyncio.to_thread(self.queue.claim, self.name)
+            if unit is None:
+                if self.idle_timeout is not None and time.monotonic() - self._idle_since >= self.idle_timeout:
+                    return count
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            logging.info(f"Worker {self.name} running {unit['payload'].get('label', unit['kind'])}")
+            try:
+                result = await self.execute(unit, session, semaphore)
+            except Exception as e:
+                logging.error(f"Work unit {unit['id']} failed: {e}")
+                await asyncio.to_thread(self.queue.fail, unit['id'], self.name, e)
+            else:
+                await asyncio.to_thread(self.queue.complete, unit['id'], self.name, result)
+            count += 1
+            self._idle_since = time.monotonic()
+
+    async def execute(self, unit, session, semaphore):
+        """Run one unit and return its JSON-serialisable result."""
+        payload = unit['payload']
+        if unit['kind'] == 'stage':
+            stage = payload['stage']
+            result = await self.monitor.analyzers[stage['type']].run_stage(stage, session, semaphore)
+            # The analyzers log and swallow their errors, returning an empty list instead
+            if not isinstance(result, dict):
+                raise RuntimeError(f"Stage '{stage['name']}' did not produce a result")
+            result.pop('checkpoint', None)
+            return result
+        if unit['kind'] == 'integrity':
+            return await self.monitor.analyzers['integrity_checks'].run_stages(payload['stages'], session, semaphore)
+        if unit['kind'] == 'min_max':
+            # A factory per unit, so its tracker only counts this unit's values
+            factory = MinMaxFactory(self.monitor.config, self.monitor.api_utils)
+            prepared_stages = await factory.prepare_stage_async(payload['stage'], session, semaphore)
+            payloads = [await factory.compute_payload(prepared_stage, session, semaphore)
+                        for prepared_stage in prepared_stages]
+            return {'payloads': payloads, 'summary': factory.result_tracker.get_summary()}
+        raise ValueError(f"Unsupported work unit kind: {unit['kind']}")
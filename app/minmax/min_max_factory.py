@@ -2,15 +2,17 @@ import asyncio
 import logging
 import math
 import random
-import secrets
 import statistics
 from collections import defaultdict
+from datetime import date
 from typing import List, Iterable
 
 import pandas as pd
 from requests import RequestException
 
 from app.core.api_utils import Dhis2ApiUtils
+from app.core.json_stream import iter_json_array
+from app.core.resilience import retry_delay
 from app.core.numeric_value_types import NumericValueType
 from app.core.period_utils import Dhis2PeriodUtils
 from app.minmax.min_max_results_tracker import ResultTracker
@@ -24,16 +26,20 @@ from app.minmax.min_max_statistics import (
 class MinMaxFactory:
     MAX_INT_32 = 2_147_483_647
 
-    def __init__(self, config):
+    def __init__(self, config, api_utils=None, run_state=None, resume=False):
         self.config = config
         self.base_url = config.get('server').get('base_url', '')
         self.d2_token = config.get('server').get('d2_token', '')
         self.default_coc = config['server'].get('default_coc', 'HllvX50cXC0')
-        self.api_utils = Dhis2ApiUtils(self.base_url, self.d2_token)
+        self.api_utils = api_utils or Dhis2ApiUtils(self.base_url, self.d2_token)
         #Filter the stage in the min_max_stages
         self.stages = config.get('min_max_stages', [])
         self.period_utils = Dhis2PeriodUtils()
         self.result_tracker = ResultTracker()
+        # Optional RunStateStore recording the progress of each stage, so it can be resumed
+        self.run_state = run_state
+        self.resume = resume
+        self.run_progress = None
 
 
     async def run_stage(self, stage: dict, session, semaphore):
@@ -42,34 +48,57 @@ class MinMaxFactory:
         generating min/max values,
         and posting the results to the appropriate endpoint based on the server version.
         """
-        prepared_stages = self.prepare_stage(stage)
+        # Resolve metadata and check permissions concurrently
+        prepared_stages, user_can_upload = await asyncio.gather(
+            self.prepare_stage_async(stage, session, semaphore),
+            self._check_can_upload_minmax_async(session, semaphore),
+        )
         all_responses = []
         #Check the user can even upload min/max values
-        user_can_upload = self._check_can_upload_minmax()
         if not user_can_upload:
             raise PermissionError("User does not have permission to upload min/max values. Please check the user permissions.")
 
+        if self.run_state is not None:
+            self.run_progress = await asyncio.to_thread(self.run_state.begin, f"min_max_stage:{stage.get('name')}",
+                                                        self.run_state.fingerprint(stage), self.resume)
         for prepared_stage in prepared_stages:
-            data_values = await self.fetch_data_for_dataset(prepared_stage, semaphore, session)
-            grouped_values = self.group_data_for_dataset(data_values)
-            min_max_results = self.calculate_dataset_minmax_values(grouped_values, prepared_stage)
-            imputed_results = self.impute_missing_minmmax_values(prepared_stage, min_max_results)
-            payload = self.prepare_min_max_payload(imputed_results, prepared_stage['dataset_id'])
-            #GH
-
-            #Decide to use bulk or legacy endpoint based on server version
-            async with semaphore:
-                server_version = await self.api_utils.get_server_version(session)
-                upload_method = self._chose_min_max_upload_method(server_version)
-                if upload_method == 'bulk':
-                    logging.info("Using bulk endpoint for min/max values.")
-                    response = await self.post_min_max_values_bulk(payload, session, semaphore)
-                else:
-                    logging.info("Using legacy endpoint for min/max values.")
-                    response = await self.post_min_max_values(payload, session, semaphore)
-            all_responses.append(response)
+            # The values computed for a dataset are a unit of work of the run; a resumed run
+            # on the same day uploads them without fetching and computing them again
+            unit_key = f"{prepared_stage['dataset_id']}:{date.today().isoformat()}"
+            payload = None
+            if self.run_progress is not None:
+                payload = await asyncio.to_thread(self.run_progress.get_unit, unit_key)
+            if payload is None:
+                payload = await self.compute_payload(prepared_stage, session, semaphore)
+                if self.run_progress is not None:
+                    await asyncio.to_thread(self.run_progress.save_unit, unit_key, payload)
+            all_responses.append(await self.upload_payload(payload, session, semaphore))
+        if self.run_progress is not None:
+            await asyncio.to_thread(self.run_progress.finish)
+            self.run_progress = None
         return all_responses
 
+    async def compute_payload(self, prepared_stage, session, semaphore):
+        """Fetch the data of one prepared stage (dataset) and compute its min/max payload."""
+        data_values = await self.fetch_data_for_dataset(prepared_stage, semaphore, session)
+        grouped_values = self.group_data_for_dataset(data_values)
+        min_max_results = self.calculate_dataset_minmax_values(grouped_values, prepared_stage)
+        imputed_results = self.impute_missing_minmmax_values(prepared_stage, min_max_results)
+        return self.prepare_min_max_payload(imputed_results, prepared_stage['dataset_id'])
+
+    async def upload_payload(self, payload, session, semaphore):
+        """Post a min/max payload with the endpoint the server version supports."""
+        #Decide to use bulk or legacy endpoint based on server version.
+        #The version lookup is shared across the run and the upload methods
+        #take their own semaphore slots, so no slot is held here.
+        server_version = await self.api_utils.get_server_version(session)
+        upload_method = self._chose_min_max_upload_method(server_version)
+        if upload_method == 'bulk':
+            logging.info("Using bulk endpoint for min/max values.")
+            return await self.post_min_max_values_bulk(payload, session, semaphore)
+        logging.info("Using legacy endpoint for min/max values.")
+        return await self.post_min_max_values(payload, session, semaphore)
+
     def calculate_dataset_minmax_values(self, grouped_data_values, prepared_stage):
         min_max_results = []
         for (ou_id, de_id, coc_id), values in grouped_data_values.items():
@@ -193,7 +222,7 @@ class MinMaxFactory:
 
     @staticmethod
     def _get_retry_delay(attempt, backoff_base):
-        return backoff_base * (2 ** (attempt - 1)) + secrets.randbelow(1000) / 1000.0 * 0.2
+        return retry_delay(attempt, backoff_base)
 
     # noinspection PyBroadException
     @staticmethod
@@ -207,47 +236,32 @@ class MinMaxFactory:
     async def _post_chunk(self, url, chunk_payload, session, semaphore, index: int,
                           max_retries: int = 3, backoff_base: float = 0.5):
         """
-        Post one chunk with bounded concurrency and simple exponential backoff.
+        Post one chunk with bounded concurrency. Transient failures are retried with
+        exponential backoff by the client's resilience policy.
         Returns (successful, ignored).
         """
         OK_STATUSES = {200, 201}
-        RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
-
-        attempt = 0
-        while True:
-            attempt += 1
-            try:
-                async with semaphore:
-                    async with session.post(url, json=chunk_payload) as response:
-                        if response.status in OK_STATUSES:
-                            successful, ignored = await self._parse_chunk_response(response, chunk_payload)
-                            logging.info(
-                                f"Chunk {index} OK (attempt {attempt}) with {len(chunk_payload['values'])} values.")
-                            return successful, ignored
-
-                        text = await response.text()
-                        if response.status in RETRYABLE_STATUSES and attempt < max_retries:
-                            delay = self._get_retry_delay(attempt, backoff_base)
-                            logging.warning(
-                                f"Chunk {index} got {response.status}. Retrying in {delay:.2f}s… Body: {text[:300]}")
-                            await asyncio.sleep(delay)
-                            continue
-
-                        raise RequestException(
-                            f"Chunk {index} failed: {response.status} - {text[:500]}"
-                        )
 
-            except Exception as e:
-                if isinstance(e, RequestException) and attempt >= max_retries:
-                    logging.error(str(e))
-                    raise
-                if not isinstance(e, RequestException) and attempt < max_retries:
-                    delay = self._get_retry_delay(attempt, backoff_base)
-                    logging.warning(f"Chunk {index} error: {e}. Retrying in {delay:.2f}s…")
-                    await asyncio.sleep(delay)
-                    continue
-                logging.error(f"Chunk {index} failed after {attempt} attempts: {e}")
-                raise
+        if self.run_progress is not None and await asyncio.to_thread(self.run_progress.is_acknowledged,
+                                                                      chunk_payload):
+            logging.info(f"Chunk {index} was posted before the run was interrupted, skipping it.")
+            return len(chunk_payload['values']), 0
+        try:
+            async with self.api_utils.request(session, 'POST', url, semaphore, idempotent=True,
+                                              max_attempts=max_retries, backoff_base=backoff_base,
+                                              json=chunk_payload) as response:
+                if response.status in OK_STATUSES:
+                    successful, ignored = await self._parse_chunk_response(response, chunk_payload)
+                    logging.info(f"Chunk {index} OK with {len(chunk_payload['values'])} values.")
+                    if self.run_progress is not None:
+                        await asyncio.to_thread(self.run_progress.acknowledge, chunk_payload)
+                    return successful, ignored
+
+                text = await response.text()
+                raise RequestException(f"Chunk {index} failed: {response.status} - {text[:500]}")
+        except Exception as e:
+            logging.error(f"Chunk {index} failed: {e}")
+            raise
 
     async def post_min_max_values_bulk(self, payload, session, semaphore, chunk_size=100000,
                                        max_retries: int = 3, backoff_base: float = 0.5):
@@ -341,7 +355,7 @@ class MinMaxFactory:
         Post a single min/max value to the server.
         """
         url = f'{self.base_url}/api/dataEntry/minMaxValues'
-        async with session.post(url, json=data) as response:
+        async with self.api_utils.request(session, 'POST', url, idempotent=True, json=data) as response:
             status = response.status
             if status == 200:
                 return True
@@ -351,36 +365,65 @@ class MinMaxFactory:
                 raise RequestException(f"Failed to post min/max value: {status} - {error_text}")
 
 
+    DATASET_METADATA_FIELDS = ['id', 'name', 'organisationUnits', 'periodType',
+                               'dataSetElements[dataElement[id,valueType],categoryCombo[categoryOptionCombos[id]]']
+
+    @staticmethod
+    def _single_dataset(resp, dataset):
+        if not resp:
+            raise ValueError(f"Dataset {dataset} not found in metadata.")
+        elif len(resp) > 1:
+            raise ValueError(f"Expected one dataset, but got multiple for ID {dataset}: {resp}")
+        else:
+            return resp[0]
+
     def get_dataset_metadata(self, dataset):
         """
         Fetch metadata for a specific dataset.
         """
-        fields = ['id','name','organisationUnits', 'periodType', 'dataSetElements[dataElement[id,valueType],categoryCombo[categoryOptionCombos[id]]']
-
         resp = self.api_utils.fetch_metadata_list(
             endpoint='dataSets',
             key='dataSets',
             filters=[f'id:eq:{dataset}'],
-            fields=fields,
+            fields=self.DATASET_METADATA_FIELDS,
             extra_params={'paging': 'false'}
         )
-        if not resp:
-            raise ValueError(f"Dataset {dataset} not found in metadata.")
-        elif len(resp) > 1:
-            raise ValueError(f"Expected one dataset, but got multiple for ID {dataset}: {resp}")
-        else:
-            return resp[0]
+        return self._single_dataset(resp, dataset)
 
-    def prepare_stage(self, stage):
-        prepared_stages = []
+    async def get_dataset_metadata_async(self, dataset, session, semaphore=None):
+        resp = await self.api_utils.fetch_metadata_list_async(
+            'dataSets', session,
+            key='dataSets',
+            filters=[f'id:eq:{dataset}'],
+            fields=self.DATASET_METADATA_FIELDS,
+            extra_params={'paging': 'false'},
+            semaphore=semaphore,
+        )
+        return self._single_dataset(resp, dataset)
 
+    def prepare_stage(self, stage):
         filtered_data_elements = self._resolve_filtered_data_elements(stage)
         orgunit_group_members = self._resolve_orgunit_group_members(stage)
+        datasets_metadata = [self.get_dataset_metadata(dataset) for dataset in stage.get('datasets', [])]
+        return self._build_prepared_stages(stage, datasets_metadata, filtered_data_elements, orgunit_group_members)
 
+    async def prepare_stage_async(self, stage, session, semaphore=None):
+        """
+        Async counterpart of ``prepare_stage``. Data element filters, org unit group members and
+        the metadata of every dataset are resolved concurrently.
+        """
         datasets = stage.get('datasets', [])
+        filtered_data_elements, orgunit_group_members, *datasets_metadata = await asyncio.gather(
+            self._resolve_filtered_data_elements_async(stage, session, semaphore),
+            self._resolve_orgunit_group_members_async(stage, session, semaphore),
+            *[self.get_dataset_metadata_async(dataset, session, semaphore) for dataset in datasets],
+        )
+        return self._build_prepared_stages(stage, datasets_metadata, filtered_data_elements, orgunit_group_members)
+
+    def _build_prepared_stages(self, stage, datasets_metadata, filtered_data_elements, orgunit_group_members):
+        prepared_stages = []
 
-        for dataset in datasets:
-            dataset_metadata = self.get_dataset_metadata(dataset)
+        for dataset, dataset_metadata in zip(stage.get('datasets', []), datasets_metadata):
             dataset_period_type = dataset_metadata.get('periodType')
             dataset_id = dataset_metadata.get('id')
 
@@ -422,26 +465,39 @@ class MinMaxFactory:
         return prepared_stages
 
     def _resolve_filtered_data_elements(self, stage):
-        data_element_groups = stage.get('data_element_groups') or []
-        data_elements = stage.get('data_elements') or []
-
-        if not data_element_groups and not data_elements:
-            return []
-
-        data_elements_filter = []
-
-        for group in data_element_groups:
-            group_metadata = self.api_utils.fetch_data_element_groups(
-                fields="id,name,dataElements[id,valueType]",
+        groups_metadata = [
+            self.api_utils.fetch_data_element_groups(
+                fields=['id', 'name', 'dataElements[id,valueType]'],
                 filters=[f'id:eq:{group}']
             )
-            data_elements = group_metadata.get('dataElements', [])
-            data_elements_filter.extend(
-                [de['id'] for de in data_elements if de.get('valueType') in NumericValueType.list()]
+            for group in stage.get('data_element_groups') or []
+        ]
+        return self._merge_data_element_filter(stage, groups_metadata)
+
+    async def _resolve_filtered_data_elements_async(self, stage, session, semaphore=None):
+        groups_metadata = await asyncio.gather(*[
+            self.api_utils.fetch_data_element_groups_async(
+                session,
+                fields=['id', 'name', 'dataElements[id,valueType]'],
+                filters=[f'id:eq:{group}'],
+                semaphore=semaphore,
             )
+            for group in stage.get('data_element_groups') or []
+        ])
+        return self._merge_data_element_filter(stage, groups_metadata)
+
+    @staticmethod
+    def _merge_data_element_filter(stage, groups_metadata):
+        data_elements_filter = []
+
+        for group_list in groups_metadata:
+            for group_metadata in group_list:
+                data_elements_filter.extend(
+                    [de['id'] for de in group_metadata.get('dataElements', [])
+                     if de.get('valueType') in NumericValueType.list()]
+                )
 
-        for de in data_elements:
-            data_elements_filter.append(de)
+        data_elements_filter.extend(stage.get('data_elements') or [])
         # Remove duplicates
         return list(set(data_elements_filter))
 
@@ -461,34 +517,33 @@ class MinMaxFactory:
             params['children'] = 'true'
         from urllib.parse import urlencode
         full_url = f"{url}?{urlencode(params)}"
-        async with semaphore:
-            logging.debug("Dispatching data values request to URL: %s", full_url)
-            async with session.get(url, params=params) as response:
-                if response.status == 200:
-                    resp = await response.json()
-                    des_in_dataset = prepared_stage['dataset_metadata'].get('dataSetElements', [])
-                    #Filter these to get the numeric data elements
-                    numeric_des = [de for de in des_in_dataset if
-                                   de.get('dataElement', {}).get('valueType') in NumericValueType.list()]
-                    #Filter the data values to only include these numeric data elements
-                    data_values = [
-                        dv for dv in resp.get('dataValues', [])
-                        if dv.get('dataElement') in [de['dataElement']['id'] for de in numeric_des]
-                    ]
-                    #Filter out the data elements which are part of the filtered data elements
-                    if prepared_stage['filtered_data_elements']:
-                        data_values = [
-                            dv for dv in data_values
-                            if dv.get('dataElement') in prepared_stage['filtered_data_elements']
-                        ]
-                    # Some DHIS2 versions omit orgUnit from individual records when it is
-                    # unambiguous from the request. Inject it so downstream code can rely on it.
-                    for dv in data_values:
-                        if 'orgUnit' not in dv:
-                            dv['orgUnit'] = org_unit
-                    return {'dataValues': data_values}
-                else:
-                    raise RequestException(f"Failed to fetch data values: {response.status} - {await response.text()}")
+
+        des_in_dataset = prepared_stage['dataset_metadata'].get('dataSetElements', [])
+        #Only numeric data elements can be analysed
+        keep_data_elements = {
+            de['dataElement']['id'] for de in des_in_dataset
+            if de.get('dataElement', {}).get('valueType') in NumericValueType.list()
+        }
+        #Restrict further to the filtered data elements, if any
+        if prepared_stage['filtered_data_elements']:
+            keep_data_elements &= set(prepared_stage['filtered_data_elements'])
+        logging.debug("Dispatching data values request to URL: %s", full_url)
+        async with self.api_utils.request(session, 'GET', url, semaphore, params=params) as response:
+            if response.status == 200:
+                # Decode values as they stream in and keep only the ones we analyse,
+                # so memory follows what we keep rather than the response size
+                data_values = [
+                    dv async for dv in iter_json_array(response.content, 'dataValues')
+                    if dv.get('dataElement') in keep_data_elements
+                ]
+                # Some DHIS2 versions omit orgUnit from individual records when it is
+                # unambiguous from the request. Inject it so downstream code can rely on it.
+                for dv in data_values:
+                    if 'orgUnit' not in dv:
+                        dv['orgUnit'] = org_unit
+                return {'dataValues': data_values}
+            else:
+                raise RequestException(f"Failed to fetch data values: {response.status} - {await response.text()}")
 
     async def get_stage_data_values(self, prepared_stage, session, semaphore):
 
@@ -533,14 +588,13 @@ class MinMaxFactory:
         url = f"{url}&filter=generated:eq:{str(generated).lower()}"
         url = f"{url}&paging=false"
 
-        async with semaphore:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    resp = await response.json()
-                    return resp.get('minMaxDataElements', [])
-                else:
-                    raise RequestException(
-                        f"Failed to fetch existing min/max values: {response.status} - {await response.text()}")
+        async with self.api_utils.request(session, 'GET', url, semaphore) as response:
+            if response.status == 200:
+                resp = await response.json()
+                return resp.get('minMaxDataElements', [])
+            else:
+                raise RequestException(
+                    f"Failed to fetch existing min/max values: {response.status} - {await response.text()}")
 
 
 
@@ -763,7 +817,7 @@ class MinMaxFactory:
         This includes fetching data values and calculating min/max values.
         """
         frames = []
-        prepared_stages = self.prepare_stage(stage)
+        prepared_stages = await self.prepare_stage_async(stage, session, semaphore)
         for prepared_stage in prepared_stages:
             data_values = await self.fetch_data_for_dataset(prepared_stage, semaphore, session)
             if data_values:
@@ -830,45 +884,69 @@ class MinMaxFactory:
         logging.info(f"Imputed {len(imputed_results) - len(min_max_results)} missing min/max values.")
         return imputed_results
 
+    @staticmethod
+    def _has_minmax_authority(me):
+        permitted_auths = ['F_MIN_MAX_ADD', 'ALL']
+        if not any(auth in me.get('authorities', []) for auth in permitted_auths):
+            logging.error("User does not have permission to add min/max values.")
+            return False
+        return True
+
     def _check_can_upload_minmax(self):
         """
         Check if the server supports min/max uploads.
         """
         try:
-            permitted_auths = ['F_MIN_MAX_ADD', 'ALL']
-            me = self.api_utils.fetch_me()
-            if not any(auth in me.get('authorities', []) for auth in permitted_auths):
-                logging.error("User does not have permission to add min/max values.")
-                return False
-            return True
+            return self._has_minmax_authority(self.api_utils.fetch_me())
         except Exception as e:
             logging.error(f"Error checking user permissions: {e}")
             return False
 
-    def _resolve_orgunit_group_members(self, stage):
-        if not stage.get('org_unit_groups'):
-            return []
-        else:
-            #These maybe comma separated strings
-            group_ids = []
-            for og in stage.get('org_unit_groups'):
-                group_ids.extend([g.strip() for g in og.split(',') if g.strip()])
-            if not group_ids:
-                return []
-            else:
-                #Loop over each group and get the ids of each orgunit
-                members = set()
-
-                for group_id in group_ids:
-                    group_metadata = self.api_utils.fetch_organisation_unit_groups(
-                        fields=["id","name","organisationUnits[id]"] ,
-                        filters=[f'id:eq:{group_id}']
-                    )
-                    for ou in group_metadata[0].get('organisationUnits', []):
-                        members.add(ou['id'])
-                return list(members)
-
-
+    async def _check_can_upload_minmax_async(self, session, semaphore=None):
+        try:
+            return self._has_minmax_authority(await self.api_utils.fetch_me_async(session, semaphore))
+        except Exception as e:
+            logging.error(f"Error checking user permissions: {e}")
+            return False
 
+    @staticmethod
+    def _org_unit_group_ids(stage):
+        #These maybe comma separated strings
+        group_ids = []
+        for og in stage.get('org_unit_groups') or []:
+            group_ids.extend([g.strip() for g in og.split(',') if g.strip()])
+        return group_ids
 
+    @staticmethod
+    def _merge_group_members(groups_metadata):
+        members = set()
+        for group_metadata in groups_metadata:
+            if not group_metadata:
+                logging.warning("Organisation unit group not found; skipping.")
+                continue
+            for ou in group_metadata[0].get('organisationUnits', []):
+                members.add(ou['id'])
+        return list(members)
 
+    def _resolve_orgunit_group_members(self, stage):
+        #Loop over each group and get the ids of each orgunit
+        groups_metadata = [
+            self.api_utils.fetch_organisation_unit_groups(
+                fields=["id", "name", "organisationUnits[id]"],
+                filters=[f'id:eq:{group_id}']
+            )
+            for group_id in self._org_unit_group_ids(stage)
+        ]
+        return self._merge_group_members(groups_metadata)
+
+    async def _resolve_orgunit_group_members_async(self, stage, session, semaphore=None):
+        groups_metadata = await asyncio.gather(*[
+            self.api_utils.fetch_organisation_unit_groups_async(
+                session,
+                fields=["id", "name", "organisationUnits[id]"],
+                filters=[f'id:eq:{group_id}'],
+                semaphore=semaphore,
+            )
+            for group_id in self._org_unit_group_ids(stage)
+        ])
+        return self._merge_group_members(groups_metadata)
@@ -1,31 +1,58 @@
+import asyncio
 import logging
+from contextlib import aclosing
 
 from flask import Blueprint, current_app, request, jsonify
 from app.core.api_utils import Dhis2ApiUtils
 from app.core.config_loader import ConfigManager
+from app.core.dhis2_client import Dhis2Client
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
+TYPEAHEAD_LIMIT = 20
 
-@api_bp.route('/data-elements', methods=['GET'])
-def api_data_elements():
-    path = current_app.config['CONFIG_PATH']
+
+def _api_utils_from_path(path):
     config = ConfigManager(config_path=path, config=None, validate_structure=False, validate_runtime=False).config
-    utils = Dhis2ApiUtils(
+    client = Dhis2Client.from_config(config)
+    return Dhis2ApiUtils(
         base_url=config['server']['base_url'],
-        d2_token=config['server']['d2_token']
+        d2_token=config['server']['d2_token'],
+        client=client
     )
+
+
+def _search_metadata(utils, endpoint, query, fields=None, predicate=None, limit=TYPEAHEAD_LIMIT):
+    """
+    Return the first ``limit`` items of ``endpoint`` whose name matches ``query``.
+    Pages are walked only until enough matches are found.
+    """
+    filters = [f'name:ilike:{query}'] if query else []
+
+    async def collect():
+        matches = []
+        async with utils.client.session() as session:
+            items = utils.iter_metadata_async(endpoint, session, filters=filters, fields=fields, page_size=limit)
+            async with aclosing(items):
+                async for item in items:
+                    if predicate is None or predicate(item):
+                        matches.append(item)
+                    if len(matches) >= limit:
+                        break
+        return matches
+
+    return asyncio.run(collect())
+
+
+@api_bp.route('/data-elements', methods=['GET'])
+def api_data_elements():
+    utils = _api_utils_from_path(current_app.config['CONFIG_PATH'])
     query = request.args.get('q', '').strip()
 
     logging.info(f"Searching data elements with query: '{query}'")
 
     try:
-        if query:
-            filters = [f'name:ilike:{query}']
-            elements = utils.fetch_data_elements(filters=filters)
-        else:
-            # No query, return empty list or first 20 elements
-            elements = utils.fetch_metadata_list('dataElements', 'dataElements')
+        elements = _search_metadata(utils, 'dataElements', query)
 
         logging.info(f"Found {len(elements)} elements")
 
@@ -33,7 +60,7 @@ def api_data_elements():
         if elements:
             logging.debug(f"First element structure: {elements[0]}")
 
-        result = [{"id": el["id"], "text": el["name"]} for el in elements[:20]]
+        result = [{"id": el["id"], "text": el["name"]} for el in elements]
         logging.info(f"Returning {len(result)} formatted elements")
 
         return jsonify(result)
@@ -44,62 +71,35 @@ def api_data_elements():
 
 @api_bp.route('/datasets', methods=['GET'])
 def api_datasets():
-    path = current_app.config['CONFIG_PATH']
-    cm = ConfigManager(config_path=path, config=None, validate_structure=False, validate_runtime=False)
-    config = cm.config
-    utils = Dhis2ApiUtils(
-        base_url=config['server']['base_url'],
-        d2_token=config['server']['d2_token']
-    )
+    utils = _api_utils_from_path(current_app.config['CONFIG_PATH'])
 
     supported_period_types = {'Daily', 'Weekly', 'Monthly', 'Quarterly', 'Yearly'}
     query = request.args.get('q', '').strip()
     try:
-        filters = [f"name:ilike:{query}"] if query else []
-        datasets = utils.fetch_data_sets(filters=filters, fields=['id', 'name', 'periodType'])
-        results = [
-            {"id": ds["id"], "text": ds["name"]}
-            for ds in datasets
-            if ds.get("periodType") in supported_period_types
-        ]
-        return jsonify(results[:20])
+        datasets = _search_metadata(utils, 'dataSets', query, fields=['id', 'name', 'periodType'],
+                                    predicate=lambda ds: ds.get("periodType") in supported_period_types)
+        return jsonify([{"id": ds["id"], "text": ds["name"]} for ds in datasets])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @api_bp.route('/validation-rule-groups', methods=['GET'])
 def api_validation_rule_groups():
-    path = current_app.config['CONFIG_PATH']
-    cm = ConfigManager(config_path=path, config=None, validate_structure=False, validate_runtime=False)
-    config = cm.config
-    utils = Dhis2ApiUtils(
-        base_url=config['server']['base_url'],
-        d2_token=config['server']['d2_token']
-    )
+    utils = _api_utils_from_path(current_app.config['CONFIG_PATH'])
     query = request.args.get('q', '').strip()
     try:
-        # Apply proper filter format if a search query is present
-        filters = [f"name:ilike:{query}"] if query else []
-
-        groups = utils.fetch_validation_rule_groups(filters=filters)
-        return jsonify([{"id": g["id"], "text": g["name"]} for g in groups[:20]])
+        groups = _search_metadata(utils, 'validationRuleGroups', query)
+        return jsonify([{"id": g["id"], "text": g["name"]} for g in groups])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @api_bp.route('/data-element-groups', methods=['GET'])
 def api_data_element_groups():
-    path = current_app.config['CONFIG_PATH']
-    cm = ConfigManager(config_path=path, config=None, validate_structure=False, validate_runtime=False)
-    config = cm.config
-    utils = Dhis2ApiUtils(
-        base_url=config['server']['base_url'],
-        d2_token=config['server']['d2_token']
-    )
+    utils = _api_utils_from_path(current_app.config['CONFIG_PATH'])
     query = request.args.get('q', '').strip()
     try:
-        filters = [f"name:ilike:{query}"] if query else []
-        groups = utils.fetch_data_element_groups(filters=filters)
-        return jsonify([{"id": g["id"], "text": g["name"]} for g in groups[:20]])
+        groups = _search_metadata(utils, 'dataElementGroups', query)
+        return jsonify([{"id": g["id"], "text": g["name"]} for g in groups])
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
\ No newline at end of file
+        return jsonify({"error": str(e)}), 500
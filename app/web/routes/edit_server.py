@@ -3,6 +3,7 @@ import os
 from flask import current_app, request, render_template, redirect, url_for, flash
 
 from app.core.config_loader import ConfigManager
+from app.core.metadata_cache import MetadataCache
 from app.web.routes.api import api_bp
 from app.web.utils.config_helpers import save_config
 
@@ -57,3 +58,16 @@ def edit_server():
     # GET request
     return render_template("edit_server.html", server=config['server'],
                            config_path=abs_config_path)
+
+
+@api_bp.route('/clear-metadata-cache', methods=['POST'], endpoint='clear_metadata_cache')
+def clear_metadata_cache():
+    config_path = current_app.config['CONFIG_PATH']
+    config = ConfigManager(config_path, config=None, validate_structure=False, validate_runtime=False).config
+    cache = MetadataCache.from_config(config)
+    if cache is None:
+        flash('The metadata cache is not enabled for this server.', 'info')
+    else:
+        cache.invalidate()
+        flash('Metadata cache cleared. Metadata will be fetched from DHIS2 on the next run.', 'success')
+    return redirect(url_for('api.edit_server'))
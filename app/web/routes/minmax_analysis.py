@@ -4,10 +4,12 @@ import time
 import uuid
 from io import StringIO
 
-import aiohttp
 from flask import current_app, jsonify, Response
 
+from app.core.api_utils import Dhis2ApiUtils
 from app.core.config_loader import ConfigManager
+from app.core.dhis2_client import Dhis2Client
+from app.core.concurrency import create_limiter
 from app.minmax.min_max_factory import MinMaxFactory
 from app.web.routes.api import api_bp
 
@@ -18,15 +20,10 @@ _jobs_lock = threading.Lock()
 
 def _run_analysis_in_background(job_id: str, config: dict, stage: dict):
     async def run():
-        concurrency = config["server"].get("max_concurrent_requests", 5)
-        semaphore = asyncio.Semaphore(concurrency)
-        headers = {
-            "Authorization": f"ApiToken {config.get('server', {}).get('d2_token', '')}",
-            "Content-Type": "application/json",
-            "Accept-Encoding": "gzip"
-        }
-        factory = MinMaxFactory(config)
-        async with aiohttp.ClientSession(headers=headers) as session:
+        client = Dhis2Client.from_config(config)
+        semaphore = create_limiter(config, client, default_max_concurrent_requests=5)
+        factory = MinMaxFactory(config, Dhis2ApiUtils(client.base_url, client.d2_token, client=client))
+        async with client.session() as session:
             return await factory.analyze_stage(stage, session, semaphore)
 
     try:
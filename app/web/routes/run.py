@@ -3,6 +3,7 @@ import asyncio
 from flask import Blueprint, current_app, render_template, flash, jsonify, redirect, url_for
 
 from app.core.config_loader import ConfigManager
+from app.core.dhis2_client import Dhis2Client
 from app.cli import DataQualityMonitor
 from app.web.routes.api import api_bp
 
@@ -28,7 +29,7 @@ def run_now():
         # Replace only the active stages in a shallow copy of config
         config_filtered = {**config, "analyzer_stages": active_stages}
 
-        monitor = DataQualityMonitor(config_filtered)
+        monitor = DataQualityMonitor(config_filtered, client=Dhis2Client.from_config(config_filtered))
         result = asyncio.run(monitor.run_all_stages())
 
         # Build summary text from import summary
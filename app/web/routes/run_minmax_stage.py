@@ -3,10 +3,12 @@ import threading
 import time
 import uuid
 
-import aiohttp
 from flask import current_app, jsonify
 
+from app.core.api_utils import Dhis2ApiUtils
 from app.core.config_loader import ConfigManager
+from app.core.dhis2_client import Dhis2Client
+from app.core.concurrency import create_limiter
 from app.minmax.min_max_factory import MinMaxFactory
 from app.web.routes.api import api_bp
 
@@ -16,15 +18,12 @@ _jobs_lock = threading.Lock()
 
 def _run_stage_in_background(job_id: str, config: dict, stage: dict):
     async def run():
-        concurrency = config["server"].get("max_concurrent_requests", 5)
-        semaphore = asyncio.Semaphore(concurrency)
-        headers = {
-            "Authorization": f"ApiToken {config.get('server', {}).get('d2_token', '')}",
-            "Content-Type": "application/json",
-            "Accept-Encoding": "gzip"
-        }
-        factory = MinMaxFactory(config)
-        async with aiohttp.ClientSession(headers=headers) as session:
+        client = Dhis2Client.from_config(config)
+        semaphore = create_limiter(config, client, default_max_concurrent_requests=5)
+        # With server.run_state enabled, a run interrupted by a restart continues where it stopped
+        factory = MinMaxFactory(config, Dhis2ApiUtils(client.base_url, client.d2_token, client=client),
+                                run_state=client.run_state, resume=True)
+        async with client.session() as session:
             await factory.run_stage(stage, session, semaphore)
         return factory.result_tracker.get_summary()
 
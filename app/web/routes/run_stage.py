@@ -1,12 +1,13 @@
 import asyncio
 from copy import deepcopy
 
-import aiohttp
 from flask import current_app, jsonify
 
 from app.analyzers.integrity_analyzer import IntegrityCheckAnalyzer
 from app.core.api_utils import Dhis2ApiUtils
 from app.core.config_loader import ConfigManager
+from app.core.dhis2_client import Dhis2Client
+from app.core.concurrency import create_limiter
 from app.cli import DataQualityMonitor
 from app.web.routes.api import api_bp
 
@@ -32,10 +33,13 @@ def run_stage(stage_index):
             # Trigger the DHIS2 async job and return immediately — browser will poll for completion
             headers = _make_headers(full_config)
 
+            client = Dhis2Client.from_config(full_config)
+
             async def _trigger():
-                analyzer = IntegrityCheckAnalyzer(full_config, full_config['server']['base_url'], headers)
-                semaphore = asyncio.Semaphore(full_config['server'].get('max_concurrent_requests', 10))
-                async with aiohttp.ClientSession(headers=headers) as session:
+                api_utils = Dhis2ApiUtils(client.base_url, client.d2_token, client=client)
+                analyzer = IntegrityCheckAnalyzer(full_config, full_config['server']['base_url'], headers, api_utils)
+                semaphore = create_limiter(full_config, client)
+                async with client.session() as session:
                     await analyzer.trigger_only_async(deepcopy(stage), session, semaphore)
 
             asyncio.run(_trigger())
@@ -50,7 +54,7 @@ def run_stage(stage_index):
         filtered_config = deepcopy(full_config)
         filtered_config['analyzer_stages'] = [stage]
 
-        monitor = DataQualityMonitor(filtered_config)
+        monitor = DataQualityMonitor(filtered_config, client=Dhis2Client.from_config(filtered_config))
         result = asyncio.run(monitor.run_all_stages())
 
         import_summary = result.get("import_summary", {})
@@ -89,12 +93,12 @@ def integrity_running():
     """Check whether a DHIS2 dataIntegrity summary job is still running."""
     try:
         config = _load_config(current_app.config['CONFIG_PATH'])
-        headers = _make_headers(config)
+        client = Dhis2Client.from_config(config)
         base_url = config['server']['base_url']
 
         async def _check():
             url = f'{base_url}/api/dataIntegrity/summary/running'
-            async with aiohttp.ClientSession(headers=headers) as session:
+            async with client.session() as session:
                 async with session.get(url) as response:
                     if response.status == 200:
                         return await response.json()
@@ -115,11 +119,13 @@ def collect_integrity(stage_index):
         stage = full_config['analyzer_stages'][stage_index]
         headers = _make_headers(full_config)
 
+        client = Dhis2Client.from_config(full_config)
+
         async def _collect():
-            analyzer = IntegrityCheckAnalyzer(full_config, full_config['server']['base_url'], headers)
-            api_utils = Dhis2ApiUtils(full_config['server']['base_url'], full_config['server']['d2_token'])
-            semaphore = asyncio.Semaphore(full_config['server'].get('max_concurrent_requests', 10))
-            async with aiohttp.ClientSession(headers=headers) as session:
+            api_utils = Dhis2ApiUtils(full_config['server']['base_url'], full_config['server']['d2_token'], client=client)
+            analyzer = IntegrityCheckAnalyzer(full_config, full_config['server']['base_url'], headers, api_utils)
+            semaphore = create_limiter(full_config, client)
+            async with client.session() as session:
                 data_value_set = await analyzer.collect_results_async(deepcopy(stage), session, semaphore)
                 return await api_utils.post_data_value_set(data_value_set, session)
 
@@ -34,3 +34,17 @@ def test_ping_unreachable():
         status, reason = _make_utils().ping()
     assert status == 'unreachable'
     assert reason is not None
+
+
+def test_metadata_params_repeats_filters_and_accepts_string_fields():
+    params = Dhis2ApiUtils._metadata_params(
+        filters=['id:eq:abc', 'name:ilike:anc'],
+        fields='id,name,dataElements[id,valueType]',
+        extra_params={'paging': False},
+    )
+    assert params == [
+        ('fields', 'id,name,dataElements[id,valueType]'),
+        ('filter', 'id:eq:abc'),
+        ('filter', 'name:ilike:anc'),
+        ('paging', 'false'),
+    ]
@@ -0,0 +1,75 @@
+import asyncio
+
+from aiohttp.test_utils import TestServer
+
+from app.benchmark.run import build_config, run_min_max
+from app.benchmark.stub_server import create_app, parse_fields, query_metadata, select_fields
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+
+
+def _instance():
+    return SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13)
+
+
+def test_instance_is_deterministic_and_facilities_report_data():
+    a, b = _instance(), _instance()
+    assert [ou['id'] for ou in a.collections['organisationUnits']] == \
+        [ou['id'] for ou in b.collections['organisationUnits']]
+    assert len(a.collections['organisationUnits']) == 1 + 2 + 6 + 24
+    assert len(a.facilities_under(a.root)) == 24
+
+    ds = a.data_sets[0]['id']
+    values = list(a.data_values(a.data_elements_for_dataset(ds), [a.root], a.periods, children=True))
+    assert values == list(b.data_values(b.data_elements_for_dataset(ds), [b.root], b.periods, children=True))
+    assert {dv['orgUnit'] for dv in values} <= set(a.facilities)
+
+
+def test_fields_and_filters_follow_the_dhis2_syntax():
+    tree = parse_fields('id,dataSetElements[dataElement[id,valueType]]')
+    assert tree == {'id': None, 'dataSetElements': {'dataElement': {'id': None, 'valueType': None}}}
+    obj = {'id': 'a', 'name': 'A', 'dataSetElements': [{'dataElement': {'id': 'd', 'valueType': 'NUMBER',
+                                                                         'name': 'D'}}]}
+    assert select_fields(obj, tree) == {'id': 'a', 'dataSetElements': [{'dataElement': {'id': 'd',
+                                                                                         'valueType': 'NUMBER'}}]}
+
+    instance = _instance()
+    level_2 = query_metadata(instance, 'organisationUnits', ['level:eq:2'], 'id', paging=False)
+    assert [ou['id'] for ou in level_2['organisationUnits']] == instance.levels[2]
+    page = query_metadata(instance, 'organisationUnits', [], 'id', page=2, page_size=10)
+    assert page['pager'] == {'page': 2, 'pageCount': 4, 'total': 33, 'pageSize': 10}
+
+
+async def _run_against_stub(instance, stages):
+    server = TestServer(create_app(instance))
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), level=3, stages=stages,
+                              min_max_org_units=2)
+        if config['analyzer_stages']:
+            return await DataQualityMonitor(config).run_all_stages()
+        return await run_min_max(config)
+    finally:
+        await server.close()
+
+
+def test_monitor_posts_outlier_and_violation_counts_to_the_stub():
+    instance = _instance()
+    result = asyncio.run(_run_against_stub(instance, ['outlier', 'validation_rules']))
+
+    assert result['errors'] == []
+    assert result['data_values_posted'] > 0
+    posted = {key[0] for key, dv in instance.stored_values.items() if dv is not None}
+    outlier_des = {de['id'] for de in instance.outlier_data_elements.values()}
+    violation_des = {de['id'] for de in instance.validation_data_elements.values()}
+    assert posted <= outlier_des | violation_des
+    assert posted & outlier_des and posted & violation_des
+    assert result['http_metrics']['outlierDetection']['requests'] == len(instance.data_sets) * len(instance.levels[2])
+
+
+def test_min_max_stage_uploads_bounds_to_the_stub():
+    instance = _instance()
+    result = asyncio.run(_run_against_stub(instance, ['min_max']))
+
+    assert result['summary']['imported'] == len(instance.min_max_values) > 0
+    assert {ou for ou, _, _ in instance.min_max_values} <= set(instance.facilities)
@@ -0,0 +1,97 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.core.concurrency import AdaptiveLimiter, create_limiter
+from app.core.dhis2_client import Dhis2Client
+
+
+def test_create_limiter_defaults_to_fixed_semaphore():
+    async def run():
+        return create_limiter({'server': {'max_concurrent_requests': 4}})
+
+    assert isinstance(asyncio.run(run()), asyncio.Semaphore)
+
+
+def test_limiter_never_exceeds_its_limit():
+    async def run():
+        limiter = AdaptiveLimiter(initial=3)
+        peak = 0
+
+        async def work():
+            nonlocal peak
+            async with limiter:
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.001)
+
+        await asyncio.gather(*(work() for _ in range(20)))
+        return peak, limiter.in_flight
+
+    assert asyncio.run(run()) == (3, 0)
+
+
+def test_overload_halves_limit_and_success_grows_it_back_within_bounds():
+    limiter = AdaptiveLimiter(initial=8, min_limit=2, max_limit=10)
+
+    limiter.on_response('GET', '/api/outlierDetection', 503, 0.5)
+    assert limiter.limit == 4
+    # A second failure from the same burst is ignored
+    limiter.on_response('GET', '/api/outlierDetection', 503, 0.5)
+    assert limiter.limit == 4
+
+    for _ in range(200):
+        limiter._in_flight = limiter.limit
+        limiter.on_response('GET', '/api/dataValueSets', 200, 0.1)
+    assert limiter.limit == 10
+
+
+def test_slow_responses_count_as_overload_when_target_latency_is_set():
+    limiter = AdaptiveLimiter(initial=6, min_limit=2, target_latency=1.0)
+    limiter.on_response('GET', '/api/outlierDetection', 200, 5.0)
+    assert limiter.limit == 3
+
+
+def test_client_reports_responses_to_limiter():
+    async def overloaded(request):
+        return web.Response(status=503)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/api/outlierDetection', overloaded)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            base_url = str(server.make_url('')).rstrip('/')
+            client = Dhis2Client(base_url, 'tok')
+            config = {'server': {'max_concurrent_requests': 8,
+                                 'adaptive_concurrency': {'enabled': True, 'min_concurrent_requests': 2}}}
+            limiter = create_limiter(config, client)
+            async with client.session() as session, limiter:
+                async with session.get(f'{base_url}/api/outlierDetection') as response:
+                    assert response.status == 503
+            return limiter.limit
+        finally:
+            await server.close()
+
+    assert asyncio.run(run()) == 4
+
+
+def test_limiter_only_hears_about_requests_on_its_own_loop():
+    """Responses of a run on another thread's loop do not move this run's limit."""
+    client = Dhis2Client('https://loops.example.org', 'tok')
+    config = {'server': {'max_concurrent_requests': 8, 'adaptive_concurrency': {'enabled': True}}}
+
+    async def make_limiter():
+        limiter = create_limiter(config, client)
+        client.notify('on_response', 'GET', '/api/outlierDetection', 503, 0.1)
+        return limiter
+
+    async def other_run():
+        client.notify('on_response', 'GET', '/api/outlierDetection', 503, 0.1)
+
+    limiter = asyncio.run(make_limiter())
+    assert limiter.limit == 4
+    limiter._last_decrease = 0.0  # a later overload on its own loop would lower the limit again
+    asyncio.run(other_run())
+    assert limiter.limit == 4
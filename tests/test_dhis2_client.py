@@ -0,0 +1,73 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.core.api_utils import Dhis2ApiUtils
+from app.core.dhis2_client import Dhis2Client
+
+
+def test_for_server_returns_shared_client():
+    """The same base URL and token resolve to one pooled client."""
+    a = Dhis2Client.for_server('https://shared.example.org', 'tok')
+    b = Dhis2Client.for_server('https://shared.example.org', 'tok')
+    c = Dhis2Client.for_server('https://shared.example.org', 'other-tok')
+    assert a is b
+    assert a is not c
+
+
+def test_api_utils_uses_injected_client():
+    client = Dhis2Client('https://inject.example.org', 'tok', max_concurrent_requests=3)
+    utils = Dhis2ApiUtils('https://inject.example.org', 'tok', client=client)
+    assert utils.client is client
+    assert utils.client.http.headers['Authorization'] == 'ApiToken tok'
+
+
+def test_session_is_reused_and_closed():
+    """Nested borrowers share one aiohttp session, closed when the outermost exits."""
+    client = Dhis2Client('https://pool.example.org', 'tok', max_concurrent_requests=4)
+
+    async def run():
+        async with client.session() as outer:
+            assert outer.connector.limit_per_host == 4
+            async with client.session() as inner:
+                assert inner is outer
+            assert not outer.closed
+        return outer
+
+    session = asyncio.run(run())
+    assert session.closed
+
+
+def test_from_config_gives_each_run_its_own_client_on_the_shared_pool():
+    """A run's stores and resilience policy are not replaced when another run starts."""
+    config = {'server': {'base_url': 'https://runs.example.org', 'd2_token': 'tok'}}
+    first = Dhis2Client.from_config(config)
+    resilience = first.resilience
+    second = Dhis2Client.from_config(config)
+    assert first is not second
+    assert first.resilience is resilience and second.resilience is not resilience
+    shared = Dhis2Client.for_server('https://runs.example.org', 'tok')
+    assert first.http.get_adapter('https://') is second.http.get_adapter('https://') \
+           is shared.http.get_adapter('https://')
+
+
+def test_async_integrity_checks_are_fetched_without_a_content_type():
+    """Like the synchronous helper, the GET carries no Content-Type header."""
+    async def data_integrity(request):
+        return web.json_response([{'name': 'check', 'content_type': request.headers.get('Content-Type')}])
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/api/dataIntegrity', data_integrity)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            base_url = str(server.make_url('')).rstrip('/')
+            utils = Dhis2ApiUtils(base_url, 'tok', client=Dhis2Client(base_url, 'tok'))
+            async with utils.client.session() as session:
+                return await utils.get_metadata_integrity_checks_async(session)
+        finally:
+            await server.close()
+
+    assert asyncio.run(run()) == [{'name': 'check', 'content_type': None}]
@@ -0,0 +1,120 @@
+import asyncio
+import copy
+
+from aiohttp.test_utils import TestServer
+
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+from app.distributed.coordinator import Coordinator
+from app.distributed.work_queue import WorkQueue
+from app.distributed.worker import Worker
+
+
+def test_work_queue_leases_and_retries_units(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.sqlite', lease_seconds=60, max_attempts=2)
+    run_id = queue.create_run([('stage', {'n': 1}), ('stage', {'n': 2})])
+
+    first = queue.claim('a')
+    second = queue.claim('b')
+    assert first['payload'] == {'n': 1} and second['payload'] == {'n': 2}
+    assert queue.claim('c') is None
+
+    queue.complete(first['id'], 'a', {'dataValues': []})
+    queue.fail(second['id'], 'b', 'boom')
+    assert [unit['status'] for unit in queue.collect(run_id)] == ['done']
+    # The failed unit is handed out again, and given up once its last lease expires
+    assert queue.claim('c')['id'] == second['id']
+    queue.lease_seconds = -1
+    assert queue.claim('d') is None
+    # A worker whose unit was given up cannot report it any more
+    queue.complete(second['id'], 'c', {'dataValues': []})
+    assert queue.outstanding(run_id) == 0
+    assert [(unit['status'], unit['error']) for unit in queue.collect(run_id)] == \
+           [('failed', 'No worker finished the unit within its lease')]
+    queue.finish_run(run_id)
+    assert queue.collect(run_id) == []
+
+
+def _stored_values(instance):
+    return {key: dv['value'] for key, dv in instance.stored_values.items() if dv is not None}
+
+
+async def _run(instance, config, queue_path):
+    app = create_app(instance)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        base_url = str(server.make_url('')).rstrip('/')
+        config = {**config, 'server': {**config['server'], 'base_url': base_url}}
+
+        local = await DataQualityMonitor(copy.deepcopy(config)).run_all_stages()
+        local_values = _stored_values(instance)
+        instance.stored_values.clear()
+        instance.deleted_values.clear()
+
+        queue = WorkQueue(queue_path)
+        coordinator = Coordinator(DataQualityMonitor(copy.deepcopy(config)), queue, include_min_max=True,
+                                  poll_interval=0.05)
+        workers = [Worker(DataQualityMonitor(copy.deepcopy(config)), queue, name=f'worker-{i}', poll_interval=0.05,
+                          idle_timeout=1)
+                   for i in range(2)]
+        distributed, *units_run = await asyncio.gather(coordinator.run(), *[worker.run() for worker in workers])
+        return local, local_values, distributed, units_run
+    finally:
+        await server.close()
+
+
+def test_workers_run_the_units_the_coordinator_posts(tmp_path):
+    instance = SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13)
+    config = build_config(instance, 'http://placeholder')
+    config['server']['distributed'] = {'org_units_per_unit': 3}
+
+    local, local_values, distributed, units_run = asyncio.run(_run(instance, config, tmp_path / 'queue.sqlite'))
+
+    assert local['errors'] == [] and distributed['errors'] == []
+    # Every stage is split into units which both workers take a share of
+    assert distributed['work_units']['failed'] == 0
+    assert distributed['work_units']['total'] == sum(units_run) > len(config['analyzer_stages'])
+    assert all(units_run)
+    assert distributed['data_values_posted'] == local['data_values_posted']
+    assert _stored_values(instance) == local_values
+    assert distributed['min_max']['imported'] > 0
+
+
+def test_expired_leases_are_handed_back_by_the_coordinator(tmp_path):
+    queue = WorkQueue(tmp_path / 'queue.sqlite', lease_seconds=60, max_attempts=2)
+    run_id = queue.create_run([('stage', {'n': 1})])
+    unit = queue.claim('a')
+    queue.lease_seconds = -1
+    queue.expire()
+    queue.lease_seconds = 60
+    assert queue.claim('b')['id'] == unit['id']
+    # The worker which lost the lease cannot report any more
+    queue.complete(unit['id'], 'a', {})
+    assert queue.outstanding(run_id) == 1
+
+
+async def _run_without_workers(instance, config, queue_path):
+    app = create_app(instance)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        config = {**config, 'server': {**config['server'], 'base_url': str(server.make_url('')).rstrip('/')}}
+        coordinator = Coordinator(DataQualityMonitor(config), WorkQueue(queue_path), poll_interval=0.05,
+                                  workers_failed=lambda: 'All local worker processes failed')
+        return await asyncio.wait_for(coordinator.run(), timeout=30)
+    finally:
+        await server.close()
+
+
+def test_coordinator_gives_up_when_its_workers_failed(tmp_path):
+    instance = SyntheticInstance(branching=(2, 3), data_elements=6, data_sets=1, months=13)
+    config = build_config(instance, 'http://placeholder', level=2, stages=['outlier'])
+
+    result = asyncio.run(_run_without_workers(instance, config, tmp_path / 'queue.sqlite'))
+
+    assert result['work_units']['total'] == result['work_units']['failed'] > 0
+    assert all('All local worker processes failed' in error for error in result['errors'])
+    assert result['data_values_posted'] == 0
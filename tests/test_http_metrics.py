@@ -0,0 +1,115 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+from app.core.api_utils import Dhis2ApiUtils
+from app.core.dhis2_client import Dhis2Client
+from app.core.http_metrics import HttpMetrics, format_prometheus, metrics_family, write_prometheus_textfile
+
+
+def test_metrics_family_groups_known_endpoints_and_defaults_to_metadata():
+    assert metrics_family('https://x.org/api/dataAnalysis/validationRules') == 'dataAnalysis/validationRules'
+    assert metrics_family('/api/40/dataValueSets.json') == 'dataValueSets'
+    assert metrics_family('/api/dataEntry/minMaxValues') == 'minMaxDataElements'
+    assert metrics_family('/api/organisationUnits.json') == 'metadata'
+
+
+def test_requests_through_the_client_are_recorded_per_family(tmp_path):
+    payload = {'dataValues': [{'dataElement': 'de', 'value': str(i)} for i in range(200)]}
+
+    async def data_value_sets(request):
+        if request.method == 'POST':
+            await request.read()
+            return web.json_response({'status': 'OK'})
+        return web.json_response(payload)
+
+    async def run():
+        app = web.Application()
+        app.router.add_route('*', '/api/dataValueSets.json', data_value_sets)
+        app.router.add_route('*', '/api/dataValueSets', data_value_sets)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            base_url = str(server.make_url('')).rstrip('/')
+            client = Dhis2Client(base_url, 'tok')
+            utils = Dhis2ApiUtils(base_url, 'tok', client=client)
+            metrics = HttpMetrics()
+            client.add_listener(metrics)
+            async with client.session() as session:
+                await utils.fetch_datavalue_sets({'dataSet': 'x'}, session)
+                await utils.post_data_value_set(payload, session)
+            return metrics.summary()
+        finally:
+            await server.close()
+
+    summary = asyncio.run(run())
+    stats = summary['dataValueSets']
+    assert stats['requests'] == 2
+    assert stats['status_codes'] == {'200': 2}
+    assert stats['bytes_sent'] > 1000
+    assert stats['bytes_received'] > 1000
+    assert stats['latency_seconds']['buckets']['+Inf'] == 2
+
+    text = format_prometheus(summary, {'duration_seconds': 1.5})
+    assert 'dq_workbench_http_requests_total{endpoint="dataValueSets",status="200"} 2' in text
+    assert 'dq_workbench_run_duration_seconds 1.5' in text
+
+    path = tmp_path / 'dq.prom'
+    write_prometheus_textfile(str(path), summary)
+    assert path.read_text().startswith('# HELP')
+
+
+def test_concurrent_runs_only_count_their_own_requests():
+    instance = SyntheticInstance(branching=(2, 3), data_elements=6, data_sets=1, months=13)
+
+    async def run():
+        server = TestServer(create_app(instance))
+        await server.start_server()
+        try:
+            base_url = str(server.make_url('')).rstrip('/')
+            outliers = build_config(instance, base_url, level=2, stages=['outlier'])
+            violations = build_config(instance, base_url, level=2, stages=['validation_rules'])
+            return await asyncio.gather(DataQualityMonitor(outliers).run_all_stages(),
+                                        DataQualityMonitor(violations).run_all_stages())
+        finally:
+            await server.close()
+
+    outlier_run, violation_run = asyncio.run(run())
+    assert 'outlierDetection' in outlier_run['http_metrics']
+    assert 'dataAnalysis/validationRules' not in outlier_run['http_metrics']
+    assert 'dataAnalysis/validationRules' in violation_run['http_metrics']
+    assert 'outlierDetection' not in violation_run['http_metrics']
+
+
+def test_requests_of_the_synchronous_helpers_are_recorded():
+    data_sets = {'dataSets': [{'id': f'ds{i}', 'name': f'Data set {i}'} for i in range(50)]}
+
+    async def metadata(request):
+        return web.json_response(data_sets)
+
+    async def run(client):
+        app = web.Application()
+        app.router.add_get('/api/dataSets.json', metadata)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            base_url = str(server.make_url('')).rstrip('/')
+            utils = Dhis2ApiUtils(base_url, 'tok', client=client)
+            # The helper blocks, so it runs off the loop serving the requests
+            return await asyncio.to_thread(utils.fetch_data_sets)
+        finally:
+            await server.close()
+
+    client = Dhis2Client('http://placeholder', 'tok')
+    metrics = HttpMetrics()
+    client.add_listener(metrics)
+    assert asyncio.run(run(client)) == data_sets['dataSets']
+
+    summary = metrics.summary()['metadata']
+    assert summary['requests'] == 1 and summary['status_codes'] == {'200': 1}
+    assert summary['bytes_received'] > 1000
@@ -0,0 +1,120 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from aiohttp.test_utils import TestServer
+
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.analyzers.incremental import IncrementalPlanner
+from app.cli import DataQualityMonitor
+from app.core.checkpoint_store import CheckpointStore
+
+COC = 'HllvX50cXC0'
+STAGE = {'name': 'Outliers', 'type': 'outlier', 'params': {'dataset': 'ds1', 'duration': '12 months'}}
+
+
+def test_checkpoints_force_a_full_run_when_missing_stale_or_reconfigured(tmp_path):
+    store = CheckpointStore(tmp_path / 'checkpoints.sqlite', full_run_after=100)
+    assert store.needs_full_run(STAGE, store.get('Outliers'))
+
+    store.save('Outliers', store.fingerprint(STAGE), started_at=1000.0, full_run=True)
+    store.save('Outliers', store.fingerprint(STAGE), started_at=1050.0, full_run=False)
+    checkpoint = store.get('Outliers')
+    assert checkpoint['started_at'] == 1050.0 and checkpoint['full_run_at'] == 1000.0
+    assert not store.needs_full_run(STAGE, checkpoint, now=1080.0)
+    assert store.needs_full_run(STAGE, checkpoint, now=1100.0)
+
+    changed = {**STAGE, 'params': {**STAGE['params'], 'duration': '24 months'}}
+    assert store.needs_full_run(changed, checkpoint, now=1080.0)
+    # Switching incremental runs off and on again does not change what the stage computes
+    toggled = {**STAGE, 'params': {**STAGE['params'], 'incremental': True}}
+    assert not store.needs_full_run(toggled, checkpoint, now=1080.0)
+
+
+def _instance():
+    return SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13, outlier_rate=0.3)
+
+
+async def _run_twice(instance, tmp_path, between):
+    server = TestServer(create_app(instance))
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), stages=['outlier', 'validation_rules'])
+        config['analyzer_stages'] = [config['analyzer_stages'][0], config['analyzer_stages'][len(instance.data_sets)]]
+        config['server']['incremental'] = {'enabled': True, 'path': str(tmp_path), 'overlap': 0}
+        first = await DataQualityMonitor(config).run_all_stages()
+        between()
+        second = await DataQualityMonitor(config).run_all_stages()
+        return first, second
+    finally:
+        await server.close()
+
+
+def test_incremental_run_only_reanalyses_changed_periods_and_org_units(tmp_path):
+    instance = _instance()
+    dataset = instance.data_sets[0]['id']
+    destination = instance.outlier_data_elements[dataset]['id']
+    vrg = instance.validation_rule_groups[0]['id']
+    rule_data_elements = {rule[side]['expression'][2:-1] for rule in instance.collections['validationRules']
+                          for side in ('leftSide', 'rightSide') if rule['validationRuleGroups'][0]['id'] == vrg}
+    # An org unit and period with an outlier, whose source data is edited between the runs
+    outlier = next(o for o in instance.outliers([dataset], [instance.root], instance.periods[2:-1])
+                   if o['de'] in rule_data_elements)
+    ou, pe = outlier['ou'], outlier['pe']
+    # A count elsewhere that only a full run would correct
+    target = instance.ou_path(ou).split('/')[3]
+    other_ou = next(f for f in instance.facilities if f not in instance.facilities_under(target))
+    other_pe = next(p for p in instance.periods[2:-1] if p != pe)
+
+    def between():
+        instance.import_data_values({'dataValues': [
+            {'dataElement': outlier['de'], 'orgUnit': ou, 'period': pe, 'categoryOptionCombo': outlier['coc'],
+             'value': '5'},
+            {'dataElement': destination, 'orgUnit': ou, 'period': pe, 'categoryOptionCombo': COC, 'value': '99'},
+            {'dataElement': destination, 'orgUnit': other_ou, 'period': other_pe, 'categoryOptionCombo': COC,
+             'value': '99'},
+        ]})
+
+    first, second = asyncio.run(_run_twice(instance, tmp_path, between))
+
+    assert first['errors'] == [] and first['data_values_posted'] > 0
+    assert second['errors'] == []
+    assert second['http_metrics']['outlierDetection']['requests'] == 1
+    assert second['http_metrics']['dataAnalysis/validationRules']['requests'] == 1
+    # The count for the edited period is recalculated, the other one is carried forward
+    assert instance.stored_values[(destination, ou, pe, COC)]['value'] != '99'
+    assert instance.stored_values[(destination, other_ou, other_pe, COC)]['value'] == '99'
+    assert second['data_values_posted'] == 1 and second['data_values_deleted'] == 0
+
+
+class ChangedDataApi:
+    """The api_utils calls of the planner, for one changed value in the current month."""
+
+    def __init__(self, period):
+        self.period = period
+
+    async def get_organisation_units_at_level(self, level, session, semaphore):
+        return ['root']
+
+    async def fetch_datavalue_sets(self, params, session, consume, semaphore):
+        consume({'orgUnit': 'facility', 'period': self.period})
+
+    async def get_organisation_unit_paths(self, org_units, session, semaphore):
+        return {'facility': '/root/district/facility'}
+
+
+def test_changes_in_the_open_period_are_reanalysed_up_to_the_end_date():
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=365)
+    current = end_date.strftime('%Y%m')
+    planner = IncrementalPlanner(ChangedDataApi(current))
+    stage = {**STAGE, 'params': {**STAGE['params'], 'level': 2}}
+    since = end_date.timestamp() - 60
+
+    scopes = asyncio.run(planner._scopes(stage, start_date, end_date, [[('dataSet', 'ds1')]], ['Monthly'],
+                                         since, end_date.timestamp(), None, None))
+
+    changed = [scope for scope in scopes if scope.org_units is not None]
+    assert [(scope.org_units, scope.windows) for scope in changed] == \
+           [(['district'], [(datetime.strptime(current, '%Y%m'), end_date)])]
@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+from aiohttp.test_utils import TestServer
+
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import INTEGRITY_JOBS, STATS, create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+
+
+def _posted_integrity_counts(instance):
+    codes = {de['id']: de['code'][3:] for de in instance.integrity_group['dataElements']}
+    return {codes[de]: int(dv['value']) for (de, _, _, _), dv in instance.stored_values.items() if de in codes}
+
+
+async def _run_integrity_stage_twice(instance, job_seconds):
+    app = create_app(instance, integrity_job_seconds=job_seconds)
+    # A slow job someone else started, for a check this stage does not monitor
+    app[INTEGRITY_JOBS]['someone_elses_check'] = (time.monotonic() + 3600, None, None)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), stages=['integrity_checks'])
+        durations, results = [], []
+        for _ in range(2):
+            started = time.monotonic()
+            results.append(await DataQualityMonitor(config).run_all_stages())
+            durations.append(time.monotonic() - started)
+        return durations, results
+    finally:
+        await server.close()
+
+
+def test_integrity_stage_waits_only_for_its_own_checks_to_finish_again():
+    instance = SyntheticInstance(branching=(2, 2), data_elements=4, data_sets=1, months=3)
+    durations, results = asyncio.run(_run_integrity_stage_twice(instance, job_seconds=0.3))
+
+    assert all(result['errors'] == [] for result in results)
+    # Neither run waits for the unrelated job, and the second one waits for fresh summaries
+    # instead of reusing those of the first run
+    assert all(0.3 <= duration < 3 for duration in durations)
+    expected = {check['code']: instance.integrity_count(check['name']) for check in instance.integrity_checks
+                if check['code'] in _posted_integrity_counts(instance)}
+    assert expected and _posted_integrity_counts(instance) == expected
+
+
+async def _run_config(instance, configure):
+    app = create_app(instance)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), stages=['integrity_checks'])
+        configure(config)
+        return await DataQualityMonitor(config).run_all_stages(), app[STATS]
+    finally:
+        await server.close()
+
+
+def test_integrity_stages_share_one_summary_job():
+    instance = SyntheticInstance(branching=(2, 2), data_elements=4, data_sets=1, months=3)
+
+    def two_stages(config):
+        stage = config['analyzer_stages'][0]
+        config['analyzer_stages'].append({**stage, 'name': 'Metadata integrity again', 'params': dict(stage['params'])})
+
+    result, stats = asyncio.run(_run_config(instance, two_stages))
+
+    assert result['errors'] == []
+    monitored = {de['code'][3:] for de in instance.integrity_group['dataElements']}
+    known = monitored & {check['code'] for check in instance.integrity_checks}
+    # The checks of both stages are triggered once, and both stages post their counts
+    assert stats['integrity_checks_triggered'] == len(known)
+    assert result['data_values_posted'] == 2 * len(monitored)
+
+
+async def _run_with_max_age(instance, max_age, between):
+    app = create_app(instance, integrity_job_seconds=0.3)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), stages=['integrity_checks'])
+        config['analyzer_stages'][0]['params']['max_age'] = max_age
+        triggered, durations = [], []
+        for i in range(3):
+            started = time.monotonic()
+            result = await DataQualityMonitor(config).run_all_stages()
+            assert result['errors'] == []
+            durations.append(time.monotonic() - started)
+            triggered.append(app[STATS]['integrity_checks_triggered'] - sum(triggered))
+            between(i, app)
+        return triggered, durations
+    finally:
+        await server.close()
+
+
+def test_recent_integrity_summaries_are_reused_until_they_reach_max_age():
+    instance = SyntheticInstance(branching=(2, 2), data_elements=4, data_sets=1, months=3)
+    monitored = {de['code'][3:] for de in instance.integrity_group['dataElements']}
+    known = [check for check in instance.integrity_checks if check['code'] in monitored]
+
+    def age_one_check(i, app):
+        if i == 1:
+            app[INTEGRITY_JOBS][known[0]['name']] = (time.monotonic() - 1, '2000-01-01T00:00:00.000', None)
+
+    triggered, durations = asyncio.run(_run_with_max_age(instance, 3600, age_one_check))
+
+    # Everything runs first, nothing while the summaries are recent, then only the stale check
+    assert triggered == [len(known), 0, 1]
+    assert durations[1] < 0.3 <= durations[2]
+    assert _posted_integrity_counts(instance) == {check['code']: instance.integrity_count(check['name'])
+                                                  for check in known}
@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.core.api_utils import Dhis2ApiUtils
+from app.core.dhis2_client import Dhis2Client
+from app.core.json_stream import JsonArrayStreamParser
+
+DATA_VALUE_SET = {
+    'dataSet': 'BfMAe6Itzgt',
+    'period': '202401',
+    'dataValues': [
+        {'dataElement': f'de{i % 3}', 'period': '202401', 'value': str(i), 'comment': 'ü "quoted" ]}'}
+        for i in range(30)
+    ],
+    'orgUnit': 'DiszpKrYNg8',
+}
+
+
+def _parse_in_chunks(raw, chunk_size):
+    parser = JsonArrayStreamParser('dataValues')
+    items = []
+    for i in range(0, len(raw), chunk_size):
+        items.extend(parser.feed(raw[i:i + chunk_size]))
+    items.extend(parser.close())
+    return parser, items
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 64, 1 << 20])
+def test_parser_yields_items_across_chunk_boundaries(chunk_size):
+    raw = json.dumps(DATA_VALUE_SET).encode('utf-8')
+    parser, items = _parse_in_chunks(raw, chunk_size)
+    assert items == DATA_VALUE_SET['dataValues']
+    assert parser.envelope == {'dataSet': 'BfMAe6Itzgt', 'period': '202401', 'orgUnit': 'DiszpKrYNg8'}
+
+
+def test_parser_handles_missing_array_and_rejects_truncated_input():
+    assert _parse_in_chunks(b'{}', 1)[1] == []
+    with pytest.raises(json.JSONDecodeError):
+        _parse_in_chunks(json.dumps(DATA_VALUE_SET).encode('utf-8')[:-10], 7)
+
+
+def test_fetch_datavalue_sets_applies_predicate_while_streaming():
+    async def data_value_sets(request):
+        return web.Response(body=json.dumps(DATA_VALUE_SET).encode('utf-8'), content_type='application/json')
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/api/dataValueSets.json', data_value_sets)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            base_url = str(server.make_url('')).rstrip('/')
+            client = Dhis2Client(base_url, 'tok')
+            utils = Dhis2ApiUtils(base_url, 'tok', client=client)
+            async with client.session() as session:
+                return await utils.fetch_datavalue_sets({'dataSet': 'BfMAe6Itzgt'}, session,
+                                                        predicate=lambda dv: dv['dataElement'] == 'de1')
+        finally:
+            await server.close()
+
+    result = asyncio.run(run())
+    assert result['period'] == '202401'
+    assert [dv['value'] for dv in result['dataValues']] == [str(i) for i in range(1, 30, 3)]
@@ -0,0 +1,76 @@
+import asyncio
+from datetime import datetime
+
+from aiohttp.test_utils import TestServer
+
+from app.analyzers.local_outlier_engine import LocalOutlierEngine
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+
+YEAR = (datetime(2024, 1, 1), datetime(2024, 12, 31))
+
+
+def _values(ou, de, values, coc='coc1'):
+    return [{'orgUnit': ou, 'dataElement': de, 'categoryOptionCombo': coc, 'attributeOptionCombo': 'aoc1',
+             'period': f'2024{month:02d}', 'value': value} for month, value in enumerate(values, start=1)]
+
+
+def test_local_engine_scores_every_series_at_once():
+    values = (_values('ou1', 'de1', ['10', '11', '9', '10', '12', '10', '11', '9', '10', '100'])
+              + _values('ou2', 'de1', ['5'] * 10)
+              + _values('ou2', 'de2', ['7', 'not a number', '7', '8', '70'])
+              + [{**_values('ou1', 'de2', ['500'])[0], 'deleted': True}])
+
+    mod_z = LocalOutlierEngine('MOD_Z_SCORE', 3, YEAR).detect(values)
+    assert sorted((o['ou'], o['de'], o['pe']) for o in mod_z) == [('ou1', 'de1', '202410'), ('ou2', 'de2', '202405')]
+    assert mod_z[0]['value'] == 100.0
+
+    # A single extreme value in ten can reach a Z-score of at most 3 (n - 1) / sqrt(n) = 2.85
+    assert LocalOutlierEngine('Z_SCORE', 3, YEAR).detect(values) == []
+    z_score = LocalOutlierEngine('Z_SCORE', 2.5, YEAR, numeric_data_elements={'de1'}).detect(values)
+    assert [(o['ou'], o['pe']) for o in z_score] == [('ou1', '202410')]
+
+
+def test_local_engine_checks_the_window_against_statistics_and_bounds():
+    values = _values('ou1', 'de1', ['10', '11', '9', '10', '12', '10', '11', '9', '10', '100'])
+    # The outlier lies outside the checked months, but still widens the statistics
+    first_half = (datetime(2024, 1, 1), datetime(2024, 6, 30))
+    assert LocalOutlierEngine('MOD_Z_SCORE', 3, first_half, YEAR).detect(values) == []
+    last_months = (datetime(2024, 9, 1), datetime(2024, 12, 31))
+    assert [o['pe'] for o in LocalOutlierEngine('MOD_Z_SCORE', 3, last_months, YEAR).detect(values)] == ['202410']
+    # Only complete periods are checked
+    assert LocalOutlierEngine('MOD_Z_SCORE', 3, (datetime(2024, 10, 2), datetime(2024, 12, 31)),
+                              YEAR).detect(values) == []
+
+    bounds = {('ou1', 'de1', 'coc1'): (9.5, 11.5)}
+    min_max = LocalOutlierEngine('MIN_MAX', 0, YEAR, min_max_bounds=bounds).detect(values)
+    assert sorted(o['pe'] for o in min_max) == ['202403', '202405', '202408', '202410']
+
+
+async def _run_outlier_stages(instance, engine):
+    server = TestServer(create_app(instance))
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), stages=['outlier'])
+        for stage in config['analyzer_stages']:
+            stage['params'].update(engine=engine, threshold=10)
+        return await DataQualityMonitor(config).run_all_stages()
+    finally:
+        await server.close()
+
+
+def test_local_engine_stage_finds_the_injected_outliers_without_outlier_detection_requests():
+    def instance():
+        return SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13, outlier_rate=0.3)
+
+    server_instance, local_instance = instance(), instance()
+    server_result = asyncio.run(_run_outlier_stages(server_instance, 'server'))
+    local_result = asyncio.run(_run_outlier_stages(local_instance, 'local'))
+
+    assert local_result['errors'] == []
+    assert 'outlierDetection' not in local_result['http_metrics']
+    assert server_result['data_values_posted'] > 0
+    for key, stored in server_instance.stored_values.items():
+        assert int(local_instance.stored_values[key]['value']) >= int(stored['value'])
@@ -0,0 +1,115 @@
+import asyncio
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import pytest
+from aiohttp.test_utils import TestServer
+
+from app.analyzers.local_validation_engine import LocalValidationRuleEngine
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+from app.core.period_utils import Dhis2PeriodUtils
+
+DE_A, DE_B, COC_1, COC_2, CONST = 'deAAAAAAAAA', 'deBBBBBBBBB', 'coc11111111', 'coc22222222', 'constCCCCCC'
+
+
+def _rule(uid, left, operator, right, strategy=None, period_type='Monthly'):
+    sides = {side: {'expression': expression} for side, expression in (('leftSide', left), ('rightSide', right))}
+    if strategy:
+        sides['rightSide']['missingValueStrategy'] = strategy
+    return {'id': uid, 'operator': operator, 'periodType': period_type, **sides}
+
+
+def _dv(ou, pe, de, coc, value):
+    return {'orgUnit': ou, 'period': pe, 'dataElement': de, 'categoryOptionCombo': coc,
+            'attributeOptionCombo': 'aoc', 'value': value}
+
+
+def test_local_engine_evaluates_every_rule_for_all_org_units_and_periods():
+    engine = LocalValidationRuleEngine([
+        _rule('total_le', f'#{{{DE_A}}}', 'less_than_or_equal_to', f'#{{{DE_B}}} * C{{{CONST}}}'),
+        _rule('combo_eq', f'#{{{DE_A}.{COC_1}}}', 'equal_to', f'#{{{DE_A}.{COC_2}}}', 'NEVER_SKIP'),
+        _rule('any_missing', f'#{{{DE_A}}}', 'less_than', f'#{{{DE_B}}} - 100', 'SKIP_IF_ANY_VALUE_MISSING'),
+        _rule('pair', f'#{{{DE_A}}}', 'compulsory_pair', f'#{{{DE_B}}}'),
+        _rule('quarterly', f'#{{{DE_A}}}', 'less_than', '0', period_type='Quarterly'),
+    ], constants={CONST: 2})
+    assert engine.data_elements == [DE_A, DE_B]
+
+    violations = engine.evaluate([
+        # A = 30 > B * 2 = 20, the combos differ and A is not below B - 100
+        _dv('ou1', '202401', DE_A, COC_1, '10'), _dv('ou1', '202401', DE_A, COC_2, '20'),
+        _dv('ou1', '202401', DE_B, COC_1, '10'),
+        # A = 10 <= B * 2 = 12, but the missing second combo counts as 0 and A is not below B - 100
+        _dv('ou1', '202402', DE_A, COC_1, '10'), _dv('ou1', '202402', DE_B, COC_1, '6'),
+        # B is missing (its only value is deleted): only the pair is evaluated, and violated
+        _dv('ou2', '202401', DE_A, COC_1, '5'), _dv('ou2', '202401', DE_A, COC_2, '5'),
+        {**_dv('ou2', '202401', DE_B, COC_1, '500'), 'deleted': True},
+        _dv('ou3', '202401', DE_A, COC_1, 'not a number'),
+    ])
+    assert sorted((v['validationRuleId'], v['organisationUnitId'], v['periodId']) for v in violations) == [
+        ('any_missing', 'ou1', '202401'),
+        ('any_missing', 'ou1', '202402'),
+        ('combo_eq', 'ou1', '202401'),
+        ('combo_eq', 'ou1', '202402'),
+        ('pair', 'ou2', '202401'),
+        ('total_le', 'ou1', '202401'),
+    ]
+
+
+def test_local_engine_skips_rules_with_a_division_by_zero():
+    """DHIS2 treats a side dividing by zero as missing, so the rule is not checked."""
+    engine = LocalValidationRuleEngine([
+        _rule('ratio', f'#{{{DE_A}}} / #{{{DE_B}}}', 'less_than', '1', 'NEVER_SKIP'),
+    ])
+    violations = engine.evaluate([
+        _dv('ou1', '202401', DE_A, COC_1, '5'), _dv('ou1', '202401', DE_B, COC_1, '0'),
+        _dv('ou2', '202401', DE_A, COC_1, '5'), _dv('ou2', '202401', DE_B, COC_1, '2'),
+    ])
+    assert [v['organisationUnitId'] for v in violations] == ['ou2']
+
+
+def test_local_engine_rejects_rules_it_cannot_evaluate():
+    with pytest.raises(ValueError, match='cannot evaluate'):
+        LocalValidationRuleEngine([_rule('oug', f'#{{{DE_A}}}', 'less_than', 'OUG{oug11111111}')])
+    with pytest.raises(ValueError, match='cannot evaluate'):
+        LocalValidationRuleEngine([_rule('call', f'#{{{DE_A}}}', 'less_than', '__import__("os")')])
+    with pytest.raises(ValueError, match='unknown constant'):
+        LocalValidationRuleEngine([_rule('const', f'#{{{DE_A}}}', 'less_than', f'C{{{CONST}}}')])
+
+
+async def _run_validation_stage(instance):
+    server = TestServer(create_app(instance))
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), stages=['validation_rules'])
+        config['analyzer_stages'] = config['analyzer_stages'][:1]
+        config['analyzer_stages'][0]['params']['engine'] = 'local'
+        return config['analyzer_stages'][0], await DataQualityMonitor(config).run_all_stages()
+    finally:
+        await server.close()
+
+
+def test_local_engine_stage_posts_the_violations_of_the_stored_data():
+    instance = SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13)
+    group = instance.validation_rule_groups[0]
+    rules = [instance.get('validationRules', r['id']) for r in group['validationRules']]
+    sides = [(rule['leftSide']['expression'][2:-1], rule['rightSide']['expression'][2:-1]) for rule in rules]
+    periods = instance.periods_between(Dhis2PeriodUtils.get_start_date_from_today('12 months').date(),
+                                       datetime.now().date())
+    totals = defaultdict(float)
+    for dv in instance.data_values({de for pair in sides for de in pair}, [instance.root], periods, children=True):
+        totals[(dv['orgUnit'], dv['period'], dv['dataElement'])] += float(dv['value'])
+    # A rule with a side without any values is skipped
+    expected = Counter((ou, pe) for ou, pe in {(ou, pe) for ou, pe, _ in totals} for left, right in sides
+                       if totals.get((ou, pe, right), float('inf')) < totals.get((ou, pe, left), float('-inf')))
+
+    stage, result = asyncio.run(_run_validation_stage(instance))
+
+    assert result['errors'] == []
+    assert 'dataAnalysis/validationRules' not in result['http_metrics']
+    destination = stage['params']['destination_data_element']
+    posted = {(ou, pe): int(dv['value']) for (de, ou, pe, _), dv in instance.stored_values.items()
+              if de == destination and dv is not None}
+    assert posted == {key: count for key, count in expected.items() if count}
@@ -0,0 +1,85 @@
+import asyncio
+
+from app.core.metadata_cache import MetadataCache
+
+
+class FakeServer:
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = []
+
+    def fetch(self, filters, fields):
+        self.requests.append(list(filters))
+        since = next((f.split(':', 2)[2] for f in filters if f.startswith('lastUpdated:gt:')), None)
+        return [o for o in self.objects if since is None or o['lastUpdated'] > since]
+
+
+def _make_cache(tmp_path, **kwargs):
+    return MetadataCache(tmp_path / 'cache.sqlite', **kwargs)
+
+
+def test_fresh_entries_are_served_without_fetching(tmp_path):
+    server = FakeServer([{'id': 'a', 'name': 'A', 'lastUpdated': '2024-01-01T00:00:00.000'}])
+    cache = _make_cache(tmp_path)
+
+    first = cache.get_or_fetch('dataSets', server.fetch, fields=['id', 'name'])
+    second = cache.get_or_fetch('dataSets', server.fetch, fields=['id', 'name'])
+
+    assert first == second == server.objects
+    assert len(server.requests) == 1
+
+
+def test_expired_entries_only_request_newer_objects(tmp_path):
+    server = FakeServer([
+        {'id': 'a', 'name': 'A', 'lastUpdated': '2024-01-01T00:00:00.000'},
+        {'id': 'b', 'name': 'B', 'lastUpdated': '2024-01-02T00:00:00.000'},
+    ])
+    cache = _make_cache(tmp_path, ttls={'dataSets': 0})
+    cache.get_or_fetch('dataSets', server.fetch, filters=['periodType:eq:Monthly'])
+
+    server.objects = [
+        {'id': 'a', 'name': 'A renamed', 'lastUpdated': '2024-02-01T00:00:00.000'},
+        {'id': 'b', 'name': 'B', 'lastUpdated': '2024-01-02T00:00:00.000'},
+        {'id': 'c', 'name': 'C', 'lastUpdated': '2024-02-02T00:00:00.000'},
+    ]
+    merged = cache.get_or_fetch('dataSets', server.fetch, filters=['periodType:eq:Monthly'])
+
+    assert server.requests[1] == ['periodType:eq:Monthly', 'lastUpdated:gt:2024-01-02T00:00:00.000']
+    assert [o['id'] for o in merged] == ['a', 'b', 'c']
+    assert merged[0]['name'] == 'A renamed'
+
+
+def test_invalidate_forces_full_fetch(tmp_path):
+    server = FakeServer([{'id': 'a', 'lastUpdated': '2024-01-01T00:00:00.000'}])
+    cache = _make_cache(tmp_path)
+
+    asyncio.run(cache.get_or_fetch_async('organisationUnits', _async(server.fetch), ['level:eq:3'], ['id']))
+    cache.invalidate('organisationUnits')
+    asyncio.run(cache.get_or_fetch_async('organisationUnits', _async(server.fetch), ['level:eq:3'], ['id']))
+
+    assert server.requests == [['level:eq:3'], ['level:eq:3']]
+
+
+def test_from_config_is_disabled_by_default_and_keyed_per_server(tmp_path):
+    assert MetadataCache.from_config({'server': {'base_url': 'https://a.example.org'}}) is None
+
+    settings = {'enabled': True, 'path': str(tmp_path)}
+    a = MetadataCache.from_config({'server': {'base_url': 'https://a.example.org', 'metadata_cache': settings}})
+    b = MetadataCache.from_config({'server': {'base_url': 'https://b.example.org', 'metadata_cache': settings}})
+    assert a.path != b.path
+    assert a.path.parent == b.path.parent == tmp_path
+
+
+def test_the_database_is_created_on_first_use(tmp_path):
+    cache = MetadataCache(tmp_path / 'cache' / 'cache.sqlite')
+    assert not cache.path.parent.exists()
+
+    server = FakeServer([{'id': 'a', 'lastUpdated': '2024-01-01T00:00:00.000'}])
+    assert asyncio.run(cache.get_or_fetch_async('dataSets', _async(server.fetch), fields=['id'])) == server.objects
+    assert cache.path.exists()
+
+
+def _async(fetch):
+    async def wrapper(filters, fields):
+        return fetch(filters, fields)
+    return wrapper
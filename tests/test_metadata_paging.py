@@ -0,0 +1,83 @@
+import asyncio
+from contextlib import aclosing
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from app.core.api_utils import Dhis2ApiUtils
+from app.core.dhis2_client import Dhis2Client
+
+ORG_UNITS = [{'id': f'ou{i:09d}'} for i in range(25)]
+
+
+def _make_app(requested_pages):
+    async def organisation_units(request):
+        page = int(request.query['page'])
+        page_size = int(request.query['pageSize'])
+        requested_pages.append(page)
+        items = ORG_UNITS[(page - 1) * page_size:page * page_size]
+        pager = {'page': page, 'pageSize': page_size}
+        if page * page_size < len(ORG_UNITS):
+            pager['nextPage'] = f'/api/organisationUnits.json?page={page + 1}'
+        return web.json_response({'pager': pager, 'organisationUnits': items})
+
+    app = web.Application()
+    app.router.add_get('/api/organisationUnits.json', organisation_units)
+    return app
+
+
+async def _with_utils(requested_pages, body):
+    server = TestServer(_make_app(requested_pages))
+    await server.start_server()
+    try:
+        base_url = str(server.make_url('')).rstrip('/')
+        client = Dhis2Client(base_url, 'tok')
+        client.metadata_page_size = 10
+        utils = Dhis2ApiUtils(base_url, 'tok', client=client)
+        async with client.session() as session:
+            return await body(utils, session)
+    finally:
+        await server.close()
+
+
+def test_org_units_at_level_walks_every_page():
+    requested_pages = []
+
+    async def body(utils, session):
+        return await utils.get_organisation_units_at_level(3, session, asyncio.Semaphore(2))
+
+    ids = asyncio.run(_with_utils(requested_pages, body))
+    assert ids == [ou['id'] for ou in ORG_UNITS]
+    assert requested_pages == [1, 2, 3]
+
+
+def test_iterator_stops_fetching_when_caller_breaks():
+    requested_pages = []
+
+    async def body(utils, session):
+        seen = []
+        items = utils.iter_metadata_async('organisationUnits', session, fields=['id'], page_size=10)
+        async with aclosing(items):
+            async for item in items:
+                seen.append(item)
+                if len(seen) == 5:
+                    break
+        return seen
+
+    seen = asyncio.run(_with_utils(requested_pages, body))
+    assert len(seen) == 5
+    # Page 2 may have been prefetched, but nothing beyond it
+    assert max(requested_pages) <= 2
+
+
+def test_concurrent_stages_share_one_org_unit_lookup():
+    requested_pages = []
+
+    async def body(utils, session):
+        semaphore = asyncio.Semaphore(2)
+        return await asyncio.gather(*(utils.get_organisation_units_at_level(3, session, semaphore)
+                                      for _ in range(4)))
+
+    results = asyncio.run(_with_utils(requested_pages, body))
+    assert all(ids == [ou['id'] for ou in ORG_UNITS] for ids in results)
+    assert requested_pages == [1, 2, 3]
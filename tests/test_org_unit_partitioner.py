@@ -0,0 +1,117 @@
+import asyncio
+from collections import Counter
+from datetime import datetime
+
+from aiohttp.test_utils import TestServer
+
+from app.analyzers.org_unit_partitioner import OrgUnitPartitioner
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+from app.core.period_utils import Dhis2PeriodUtils
+
+
+class FakeApiUtils:
+    def __init__(self, parents):
+        self.parents = parents
+
+    async def get_organisation_unit_parents(self, level, session, semaphore):
+        return self.parents
+
+
+PARENTS = {'a1': 'A', 'a2': 'A', 'a3': 'A', 'b1': 'B', 'c1': 'C', 'c2': 'C', 'c3': 'C', 'c4': 'C'}
+
+
+def _plan(**kwargs):
+    partitioner = OrgUnitPartitioner(FakeApiUtils(PARENTS), max_org_units_per_request=3, **kwargs)
+    return [(r.org_units, r.scope) for r in asyncio.run(partitioner.plan(None, None, level=3))]
+
+
+def test_siblings_share_requests_without_mixing_parents():
+    assert _plan() == [
+        (['a1', 'a2', 'a3'], ['a1', 'a2', 'a3']),
+        (['b1'], ['b1']),
+        (['c1', 'c2', 'c3'], ['c1', 'c2', 'c3']),
+        (['c4'], ['c4']),
+    ]
+
+
+def test_single_org_unit_analyses_query_the_parent_of_small_groups():
+    assert _plan(multiple_org_units=False) == [
+        (['A'], ['a1', 'a2', 'a3']),
+        (['b1'], ['b1']),
+        (['c1'], ['c1']), (['c2'], ['c2']), (['c3'], ['c3']), (['c4'], ['c4']),
+    ]
+
+
+def _instance():
+    return SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13, outlier_rate=0.3)
+
+
+async def _run(instance, stages, level, **params):
+    server = TestServer(create_app(instance))
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), level=level, stages=stages)
+        config['analyzer_stages'] = config['analyzer_stages'][:1]
+        config['analyzer_stages'][0]['params'].update(params)
+        return await DataQualityMonitor(config).run_all_stages()
+    finally:
+        await server.close()
+
+
+def _stage_periods(instance):
+    start = Dhis2PeriodUtils.get_start_date_from_today('12 months')
+    return instance.periods_between(start.date(), datetime.now().date())
+
+
+def _posted_counts(instance, data_element):
+    return {(ou, pe): int(dv['value']) for (de, ou, pe, _), dv in instance.stored_values.items()
+            if de == data_element and dv is not None}
+
+
+def test_truncated_outlier_requests_are_split_until_complete():
+    instance = _instance()
+    dataset = instance.data_sets[0]['id']
+    expected = Counter((o['ou'], o['pe'])
+                       for o in instance.outliers([dataset], [instance.root], _stage_periods(instance)))
+    # Every facility has fewer than 6 outliers, but each level 2 org unit has far more
+    result = asyncio.run(_run(instance, ['outlier'], level=2, max_results=6))
+
+    assert result['errors'] == []
+    assert _posted_counts(instance, instance.outlier_data_elements[dataset]['id']) == expected
+    assert result['http_metrics']['outlierDetection']['requests'] > 2
+
+
+def test_org_units_still_truncated_without_children_are_reported():
+    instance = _instance()
+    result = asyncio.run(_run(instance, ['outlier'], level=2, max_results=3))
+
+    assert any('cannot be split further' in error for error in result['errors'])
+
+
+def test_validation_rule_analysis_runs_once_per_parent():
+    instance = _instance()
+    vrg = instance.validation_rule_groups[0]['id']
+    expected = Counter((v['organisationUnitId'], v['periodId'])
+                       for v in instance.validation_violations(vrg, [instance.root], _stage_periods(instance)))
+    result = asyncio.run(_run(instance, ['validation_rules'], level=3))
+
+    assert result['errors'] == []
+    assert _posted_counts(instance, instance.validation_data_elements[vrg]['id']) == expected
+    assert result['http_metrics']['dataAnalysis/validationRules']['requests'] == len(instance.levels[2])
+
+
+def test_sharded_outlier_stage_posts_the_same_counts():
+    instance = _instance()
+    dataset = instance.data_sets[0]['id']
+    expected = Counter((o['ou'], o['pe'])
+                       for o in instance.outliers([dataset], [instance.root], _stage_periods(instance)))
+    result = asyncio.run(_run(instance, ['outlier'], level=3, shard_duration='3 months'))
+
+    windows = Dhis2PeriodUtils.split_date_range(Dhis2PeriodUtils.get_start_date_from_today('12 months'),
+                                                datetime.now(), '3 months')
+    assert result['errors'] == []
+    assert _posted_counts(instance, instance.outlier_data_elements[dataset]['id']) == expected
+    assert result['http_metrics']['outlierDetection']['requests'] == len(windows) * len(instance.levels[2])
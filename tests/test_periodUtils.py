@@ -3,6 +3,8 @@ import sys
 import os
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from datetime import datetime
+
 from app.core.period_utils import Dhis2PeriodUtils
 class TestDhis2PeriodUtils(unittest.TestCase):
 
@@ -45,5 +47,22 @@ class TestDhis2PeriodUtils(unittest.TestCase):
         date = "2023-01-01"
         result = Dhis2PeriodUtils.current_monthly_period(date)
         self.assertEqual(result, "202301")
+
+    def test_split_date_range_aligns_windows_to_periods(self):
+        windows = Dhis2PeriodUtils.split_date_range(datetime(2021, 10, 17), datetime(2023, 2, 3), "6 months")
+        self.assertEqual([(start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")) for start, end in windows], [
+            ("2021-10-17", "2021-12-31"),
+            ("2022-01-01", "2022-06-30"),
+            ("2022-07-01", "2022-12-31"),
+            ("2023-01-01", "2023-02-03"),
+        ])
+
+    def test_split_date_range_starts_weeks_on_monday(self):
+        windows = Dhis2PeriodUtils.split_date_range(datetime(2024, 1, 3), datetime(2024, 1, 20), "1 week")
+        self.assertEqual([start.strftime("%Y-%m-%d") for start, _ in windows],
+                         ["2024-01-03", "2024-01-08", "2024-01-15"])
+        self.assertEqual(windows[0][1], datetime(2024, 1, 7))
+
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
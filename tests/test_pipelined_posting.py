@@ -0,0 +1,147 @@
+import asyncio
+import math
+import time
+
+from aiohttp.test_utils import TestServer
+
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import STATS, create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+from app.core.dhis2_client import Dhis2Client
+from app.core.result_poster import ResultPoster
+
+
+class _ResponseLog:
+    def __init__(self):
+        self.responses = []
+
+    def on_response(self, method, url, status, elapsed):
+        self.responses.append((time.monotonic(), method, url))
+
+
+async def _run(instance, configure, **app_options):
+    app = create_app(instance, latency_by_endpoint={'dataAnalysis/validationRules': 0.5}, **app_options)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), stages=['outlier', 'validation_rules'])
+        configure(config)
+        client = Dhis2Client.from_config(config)
+        log = _ResponseLog()
+        client.add_listener(log)
+        result = await DataQualityMonitor(config, client=client).run_all_stages()
+        result['stub_stats'] = app[STATS]
+        return result, log.responses
+    finally:
+        await server.close()
+
+
+def test_results_are_posted_while_slower_stages_still_analyse():
+    instance = SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13)
+
+    def one_stage_each(config):
+        config['analyzer_stages'] = [[s for s in config['analyzer_stages'] if s['type'] == stage_type][0]
+                                     for stage_type in ('outlier', 'validation_rules')]
+
+    result, responses = asyncio.run(_run(instance, one_stage_each))
+
+    assert result['errors'] == [] and result['data_values_posted'] > 0
+    first_post = min(t for t, method, url in responses if method == 'POST' and url == '/api/dataValueSets')
+    last_analysis = max(t for t, _, url in responses if url == '/api/dataAnalysis/validationRules')
+    assert first_post < last_analysis
+    stored = sum(1 for dv in instance.stored_values.values() if dv is not None)
+    assert stored == result['data_values_posted']
+
+
+def test_large_results_are_posted_in_batches():
+    instance = SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13)
+
+    def small_batches(config):
+        config['server']['post_batch_size'] = 2
+        config['analyzer_stages'] = [s for s in config['analyzer_stages'] if s['type'] == 'outlier']
+
+    result, responses = asyncio.run(_run(instance, small_batches))
+
+    assert result['errors'] == []
+    posts = sum(1 for _, method, url in responses if method == 'POST' and url == '/api/dataValueSets')
+    assert posts >= math.ceil(result['data_values_posted'] / 2) > 1
+
+
+def test_chunks_are_bounded_by_value_count_and_encoded_size():
+    values = [{'dataElement': 'de', 'orgUnit': f'ou{i}', 'value': 'x' * (i % 3) * 100} for i in range(30)]
+    sizes = [ResultPoster.estimate_size(dv) for dv in values]
+
+    chunks = list(ResultPoster.chunks(values, batch_size=8, batch_bytes=400))
+
+    assert [dv for chunk in chunks for dv in chunk] == values
+    assert all(len(chunk) <= 8 for chunk in chunks)
+    # A chunk only goes over the byte budget when a single value does
+    offset = 0
+    for chunk in chunks:
+        assert len(chunk) == 1 or sum(sizes[offset:offset + len(chunk)]) <= 400
+        offset += len(chunk)
+
+
+def test_large_results_are_posted_in_chunks_by_size():
+    instance = SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13)
+
+    def small_chunks(config):
+        config['server']['post_batch_bytes'] = 300
+        config['analyzer_stages'] = [s for s in config['analyzer_stages'] if s['type'] == 'validation_rules']
+
+    result, responses = asyncio.run(_run(instance, small_chunks))
+
+    assert result['errors'] == []
+    posts = sum(1 for _, method, url in responses if method == 'POST' and url == '/api/dataValueSets')
+    assert posts > 1
+    assert sum(1 for dv in instance.stored_values.values() if dv is not None) == result['data_values_posted']
+    assert result['import_summary']['imported'] == result['data_values_posted']
+
+
+def test_async_imports_wait_for_the_import_jobs_to_finish():
+    instance = SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13)
+
+    def async_import(config):
+        config['server'].update(async_import=True, post_batch_size=10)
+        config['analyzer_stages'] = [s for s in config['analyzer_stages'] if s['type'] == 'validation_rules']
+
+    result, responses = asyncio.run(_run(instance, async_import, import_job_seconds=0.3))
+
+    assert result['errors'] == []
+    posts = sum(1 for _, method, url in responses if method == 'POST' and url == '/api/dataValueSets')
+    assert result['stub_stats']['import_jobs'] == posts > 1
+    # The values are stored by the jobs, and the summaries of all jobs are collected
+    assert sum(1 for dv in instance.stored_values.values() if dv is not None) == result['data_values_posted']
+    assert result['import_summary']['imported'] == result['data_values_posted']
+    assert result['import_summary']['status'] == 'OK'
+
+
+class _PartlyFailingImports:
+    """Imports the upserts of dataset ``ok``; other chunks fail, or end with an ERROR status."""
+
+    async def post_data_value_set(self, payload, session, params=None, semaphore=None):
+        if params:
+            return {'status': 'ERROR', 'response': {'importCount': {}}}
+        if payload.get('dataSet') != 'ok':
+            raise RuntimeError('503 from DHIS2')
+        return {'status': 'OK', 'response': {'importCount': {'imported': len(payload['dataValues'])}}}
+
+
+def test_only_values_dhis2_accepted_are_counted_as_posted():
+    def values(n):
+        return [{'dataElement': 'de', 'orgUnit': f'ou{i}', 'period': '202401', 'value': '1'} for i in range(n)]
+
+    async def run():
+        poster = ResultPoster(_PartlyFailingImports(), session=None)
+        poster.add({'dataValues': [{**dv, '_dataset': 'ok'} for dv in values(3)]})
+        poster.add({'dataValues': [{**dv, '_dataset': 'broken'} for dv in values(2)]})
+        poster.add({'deletions': values(4)})
+        await poster.close()
+        return poster
+
+    poster = asyncio.run(run())
+
+    assert (poster.upserts, poster.failed_upserts) == (3, 2)
+    assert (poster.deletes, poster.failed_deletes) == (0, 4)
+    assert len(poster.errors) == 2
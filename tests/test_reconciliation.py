@@ -0,0 +1,68 @@
+import asyncio
+
+from aiohttp.test_utils import TestServer
+
+from app.analyzers.reconciliation import DataValueReconciler
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+
+COC = 'HllvX50cXC0'
+
+
+def _dv(ou, period, value, coc=None):
+    dv = {'dataElement': 'de1', 'orgUnit': ou, 'period': period, 'value': value}
+    if coc:
+        dv['categoryOptionCombo'] = coc
+    return dv
+
+
+def test_reconcile_splits_new_changed_unchanged_and_stale_values():
+    existing = [_dv('ou1', '202401', '3', COC), _dv('ou2', '202401', '1.0'), _dv('ou3', '202401', '7')]
+    calculated = [_dv('ou1', '202401', '3'), _dv('ou2', '202401', '1'), _dv('ou3', '202401', '8'),
+                  _dv('ou4', '202401', '2'), _dv('ou4', '202401', '5')]
+
+    result = DataValueReconciler(COC).reconcile(existing, calculated)
+
+    assert result.unchanged == 2  # a missing COC means the default, and 1.0 == 1
+    assert [(dv['orgUnit'], dv['value']) for dv in result.upserts] == [('ou3', '8'), ('ou4', '2')]
+    assert result.deletions == []
+    assert result.calculated == 5
+
+
+def test_reconcile_deletes_values_that_were_not_calculated_again():
+    existing = [_dv('ou1', '202401', '3'), _dv('ou1', '202402', '4')]
+    result = DataValueReconciler(COC).reconcile(existing, [_dv('ou1', '202402', '4')])
+    assert result.deletions == [existing[0]]
+    assert result.upserts == []
+
+
+async def _run_twice(instance, stale_value):
+    server = TestServer(create_app(instance))
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), stages=['outlier', 'validation_rules'])
+        first = await DataQualityMonitor(config).run_all_stages()
+        instance.import_data_values({'dataValues': [stale_value]})
+        second = await DataQualityMonitor(config).run_all_stages()
+        return first, second
+    finally:
+        await server.close()
+
+
+def test_second_run_only_removes_stale_counts():
+    instance = SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13)
+    dataset = instance.data_sets[0]['id']
+    stale = {'dataElement': instance.outlier_data_elements[dataset]['id'], 'orgUnit': instance.facilities[0],
+             'period': instance.periods[-1], 'categoryOptionCombo': COC, 'value': '99'}
+    # The facility has no outlier in that period, so an old count there is stale
+    assert not any(o['ou'] == stale['orgUnit'] and o['pe'] == stale['period']
+                   for o in instance.outliers([dataset], [instance.root], instance.periods))
+
+    first, second = asyncio.run(_run_twice(instance, stale))
+
+    assert first['data_values_posted'] > 0
+    assert second['data_values_posted'] == 0
+    assert second['data_values_deleted'] == 1
+    assert instance.stored_values[(stale['dataElement'], stale['orgUnit'], stale['period'], COC)] is None
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+from app.core.resilience import (
+    CircuitBreaker, CircuitOpenError, ResiliencePolicy, endpoint_family, parse_retry_after
+)
+
+
+def test_endpoint_family_ignores_api_version_and_extension():
+    assert endpoint_family('https://dhis2.example.org/api/40/dataValueSets.json?x=1') == 'dataValueSets'
+    assert endpoint_family('https://dhis2.example.org/api/dataIntegrity/summary/running') == 'dataIntegrity'
+    assert endpoint_family('https://dhis2.example.org/other') == 'other'
+
+
+def test_parse_retry_after_accepts_seconds_and_ignores_garbage():
+    assert parse_retry_after('3') == 3.0
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') == 0.0
+    assert parse_retry_after('soon') is None
+    assert parse_retry_after(None) is None
+
+
+def test_breaker_opens_after_threshold_and_closes_after_successful_probe():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.01)
+    assert breaker.record_failure() is False
+    assert breaker.record_failure() is True
+    assert breaker.before_request() > 0
+
+    asyncio.run(asyncio.sleep(0.02))
+    assert breaker.before_request() == 0  # the probe
+    assert breaker.before_request() > 0   # everyone else waits for it
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def _serve(statuses, calls):
+    async def handler(request):
+        calls.append(request.method)
+        status = statuses.pop(0) if statuses else 200
+        headers = {'Retry-After': '0'} if status == 429 else {}
+        return web.json_response({'status': status}, status=status, headers=headers)
+
+    app = web.Application()
+    app.router.add_route('*', '/api/outlierDetection', handler)
+    return TestServer(app)
+
+
+async def _request(policy, statuses, method='GET', **kwargs):
+    calls = []
+    server = _serve(statuses, calls)
+    await server.start_server()
+    try:
+        async with ClientSession() as session:
+            async with policy.request(session, method, str(server.make_url('/api/outlierDetection')),
+                                      asyncio.Semaphore(1), **kwargs) as response:
+                return response.status, calls
+    finally:
+        await server.close()
+
+
+def test_get_is_retried_on_transient_statuses():
+    policy = ResiliencePolicy(backoff_base=0.0)
+    status, calls = asyncio.run(_request(policy, [503, 429]))
+    assert status == 200
+    assert len(calls) == 3
+
+    summary = policy.summary()
+    assert summary['retries'] == 2
+    assert summary['retry_after_waits'] == 1
+    assert summary['by_endpoint']['outlierDetection']['requests'] == 3
+
+
+def test_post_is_not_retried_unless_marked_idempotent():
+    policy = ResiliencePolicy(backoff_base=0.0)
+    assert asyncio.run(_request(policy, [502], method='POST'))[0] == 502
+    assert asyncio.run(_request(policy, [502], method='POST', idempotent=True))[0] == 200
+
+
+def test_open_circuit_stops_requests():
+    policy = ResiliencePolicy(max_attempts=1, failure_threshold=1, reset_timeout=60)
+    assert asyncio.run(_request(policy, [503]))[0] == 503
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(_request(policy, []))
+    assert policy.summary()['circuit_opened'] == 1
@@ -0,0 +1,74 @@
+import asyncio
+
+from aiohttp.test_utils import TestServer
+
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import STATS, create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+from app.core.dhis2_client import Dhis2Client
+from app.core.run_state import RunStateStore
+
+ANALYSES = ('outlierDetection', 'dataAnalysis/validationRules')
+
+
+def test_run_state_resumes_only_the_same_configuration(tmp_path):
+    store = RunStateStore(tmp_path / 'runs.sqlite')
+
+    progress = store.begin('stages', 'fingerprint-a')
+    progress.save_unit('unit', [[{'value': '1'}], False])
+    progress.acknowledge({'dataValues': [{'value': '1'}]})
+
+    resumed = store.begin('stages', 'fingerprint-a', resume=True)
+    assert resumed.resumed and resumed.get_unit('unit') == [[{'value': '1'}], False]
+    assert resumed.is_acknowledged({'dataValues': [{'value': '1'}]})
+    # A changed configuration, or a run which is not resumed, starts from scratch
+    assert not store.begin('stages', 'fingerprint-b', resume=True).resumed
+    assert store.begin('stages', 'fingerprint-b').get_unit('unit') is None
+
+    progress = store.begin('stages', 'fingerprint-b')
+    progress.save_unit('unit', 1)
+    progress.finish()
+    assert not store.begin('stages', 'fingerprint-b', resume=True).resumed
+
+
+async def _run_four_times(instance, store):
+    app = create_app(instance)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), stages=['outlier', 'validation_rules'])
+        stages = config['analyzer_stages']
+        # A broken stage makes the run fail, so that its progress is kept
+        config['analyzer_stages'] = [stages[0], stages[-1], {'name': 'Broken', 'type': 'outlier', 'params': {}}]
+        # A run of one of the stages from the web interface in between, which does not record
+        # its progress, leaves the interrupted run alone
+        web_config = {**config, 'analyzer_stages': [stages[0]]}
+        runs = []
+        for run_config, resume, record_progress in ((config, False, True), (web_config, False, False),
+                                                    (config, True, True), (config, False, True)):
+            client = Dhis2Client.from_config(run_config)
+            client.run_state = store
+            before = {family: app[STATS][family] for family in ANALYSES}
+            monitor = DataQualityMonitor(run_config, client=client, resume=resume, record_progress=record_progress)
+            result = await monitor.run_all_stages()
+            runs.append((result, {family: app[STATS][family] - before[family] for family in ANALYSES}))
+        return runs
+    finally:
+        await server.close()
+
+
+def test_resumed_run_skips_the_completed_analysis_requests(tmp_path):
+    instance = SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13)
+    store = RunStateStore(tmp_path / 'runs.sqlite')
+
+    (first, first_requests), _, (resumed, resumed_requests), (again, again_requests) = \
+        asyncio.run(_run_four_times(instance, store))
+
+    assert first['data_values_posted'] > 0 and len(first['errors']) == 1
+    assert all(first_requests[family] > 0 for family in ANALYSES)
+    # The resumed run reuses the saved outputs; everything was posted, so nothing is outstanding
+    assert resumed_requests == {family: 0 for family in ANALYSES}
+    assert resumed['data_values_posted'] == 0 and len(resumed['errors']) == 1
+    # Without --resume the run starts from scratch
+    assert again_requests == first_requests
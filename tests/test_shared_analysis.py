@@ -0,0 +1,85 @@
+import asyncio
+
+from aiohttp.test_utils import TestServer
+
+from app.analyzers.outlier_analyzer import OutlierAnalyzer
+from app.benchmark.run import build_config
+from app.benchmark.stub_server import create_app
+from app.benchmark.synthetic import SyntheticInstance
+from app.cli import DataQualityMonitor
+from app.core.api_utils import Dhis2ApiUtils
+from app.core.dhis2_client import Dhis2Client
+
+ANALYSES = ('outlierDetection', 'dataAnalysis/validationRules')
+
+
+async def _run_stages(instance, duplicate):
+    server = TestServer(create_app(instance))
+    await server.start_server()
+    try:
+        config = build_config(instance, str(server.make_url('')).rstrip('/'), stages=['outlier', 'validation_rules'])
+        stages = []
+        for stage_type in ('outlier', 'validation_rules'):
+            first, second = [stage for stage in config['analyzer_stages'] if stage['type'] == stage_type][:2]
+            stages.append(first)
+            if duplicate:
+                # The same analysis as the first stage, stored in the second stage's data element
+                destination = second['params']['destination_data_element']
+                stages.append({**first, 'name': f"{first['name']} again",
+                               'params': {**first['params'], 'destination_data_element': destination}})
+        config['analyzer_stages'] = stages
+        result = await DataQualityMonitor(config).run_all_stages()
+        return stages, result
+    finally:
+        await server.close()
+
+
+def _posted(instance, data_element):
+    return {(ou, pe): dv['value'] for (de, ou, pe, _), dv in instance.stored_values.items()
+            if de == data_element and dv is not None}
+
+
+def test_stages_with_the_same_analysis_share_its_requests():
+    instance = SyntheticInstance(branching=(2, 3, 4), data_elements=12, data_sets=2, months=13)
+    _, single = asyncio.run(_run_stages(instance, duplicate=False))
+    stages, shared = asyncio.run(_run_stages(instance, duplicate=True))
+
+    assert single['errors'] == [] and shared['errors'] == []
+    for family in ANALYSES:
+        assert shared['http_metrics'][family]['requests'] == single['http_metrics'][family]['requests'] > 0
+    # Both stages of each pair store the same counts
+    for first, again in (stages[:2], stages[2:]):
+        counts = _posted(instance, first['params']['destination_data_element'])
+        assert counts and _posted(instance, again['params']['destination_data_element']) == counts
+
+
+class Session:
+    """Stands in for the aiohttp session the memo of a run is tied to."""
+
+
+def test_shared_results_are_released_by_stages_which_finish_without_using_them():
+    client = Dhis2Client('http://dhis2.example.org', 'token')
+    analyzer = OutlierAnalyzer({'server': {}}, client.base_url, {},
+                               Dhis2ApiUtils(client.base_url, 'token', client=client))
+    stage = {'name': 'Outliers', 'type': 'outlier', 'params': {'dataset': 'ds1', 'destination_data_element': 'a'}}
+    again = {**stage, 'name': 'Outliers again', 'params': {**stage['params'], 'destination_data_element': 'b'}}
+    analyzer.shared_analyses = {analyzer.analysis_signature(stage): {stage['name'], again['name']}}
+    session = Session()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return ['raw response']
+
+    async def run():
+        # The second stage takes another request, e.g. because its incremental plan differs
+        await analyzer.shared_request(session, 'window 1', fetch, stage)
+        assert len(client.memo(session)._tasks) == 1
+        analyzer.release_shared(again, session)
+        assert client.memo(session)._tasks == {}
+        # Once it has finished, the other stage no longer holds on to what it fetches
+        await analyzer.shared_request(session, 'window 2', fetch, stage)
+        assert client.memo(session)._tasks == {}
+
+    asyncio.run(run())
+    assert len(calls) == 2
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from app.core.single_flight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call_and_later_callers_hit_the_memo():
+    calls = []
+
+    async def lookup():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'periodType': 'Monthly'}
+
+    async def run():
+        memo = SingleFlight()
+        results = await asyncio.gather(*(memo.do(('period_type', 'ds'), lookup) for _ in range(5)))
+        results.append(await memo.do(('period_type', 'ds'), lookup))
+        return memo, results
+
+    memo, results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+    assert (memo.misses, memo.hits) == (1, 5)
+
+
+def test_failures_are_not_memoized():
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError('boom')
+        return 'ok'
+
+    async def run():
+        memo = SingleFlight()
+        with pytest.raises(RuntimeError):
+            await memo.do('key', flaky)
+        return await memo.do('key', flaky)
+
+    assert asyncio.run(run()) == 'ok'
+    assert len(attempts) == 2
+
+
+def test_results_with_a_known_number_of_uses_are_dropped_after_the_last_one():
+    calls = []
+
+    async def lookup():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return ['outlier values']
+
+    async def run():
+        memo = SingleFlight()
+        shared = await asyncio.gather(memo.do('request', lookup, uses=2), memo.do('request', lookup, uses=2))
+        again = await memo.do('request', lookup, uses=2)
+        return shared, again
+
+    shared, again = asyncio.run(run())
+    assert shared[0] is shared[1] and again == shared[0]
+    assert len(calls) == 2